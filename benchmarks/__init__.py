@@ -0,0 +1,4 @@
+"""Benchmarks for the conversion and ingest paths
+
+Run from the repository root, e.g. python -m benchmarks.bench_to_datetime_string
+"""
@@ -0,0 +1,238 @@
+"""Measure the allocations and garbage collections of each converter on synthetic EventHub batches
+
+Each publisher path converts its events in batches, as the functions receive them. One pass runs
+under tracemalloc and reports, per batch, the peak of memory allocated above what was in use
+when the batch started, and the blocks and bytes still held once it returns (mostly the records
+it produced), per event. tracemalloc slows everything, so the collections and their pauses are
+counted with gc.callbacks on separate passes, once for each way of configuring the collector:
+
+    default    the interpreter's thresholds
+    threshold  gc.set_threshold(--threshold), so the young generation is collected less often
+    freeze     gc.freeze() after a warm-up batch, so the modules, schema and clients loaded by
+               then are never scanned again
+    both       the two together
+
+Usage: python -m benchmarks.bench_allocations [--events N] [--batch-size N]
+    [--mix glow=0.4,emon=0.3,homie=0.25,bmw=0.05] [--seed N] [--threshold 50000,20,20]
+"""  # noqa: E501
+
+import argparse
+import gc
+import json
+import os
+import statistics
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+from azure.functions import EventHubEvent
+
+from benchmarks.bench_converters import CaptureOut, reset_bmw_dedupe
+from benchmarks.synthetic_events import DEFAULT_MIX, SyntheticEventGenerator, parse_mix
+from shared_code import json_converter
+from shared_code.bmw_to_timescale import convert_bmw_to_timescale
+from shared_code.emon import emon_to_timescale
+from shared_code.glow import glow_to_timescale
+from shared_code.homie import homie_to_timescale
+
+GC_MODES = ["default", "threshold", "freeze", "both"]
+
+
+class GcMonitor:
+    """Counts the collections of each generation, and how long they paused the converter"""
+
+    def __init__(self):
+        self.collections = [0, 0, 0]
+        self.pause_ms = 0.0
+        self.started = 0.0
+
+    def __call__(self, phase: str, info: Dict[str, Any]) -> None:
+        if phase == "start":
+            self.started = time.perf_counter()
+        else:
+            self.collections[info["generation"]] += 1
+            self.pause_ms += (time.perf_counter() - self.started) * 1000
+
+
+def records_with(converter: Callable[[dict, str, str], Any]) -> Callable:
+    def convert(events: List[EventHubEvent]) -> List[Any]:
+        records = []
+        for event in events:
+            messagebody = json.loads(event.get_body().decode("utf-8"))
+            topic = messagebody["topic"]
+            records.extend(converter(messagebody, topic, topic.split("/")[0]) or [])
+        return records
+
+    return convert
+
+
+def messages_from_json(events: List[EventHubEvent]) -> List[str]:
+    out = CaptureOut()
+    json_converter.convert_json_to_timeseries(events, out)
+    return out.value
+
+
+def messages_from_bmw(events: List[EventHubEvent]) -> List[str]:
+    out = CaptureOut()
+    convert_bmw_to_timescale(events, out, CaptureOut())
+    return out.value
+
+
+def to_batches(events: List[EventHubEvent], size: int) -> List[List[EventHubEvent]]:
+    batches = []
+    for event in events:
+        if not batches or len(batches[-1]) == size:
+            batches.append([])
+        batches[-1].append(event)
+    return batches
+
+
+def measure_allocations(
+    convert: Callable[[List[EventHubEvent]], List[Any]],
+    batches: List[List[EventHubEvent]],
+) -> Dict[str, float]:
+    """@return: peak KiB per batch, and blocks and bytes held per event once each batch returns"""  # noqa: E501
+    ignore_tracemalloc = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    peaks, blocks, size = [], 0, 0
+    # the first batch fills the caches of a new worker, so it is left out as in measure_collections
+    convert(batches[0])
+    tracemalloc.start()
+    try:
+        for batch in batches[1:]:
+            before = tracemalloc.take_snapshot().filter_traces(ignore_tracemalloc)
+            tracemalloc.reset_peak()
+            start, _ = tracemalloc.get_traced_memory()
+            output = convert(batch)
+            _, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot().filter_traces(ignore_tracemalloc)
+            peaks.append((peak - start) / 1024)
+            for stat in after.compare_to(before, "filename"):
+                blocks += stat.count_diff
+                size += stat.size_diff
+            del output
+    finally:
+        tracemalloc.stop()
+    events = sum(len(batch) for batch in batches[1:])
+    return {
+        "peak KiB": statistics.median(peaks),
+        "blocks/ev": blocks / events,
+        "B/ev": size / events,
+    }
+
+
+def measure_collections(
+    convert: Callable[[List[EventHubEvent]], List[Any]],
+    batches: List[List[EventHubEvent]],
+    mode: str,
+    threshold: Tuple[int, ...],
+) -> Dict[str, float]:
+    """@return: the median ms per batch, and the collections of each generation and their pause per batch"""  # noqa: E501
+    default_threshold = gc.get_threshold()
+    monitor = GcMonitor()
+    gc.collect()
+    # the first batch stands in for the first invocation on a new worker, before gc is tuned
+    convert(batches[0])
+    if mode in ("threshold", "both"):
+        gc.set_threshold(*threshold)
+    if mode in ("freeze", "both"):
+        gc.freeze()
+    gc.callbacks.append(monitor)
+    elapsed = []
+    try:
+        for batch in batches[1:]:
+            start = time.perf_counter()
+            convert(batch)
+            elapsed.append((time.perf_counter() - start) * 1000)
+    finally:
+        gc.callbacks.remove(monitor)
+        gc.unfreeze()
+        gc.set_threshold(*default_threshold)
+    measured = len(batches) - 1
+    return {
+        "batch ms": statistics.median(elapsed),
+        "gen0/b": monitor.collections[0] / measured,
+        "gen1/b": monitor.collections[1] / measured,
+        "gen2/b": monitor.collections[2] / measured,
+        "gc ms/b": monitor.pause_ms / measured,
+    }
+
+
+def print_row(name: str, result: Dict[str, float], columns: List[str]) -> None:
+    print(f"{name:<38}" + "".join(f"{result[c]:>11.3f}" for c in columns))
+
+
+def run(
+    events: int,
+    batch_size: int,
+    mix: Dict[str, float],
+    seed: int,
+    threshold: Tuple[int, ...],
+) -> None:
+    os.environ["DEDUPE_BACKEND"] = "memory"
+    os.environ["JSON_CONVERTER_WORKERS"] = "0"
+    batch = SyntheticEventGenerator(mix, seed).make_batch(events)
+    by_publisher: Dict[str, List[EventHubEvent]] = {}
+    for publisher, event in batch:
+        by_publisher.setdefault(publisher, []).append(event)
+    json_events = [event for publisher, event in batch if publisher != "bmw"]
+    cases = [
+        ("glow_to_timescale", records_with(glow_to_timescale), "glow"),
+        ("homie_to_timescale", records_with(homie_to_timescale), "homie"),
+        ("emon_to_timescale", records_with(emon_to_timescale), "emon"),
+        ("convert_json_to_timeseries", messages_from_json, json_events),
+        ("convert_bmw_to_timescale", messages_from_bmw, "bmw"),
+    ]
+    runnable = []
+    for name, convert, case_events in cases:
+        if isinstance(case_events, str):
+            case_events = by_publisher.get(case_events, [])
+        batches = to_batches(case_events, batch_size)
+        # the first batch warms up, so at least one more is needed
+        if len(batches) < 2:
+            print(f"{name}: fewer than {batch_size + 1} events in mix, skipped")
+            continue
+        runnable.append((name, convert, batches))
+
+    print(f"{events} events in batches of {batch_size}, mix {mix}, seed {seed}")
+    columns = ["peak KiB", "blocks/ev", "B/ev"]
+    print(f"{'allocations':<38}" + "".join(f"{c:>11}" for c in columns))
+    for name, convert, batches in runnable:
+        reset_bmw_dedupe()
+        print_row(name, measure_allocations(convert, batches), columns)
+
+    print(f"gc thresholds: default {gc.get_threshold()}, tuned {threshold}")
+    columns = ["batch ms", "gen0/b", "gen1/b", "gen2/b", "gc ms/b"]
+    print(f"{'collections':<38}" + "".join(f"{c:>11}" for c in columns))
+    for name, convert, batches in runnable:
+        for mode in GC_MODES:
+            reset_bmw_dedupe()
+            result = measure_collections(convert, batches, mode, threshold)
+            print_row(f"{name} ({mode})", result, columns)
+
+
+def parse_threshold(threshold: str) -> Tuple[int, ...]:
+    values = tuple(int(value) for value in threshold.split(","))
+    if not 1 <= len(values) <= 3 or values[0] < 1:
+        raise ValueError(f"Invalid gc threshold: {threshold}")
+    return values
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--events", type=int, default=4000)
+    arg_parser.add_argument("--batch-size", type=int, default=100)
+    arg_parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=DEFAULT_MIX,
+        help="publisher=weight pairs, from glow, emon, homie and bmw",
+    )
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument(
+        "--threshold",
+        type=parse_threshold,
+        default=(50000, 20, 20),
+        help="gc.set_threshold arguments for the threshold and both modes",
+    )
+    args = arg_parser.parse_args()
+    run(args.events, args.batch_size, args.mix, args.seed, args.threshold)
@@ -0,0 +1,168 @@
+"""Measure the throughput, latency and peak memory of each converter on synthetic EventHub batches
+
+Each converter is given the events of its publisher one at a time, for per-event latency, and
+convert_json_to_timeseries and convert_bmw_to_timescale are also given the whole batch, as the
+functions receive it. Peak memory is measured on a separate pass, as tracemalloc slows everything.
+
+Usage: python -m benchmarks.bench_converters [--events N] [--mix glow=0.4,emon=0.3,homie=0.25,bmw=0.05]
+    [--seed N] [--repeats N]
+"""  # noqa: E501
+
+import argparse
+import json
+import os
+import statistics
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from azure.functions import EventHubEvent
+
+from benchmarks.synthetic_events import DEFAULT_MIX, SyntheticEventGenerator, parse_mix
+from shared_code import dedupe_backend, json_converter
+from shared_code.bmw_to_timescale import convert_bmw_to_timescale
+from shared_code.emon import emon_to_timescale
+from shared_code.glow import glow_to_timescale
+from shared_code.homie import homie_to_timescale
+
+
+class CaptureOut:
+    """Stands in for the func.Out output binding"""
+
+    def __init__(self):
+        self.value: List[str] = []
+
+    def set(self, value: List[str]) -> None:
+        self.value = value
+
+    def get(self) -> List[str]:
+        return self.value
+
+
+def convert_with(converter: Callable[[dict, str, str], Any]) -> Callable:
+    def convert(events: List[EventHubEvent]) -> int:
+        records = 0
+        for event in events:
+            messagebody = json.loads(event.get_body().decode("utf-8"))
+            topic = messagebody["topic"]
+            records += len(converter(messagebody, topic, topic.split("/")[0]) or [])
+        return records
+
+    return convert
+
+
+def convert_json(events: List[EventHubEvent]) -> int:
+    out = CaptureOut()
+    json_converter.convert_json_to_timeseries(events, out)
+    return len(out.value)
+
+
+def convert_bmw(events: List[EventHubEvent]) -> int:
+    out = CaptureOut()
+    convert_bmw_to_timescale(events, out, CaptureOut())
+    return len(out.value)
+
+
+def reset_bmw_dedupe() -> None:
+    # a fresh in-memory dedupe store, so repeated passes are not discarded as duplicates
+    dedupe_backend.dedupe_backends.pop("memory", None)
+
+
+def measure(
+    convert: Callable[[List[EventHubEvent]], int],
+    events: List[EventHubEvent],
+    per_event: bool,
+    repeats: int,
+    before_pass: Callable[[], None],
+) -> Dict[str, float]:
+    """@return: events/s and records/s of the best pass, p50/p99 latency in ms and peak memory in MiB"""  # noqa: E501
+    best_elapsed = float("inf")
+    latencies: List[float] = []
+    for _ in range(repeats):
+        before_pass()
+        records = 0
+        pass_latencies = []
+        start = time.perf_counter()
+        if per_event:
+            for event in events:
+                event_start = time.perf_counter()
+                records += convert([event])
+                pass_latencies.append((time.perf_counter() - event_start) * 1000)
+        else:
+            records = convert(events)
+        elapsed = time.perf_counter() - start
+        if elapsed < best_elapsed:
+            best_elapsed, best_records, latencies = elapsed, records, pass_latencies
+
+    before_pass()
+    tracemalloc.start()
+    if per_event:
+        for event in events:
+            convert([event])
+    else:
+        convert(events)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "events/s": len(events) / best_elapsed,
+        "records/s": best_records / best_elapsed,
+        "p50 ms": statistics.median(latencies) if latencies else float("nan"),
+        "p99 ms": (
+            statistics.quantiles(latencies, n=100)[-1]
+            if len(latencies) > 1
+            else float("nan")
+        ),
+        "peak MiB": peak / 2**20,
+    }
+
+
+def run(events: int, mix: Dict[str, float], seed: int, repeats: int) -> None:
+    os.environ["DEDUPE_BACKEND"] = "memory"
+    os.environ["JSON_CONVERTER_WORKERS"] = "0"
+    batch = SyntheticEventGenerator(mix, seed).make_batch(events)
+    by_publisher: Dict[str, List[EventHubEvent]] = {}
+    for publisher, event in batch:
+        by_publisher.setdefault(publisher, []).append(event)
+    json_events = [event for publisher, event in batch if publisher != "bmw"]
+    bmw_events = by_publisher.get("bmw", [])
+
+    cases = [
+        ("glow_to_timescale", convert_with(glow_to_timescale), "glow", True),
+        ("homie_to_timescale", convert_with(homie_to_timescale), "homie", True),
+        ("emon_to_timescale", convert_with(emon_to_timescale), "emon", True),
+        ("convert_json_to_timeseries", convert_json, json_events, True),
+        ("  (whole batch)", convert_json, json_events, False),
+        ("convert_bmw_to_timescale", convert_bmw, bmw_events, True),
+        ("  (whole batch)", convert_bmw, bmw_events, False),
+    ]
+    columns = ["events/s", "records/s", "p50 ms", "p99 ms", "peak MiB"]
+    print(f"{events} events, mix {mix}, seed {seed}")
+    print(f"{'converter':<28}{'events':>8}" + "".join(f"{c:>11}" for c in columns))
+    for name, convert, case_events, per_event in cases:
+        if isinstance(case_events, str):
+            case_events = by_publisher.get(case_events, [])
+        if not case_events:
+            print(f"{name:<28}{0:>8}  no events in mix")
+            continue
+        before_pass = reset_bmw_dedupe if convert is convert_bmw else lambda: None
+        result = measure(convert, case_events, per_event, repeats, before_pass)
+        print(
+            f"{name:<28}{len(case_events):>8}"
+            + "".join(f"{result[c]:>11.3f}" for c in columns)
+        )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--events", type=int, default=2000)
+    arg_parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=DEFAULT_MIX,
+        help="publisher=weight pairs, from glow, emon, homie and bmw",
+    )
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--repeats", type=int, default=3)
+    args = arg_parser.parse_args()
+    run(args.events, args.mix, args.seed, args.repeats)
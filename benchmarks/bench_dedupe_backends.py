@@ -0,0 +1,106 @@
+"""Measure the latency of each dedupe backend for new and duplicate BMW updates
+
+Runs against local stand-ins: Azurite for Azure Tables, and a local Postgres. A backend which
+cannot be reached is reported and skipped.
+
+Usage: python -m benchmarks.bench_dedupe_backends [--updates N] [--azurite CONNECTION_STRING]
+    [--postgres CONNECTION_STRING]
+"""
+
+import argparse
+import os
+import statistics
+import time
+import uuid
+from typing import Callable, Dict, List
+
+from azure.data.tables import TableServiceClient
+
+from shared_code.dedupe_backend import (
+    DedupeBackend,
+    MemoryDedupeBackend,
+    PostgresDedupeBackend,
+    TableDedupeBackend,
+)
+
+# the well-known development account of the Azurite emulator
+AZURITE_CONNECTION_STRING = (
+    "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;"
+    "AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;"  # noqa: E501
+    "TableEndpoint=http://127.0.0.1:10002/devstoreaccount1;"
+)
+POSTGRES_CONNECTION_STRING = (
+    "dbname=postgres user=postgres password=postgres host=localhost port=5432"
+)
+
+
+def time_calls(call: Callable[[str], object], identifiers: List[str]) -> List[float]:
+    """@return: the latency of each call, in milliseconds"""
+    latencies = []
+    for identifier in identifiers:
+        start = time.perf_counter()
+        call(identifier)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def measure(backend: DedupeBackend, updates: int) -> Dict[str, List[float]]:
+    # a fresh context per run, so earlier runs never count as duplicates
+    context = f"bench{uuid.uuid4().hex[:16]}"
+    identifiers = [f"2024-01-01T00:00:{i:05d}Z" for i in range(updates)]
+
+    def claim_and_confirm(identifier: str) -> None:
+        if backend.claim_id(identifier, context):
+            backend.confirm_id(identifier, context)
+
+    return {
+        "new": time_calls(claim_and_confirm, identifiers),
+        "duplicate": time_calls(lambda i: backend.claim_id(i, context), identifiers),
+    }
+
+
+def make_backends(
+    azurite: str, postgres: str
+) -> Dict[str, Callable[[], DedupeBackend]]:
+    return {
+        "memory": MemoryDedupeBackend,
+        "table (azurite)": lambda: TableDedupeBackend(
+            TableServiceClient.from_connection_string(azurite)
+        ),
+        "postgres": lambda: PostgresDedupeBackend(postgres, table_name="dedupe_bench"),
+    }
+
+
+def run(updates: int, azurite: str, postgres: str) -> None:
+    print(f"{'backend':<18}{'operation':<11}{'mean ms':>9}{'p50 ms':>9}{'p95 ms':>9}")
+    for name, make_backend in make_backends(azurite, postgres).items():
+        try:
+            backend = make_backend()
+            # the first call pays for connecting and creating tables
+            backend.claim_id("warm-up", f"warmup{uuid.uuid4().hex[:16]}")
+        except Exception as e:
+            print(f"{name:<18}skipped: {e}")
+            continue
+        for operation, latencies in measure(backend, updates).items():
+            p95 = statistics.quantiles(latencies, n=20)[-1]
+            print(
+                f"{name:<18}{operation:<11}{statistics.mean(latencies):>9.3f}"
+                f"{statistics.median(latencies):>9.3f}{p95:>9.3f}"
+            )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--updates", type=int, default=200)
+    arg_parser.add_argument(
+        "--azurite",
+        default=os.environ.get("AZURITE_CONNECTION_STRING", AZURITE_CONNECTION_STRING),
+    )
+    arg_parser.add_argument(
+        "--postgres",
+        default=os.environ.get(
+            "DEDUPE_POSTGRES_CONNECTION_STRING", POSTGRES_CONNECTION_STRING
+        ),
+    )
+    args = arg_parser.parse_args()
+    run(args.updates, args.azurite, args.postgres)
@@ -0,0 +1,57 @@
+"""Compare deserialize_nested_json against recursively_deserialize on the BMW state fixture
+
+Usage: python -m benchmarks.bench_deserialize [--iterations N]
+"""
+
+import argparse
+import json
+import os
+import timeit
+
+from shared_code import helpers
+
+BMW_STATE_PATH = os.sep.join(
+    [
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "test",
+        "cleaned_bmw_api_state_data.json",
+    ]
+)
+
+
+def run(iterations: int) -> None:
+    with open(BMW_STATE_PATH, "rb") as f:
+        raw_bytes = f.read()
+    raw_string = raw_bytes.decode("utf-8")
+    # the same state as it arrives from bmw_update, serialised again inside an envelope
+    wrapped = json.dumps({"body": raw_string, "vin": "WBA00000000000000"})
+    cases = {
+        "bmw state (str)": (
+            lambda: helpers.recursively_deserialize(raw_string),
+            lambda: helpers.deserialize_nested_json(raw_string),
+        ),
+        "bmw state (bytes)": (
+            lambda: helpers.recursively_deserialize(raw_bytes.decode("utf-8")),
+            lambda: helpers.deserialize_nested_json(raw_bytes),
+        ),
+        "bmw state (wrapped)": (
+            lambda: helpers.recursively_deserialize(wrapped),
+            lambda: helpers.deserialize_nested_json(wrapped),
+        ),
+    }
+    print(f"{'case':<22}{'original ms':>14}{'heuristic ms':>14}{'speedup':>10}")
+    for name, (original, heuristic) in cases.items():
+        assert original() == heuristic()
+        original_time = timeit.timeit(original, number=iterations) / iterations
+        heuristic_time = timeit.timeit(heuristic, number=iterations) / iterations
+        print(
+            f"{name:<22}{original_time * 1e3:>14.3f}{heuristic_time * 1e3:>14.3f}"
+            f"{original_time / heuristic_time:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--iterations", type=int, default=200)
+    run(arg_parser.parse_args().iterations)
@@ -0,0 +1,111 @@
+"""Measure the cold-start import time of each function entry point
+
+Each entry point is imported in a fresh interpreter with -X importtime, as a new Functions worker
+would, and the median total over the runs is reported with the slowest modules it pulled in. The
+heavy libraries each entry point should not import are checked too, and with --max-ms the script
+exits non-zero if any entry point is slower, so it can guard cold start in CI.
+
+Usage: python -m benchmarks.bench_import_time [--runs N] [--top N] [--max-ms MS]
+    [json_to_timeseries timeseries_to_timescale ...]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = [
+    "json_to_timeseries",
+    "timeseries_to_timescale",
+    "bmw_to_timescale",
+    "bmw_update",
+    "dedupe_purge",
+]
+# libraries an entry point pays for at cold start without using them
+UNUSED_LIBRARIES: Dict[str, List[str]] = {
+    "json_to_timeseries": [
+        "psycopg",
+        "jsonschema",
+        "azure.data.tables",
+        "bimmer_connected",
+    ],
+    "timeseries_to_timescale": ["azure.data.tables", "bimmer_connected"],
+    "bmw_to_timescale": ["psycopg", "jsonschema", "bimmer_connected"],
+}
+
+
+def import_once(entry_point: str) -> Tuple[float, Dict[str, float]]:
+    """Import the entry point in a new interpreter
+    @return: the total import time in ms, and the cumulative time of each module it imported
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {entry_point}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules: Dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        if cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative) / 1000
+    return modules[entry_point], modules
+
+
+def measure(entry_point: str, runs: int) -> Tuple[float, Dict[str, float]]:
+    """@return: the median import time in ms, and the modules of the median run"""
+    results = sorted(
+        (import_once(entry_point) for _ in range(runs)), key=lambda r: r[0]
+    )
+    return (
+        statistics.median(total for total, _ in results),
+        results[len(results) // 2][1],
+    )
+
+
+def run(entry_points: List[str], runs: int, top: int, max_ms: float) -> int:
+    over_budget = []
+    for entry_point in entry_points:
+        total, modules = measure(entry_point, runs)
+        print(f"{entry_point}: {total:.1f}ms (median of {runs})")
+        slowest = sorted(
+            (item for item in modules.items() if item[0] != entry_point),
+            key=lambda item: item[1],
+            reverse=True,
+        )[:top]
+        for name, cumulative in slowest:
+            print(f"{cumulative:>10.1f}ms  {name}")
+        if unused := [
+            library
+            for library in UNUSED_LIBRARIES.get(entry_point, [])
+            if library in modules
+        ]:
+            print(f"  imports libraries it does not use: {', '.join(unused)}")
+            over_budget.append(entry_point)
+        if max_ms and total > max_ms:
+            over_budget.append(entry_point)
+    if over_budget:
+        print(f"Over budget: {', '.join(sorted(set(over_budget)))}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("entry_points", nargs="*", default=ENTRY_POINTS)
+    arg_parser.add_argument("--runs", type=int, default=5)
+    arg_parser.add_argument("--top", type=int, default=8)
+    arg_parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=0,
+        help="fail if any entry point takes longer to import, 0 to only report",
+    )
+    args = arg_parser.parse_args()
+    sys.exit(run(args.entry_points, args.runs, args.top, args.max_ms))
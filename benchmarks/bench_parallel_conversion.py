@@ -0,0 +1,58 @@
+"""Measure how convert_json_to_timeseries scales across worker processes
+
+Usage: python -m benchmarks.bench_parallel_conversion [--events N] [--max-workers N] [--repeats N]
+"""
+
+import argparse
+import os
+import time
+from unittest.mock import Mock
+
+import azure.functions as func
+
+from shared_code import json_converter
+from test_utils.get_test_data import create_event_hub_event, load_test_data
+
+EVENT_NAMES = ["glow_electricitymeter", "glow_gasmeter", "emontx4_json", "homie_mode"]
+
+
+def make_batch(size: int) -> list[str]:
+    test_data = load_test_data()
+    bodies = [
+        create_event_hub_event(test_data[name]["properties"]).get_body().decode("utf-8")
+        for name in EVENT_NAMES
+    ]
+    return [bodies[i % len(bodies)] for i in range(size)]
+
+
+def time_batch(batch: list[str], workers: int, repeats: int) -> float:
+    os.environ["JSON_CONVERTER_WORKERS"] = str(workers)
+    os.environ["JSON_CONVERTER_PARALLEL_THRESHOLD"] = "1"
+    # warm the pool (and the children's imports) before timing
+    json_converter.convert_json_to_timeseries(batch, Mock(spec=func.Out))
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        json_converter.convert_json_to_timeseries(batch, Mock(spec=func.Out))
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(events: int, max_workers: int, repeats: int) -> None:
+    batch = make_batch(events)
+    serial = time_batch(batch, 0, repeats)
+    print(f"{'workers':>8}{'events/s':>12}{'speedup':>10}")
+    print(f"{'serial':>8}{events / serial:>12.0f}{1:>9.2f}x")
+    for workers in range(1, max_workers + 1):
+        elapsed = time_batch(batch, workers, repeats)
+        print(f"{workers:>8}{events / elapsed:>12.0f}{serial / elapsed:>9.2f}x")
+    json_converter.shutdown_process_pool()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--events", type=int, default=5000)
+    arg_parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    arg_parser.add_argument("--repeats", type=int, default=3)
+    args = arg_parser.parse_args()
+    run(args.events, args.max_workers, args.repeats)
@@ -0,0 +1,226 @@
+"""Measure how fast timeseries_to_timescale can write to a local TimescaleDB
+
+Creates a table and its roles with db/create_table_and_roles.sql, then drives store_data as the
+table's writer user with generated batches of EventHubEvents, one record per event, as
+timeseries_to_timescale receives them. Reports rows/s, per-batch transaction latency and WAL
+bytes per row for each combination of batch size, data type mix and concurrency. The table and
+roles are dropped afterwards with db/cleanup_table_and_roles.sql unless --keep is given.
+
+Usage: python -m benchmarks.bench_timescale_ingest [--connection-string DSN] [--table NAME]
+    [--rows N] [--batch-sizes 1,10,100,500] [--concurrency 1,4]
+    [--mixes number=1 number=0.7,string=0.1,boolean=0.1,geography=0.1] [--keep]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import re
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import psycopg
+from azure.functions import EventHubEvent
+from psycopg.conninfo import conninfo_to_dict
+
+from benchmarks.synthetic_events import parse_mix
+from shared_code.settings import reload_settings
+from shared_code.timescale import store_data
+from test_utils.get_test_data import create_event_hub_event
+
+DB_PATH = os.sep.join([os.path.dirname(os.path.abspath(__file__)), "..", "db"])
+POSTGRES_CONNECTION_STRING = (
+    "dbname=postgres user=postgres password=postgres host=localhost port=5432"
+)
+DATA_TYPES = ["number", "string", "boolean", "geography"]
+START_TIME = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def run_sql_script(conn: psycopg.Connection, script: str, table_name: str) -> None:
+    """Run one of the scripts in db/, as psql would with -v table_name=..."""
+    if not re.fullmatch(r"[a-z_][a-z0-9_]*", table_name):
+        raise ValueError(f"Invalid table name: {table_name}")
+    with open(os.sep.join([DB_PATH, script]), "r") as f:
+        sql = f.read()
+    conn.execute(sql.replace(":table_name", f"'{table_name}'"))
+
+
+def make_record(data_type: str, index: int, rng: random.Random) -> Dict[str, Any]:
+    if data_type == "number":
+        measurement_of, value = "power", round(rng.uniform(0, 5000), 3)
+    elif data_type == "string":
+        measurement_of, value = "mode", rng.choice(["Home", "Away", "Night"])
+    elif data_type == "boolean":
+        measurement_of, value = "isChargerConnected", rng.random() < 0.5
+    else:
+        measurement_of = "location"
+        value = [51.5 + rng.uniform(-0.1, 0.1), -0.12 + rng.uniform(-0.1, 0.1)]
+    return {
+        # a reading every 100ms, so a run stays within one or two chunks
+        "timestamp": (START_TIME + datetime.timedelta(milliseconds=index * 100))
+        .isoformat()
+        .replace("+00:00", "Z"),
+        "measurement_subject": f"sensor{index % 20}",
+        "measurement_publisher": "bench",
+        "measurement_of": measurement_of,
+        "measurement_value": value,
+        "measurement_data_type": data_type,
+        "correlation_id": f"bench-{index // 10}",
+    }
+
+
+def make_events(rows: int, mix: Dict[str, float], seed: int) -> List[EventHubEvent]:
+    rng = random.Random(seed)
+    data_types = list(mix)
+    weights = [mix[data_type] for data_type in data_types]
+    return [
+        create_event_hub_event(
+            {
+                "body": json.dumps(
+                    make_record(rng.choices(data_types, weights)[0], i, rng)
+                ),
+                "offset": str(i),
+                "sequence_number": i,
+            }
+        )
+        for i in range(rows)
+    ]
+
+
+def timed_store(batch: List[EventHubEvent]) -> float:
+    """@return: how long store_data took, in milliseconds"""
+    start = time.perf_counter()
+    store_data(batch)
+    return (time.perf_counter() - start) * 1000
+
+
+def get_wal_lsn(admin_conn: psycopg.Connection) -> str:
+    return admin_conn.execute("SELECT pg_current_wal_lsn()").fetchone()[0]
+
+
+def measure(
+    admin_conn: psycopg.Connection,
+    events: List[EventHubEvent],
+    batch_size: int,
+    concurrency: int,
+) -> Dict[str, float]:
+    batches = [events[i : i + batch_size] for i in range(0, len(events), batch_size)]
+    wal_start = get_wal_lsn(admin_conn)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed_store, batches))
+    elapsed = time.perf_counter() - start
+    wal_bytes = admin_conn.execute(
+        "SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s::pg_lsn)", (wal_start,)
+    ).fetchone()[0]
+    return {
+        "rows/s": len(events) / elapsed,
+        "p50 ms": statistics.median(latencies),
+        "p99 ms": (
+            statistics.quantiles(latencies, n=100)[-1]
+            if len(latencies) > 1
+            else latencies[0]
+        ),
+        "WAL B/row": float(wal_bytes) / len(events),
+    }
+
+
+def use_writer_user(connection_string: str, table_name: str) -> None:
+    """Point store_data at the table, connecting as its writer user"""
+    conninfo = conninfo_to_dict(connection_string)
+    writer_user_name = f"{table_name}_writer_user"
+    os.environ.update(
+        {
+            "POSTGRES_DB": str(conninfo.get("dbname", "postgres")),
+            "POSTGRES_HOST": str(conninfo.get("host", "localhost")),
+            "POSTGRES_PORT": str(conninfo.get("port", "5432")),
+            # create_table_and_roles.sql sets each user's password to its name
+            "POSTGRES_USER": writer_user_name,
+            "POSTGRES_PASSWORD": writer_user_name,
+            "TABLE_NAME": table_name,
+        }
+    )
+    reload_settings()
+
+
+def run(
+    connection_string: str,
+    table_name: str,
+    rows: int,
+    batch_sizes: List[int],
+    concurrencies: List[int],
+    mixes: List[Dict[str, float]],
+    keep: bool,
+) -> None:
+    with psycopg.connect(connection_string, autocommit=True) as admin_conn:
+        run_sql_script(admin_conn, "create_table_and_roles.sql", table_name)
+        use_writer_user(connection_string, table_name)
+        try:
+            columns = ["rows/s", "p50 ms", "p99 ms", "WAL B/row"]
+            print(f"{rows} rows per run into {table_name}")
+            print(
+                f"{'batch':>6}{'conc':>6}  {'mix':<44}"
+                + "".join(f"{c:>11}" for c in columns)
+            )
+            for mix_index, mix in enumerate(mixes):
+                events = make_events(rows, mix, seed=mix_index)
+                mix_name = ",".join(
+                    f"{name}={weight:g}" for name, weight in mix.items()
+                )
+                for batch_size in batch_sizes:
+                    for concurrency in concurrencies:
+                        # every run starts from an empty table, so they compare
+                        admin_conn.execute(f"TRUNCATE {table_name}")
+                        result = measure(admin_conn, events, batch_size, concurrency)
+                        print(
+                            f"{batch_size:>6}{concurrency:>6}  {mix_name:<44}"
+                            + "".join(f"{result[c]:>11.1f}" for c in columns)
+                        )
+        finally:
+            if not keep:
+                run_sql_script(admin_conn, "cleanup_table_and_roles.sql", table_name)
+
+
+def parse_int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",")]
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument(
+        "--connection-string",
+        default=os.environ.get(
+            "BENCH_POSTGRES_CONNECTION_STRING", POSTGRES_CONNECTION_STRING
+        ),
+        help="a user which can create extensions, tables and roles",
+    )
+    arg_parser.add_argument("--table", default="conditions_bench")
+    arg_parser.add_argument("--rows", type=int, default=2000)
+    arg_parser.add_argument(
+        "--batch-sizes", type=parse_int_list, default=[1, 10, 100, 500]
+    )
+    arg_parser.add_argument("--concurrency", type=parse_int_list, default=[1, 4])
+    arg_parser.add_argument(
+        "--mixes",
+        nargs="+",
+        type=lambda mix: parse_mix(mix, DATA_TYPES),
+        default=[
+            {"number": 1},
+            {"number": 0.7, "string": 0.1, "boolean": 0.1, "geography": 0.1},
+        ],
+        help="data_type=weight pairs, from number, string, boolean and geography",
+    )
+    arg_parser.add_argument("--keep", action="store_true")
+    args = arg_parser.parse_args()
+    run(
+        args.connection_string,
+        args.table,
+        args.rows,
+        args.batch_sizes,
+        args.concurrency,
+        args.mixes,
+        args.keep,
+    )
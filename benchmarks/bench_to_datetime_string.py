@@ -0,0 +1,51 @@
+"""Compare to_datetime_string against plain dateutil parsing
+
+Usage: python -m benchmarks.bench_to_datetime_string [--iterations N]
+"""
+
+import argparse
+import timeit
+
+from dateutil import parser
+
+from shared_code import helpers
+
+
+def dateutil_to_datetime_string(timestamp: str) -> str:
+    """The implementation before the fast path, used as the baseline"""
+    return parser.parse(timestamp).strftime(helpers.DATETIME_STRING_FORMAT)
+
+
+def run(iterations: int) -> None:
+    cases = {
+        "glow (repeated)": ["2023-01-01T12:34:56Z"] * 10,
+        "iso (unique)": [
+            f"2023-01-01T12:{m:02d}:{s:02d}.123+00:00"
+            for m in range(60)
+            for s in range(60)
+        ],
+        "homie (no tz)": ["2022-12-26T13:44:54.724"] * 10,
+        "rfc 2822 (fallback)": ["Sat, 26 Nov 2022 16:30:00 GMT"] * 10,
+    }
+    print(f"{'case':<22}{'dateutil us/op':>16}{'fast path us/op':>18}{'speedup':>10}")
+    for name, timestamps in cases.items():
+        operations = iterations * len(timestamps)
+        baseline = timeit.timeit(
+            lambda: [dateutil_to_datetime_string(t) for t in timestamps],
+            number=iterations,
+        )
+        helpers.convert_timestamp_to_string.cache_clear()
+        fast = timeit.timeit(
+            lambda: [helpers.to_datetime_string(t) for t in timestamps],
+            number=iterations,
+        )
+        print(
+            f"{name:<22}{baseline / operations * 1e6:>16.2f}"
+            f"{fast / operations * 1e6:>18.2f}{baseline / fast:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--iterations", type=int, default=20)
+    run(arg_parser.parse_args().iterations)
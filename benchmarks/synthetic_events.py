@@ -0,0 +1,142 @@
+"""Generate realistic EventHub batches for the benchmarks
+
+Each event is a copy of a real message from test_utils/test_data.json or
+test/cleaned_bmw_api_state_data.json, with its timestamps moved on and its readings varied a
+little, so converters see the same shapes and sizes as in production but no two events are equal.
+"""
+
+import datetime
+import json
+import os
+import random
+from typing import Any, Dict, List, Tuple
+
+from azure.functions import EventHubEvent
+
+from test_utils.get_test_data import create_event_hub_event, load_test_data
+
+BMW_STATE_PATH = os.sep.join(
+    [
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "test",
+        "cleaned_bmw_api_state_data.json",
+    ]
+)
+
+# test_data.json entries used as templates for each publisher
+TEMPLATES = {
+    "glow": ["glow_electricitymeter", "glow_gasmeter"],
+    "emon": ["emontx4_json"],
+    "homie": ["homie_mode", "homie_measure_temperature"],
+}
+PUBLISHERS = ["glow", "emon", "homie", "bmw"]
+DEFAULT_MIX = {"glow": 0.4, "emon": 0.3, "homie": 0.25, "bmw": 0.05}
+START_TIME = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def parse_mix(mix: str, names: List[str] = PUBLISHERS) -> Dict[str, float]:
+    """Parse a mix such as "glow=0.4,emon=0.3,homie=0.3"
+    @param mix: comma-separated name=weight pairs
+    @param names: the names allowed in the mix, publishers by default
+    @return: the weights, keyed by name
+    @raises ValueError: if a name is not allowed or no weight is positive
+    """
+    weights = {}
+    for pair in mix.split(","):
+        name, _, weight = pair.partition("=")
+        name = name.strip()
+        if name not in names:
+            raise ValueError(f"Unknown name in mix: {name}")
+        weights[name] = float(weight or 1)
+    if sum(weights.values()) <= 0:
+        raise ValueError(f"Nothing has a positive weight in mix: {mix}")
+    return weights
+
+
+def vary(value: Any, rng: random.Random) -> Any:
+    """Move every float reading in a nested payload by up to 1%, leaving ints and strings alone"""
+    if isinstance(value, dict):
+        return {key: vary(item, rng) for key, item in value.items()}
+    if isinstance(value, list):
+        return [vary(item, rng) for item in value]
+    if isinstance(value, float):
+        return round(value * rng.uniform(0.99, 1.01), 3)
+    return value
+
+
+class SyntheticEventGenerator:
+    def __init__(
+        self, mix: Dict[str, float] = DEFAULT_MIX, seed: int = 0, vins: int = 2
+    ):
+        """
+        @param mix: the relative weight of each publisher in a batch
+        @param seed: the seed for the readings and the order of publishers
+        @param vins: how many vehicles the BMW events are spread across
+        """
+        self.publishers = [publisher for publisher in mix if mix[publisher] > 0]
+        self.weights = [mix[publisher] for publisher in self.publishers]
+        self.rng = random.Random(seed)
+        self.vins = [f"WBA0000000000{i:04d}" for i in range(vins)]
+        self.sequence_number = 0
+        test_data = load_test_data()
+        self.templates: Dict[str, List[Dict[str, Any]]] = {
+            # load_test_data parses the bodies, leaving each payload as a JSON string
+            publisher: [test_data[name]["properties"]["body"] for name in names]
+            for publisher, names in TEMPLATES.items()
+        }
+        with open(BMW_STATE_PATH, "r") as f:
+            self.bmw_state = json.load(f)
+
+    def next_body(self, publisher: str, now: datetime.datetime) -> Dict[str, Any]:
+        if publisher == "bmw":
+            return self.bmw_body(now)
+        body = dict(self.rng.choice(self.templates[publisher]))
+        body["timestamp"] = now.timestamp()
+        if publisher == "homie":
+            if body["topic"].endswith("measure-temperature"):
+                body["payload"] = f"{self.rng.uniform(17, 23):.1f}"
+            return body
+        payload = vary(json.loads(body["payload"]), self.rng)
+        if publisher == "emon":
+            payload["time"] = now.timestamp()
+            payload["MSG"] = self.sequence_number
+        else:
+            for reading in payload.values():
+                reading["timestamp"] = now.strftime("%Y-%m-%dT%H:%M:%SZ")
+        body["payload"] = json.dumps(payload)
+        return body
+
+    def bmw_body(self, now: datetime.datetime) -> Dict[str, Any]:
+        state = vary(self.bmw_state["state"], self.rng)
+        state["lastUpdatedAt"] = now.strftime("%Y-%m-%dT%H:%M:%SZ")
+        state["currentMileage"] = self.bmw_state["state"]["currentMileage"] + (
+            self.sequence_number // 10
+        )
+        charging_state = state["electricChargingState"]
+        charging_state["chargingLevelPercent"] = self.rng.randint(20, 100)
+        return {
+            "vin": self.rng.choice(self.vins),
+            "capabilities": self.bmw_state["capabilities"],
+            "state": state,
+        }
+
+    def next_event(self) -> Tuple[str, EventHubEvent]:
+        """@return: the publisher and the event"""
+        publisher = self.rng.choices(self.publishers, self.weights)[0]
+        # a reading every second, so BMW lastUpdatedAt values are unique
+        now = START_TIME + datetime.timedelta(seconds=self.sequence_number)
+        event = create_event_hub_event(
+            {
+                "body": json.dumps(self.next_body(publisher, now)),
+                "enqueued_time": now.isoformat(),
+                "offset": str(self.sequence_number * 512),
+                "sequence_number": self.sequence_number,
+            }
+        )
+        self.sequence_number += 1
+        return publisher, event
+
+    def make_batch(self, size: int) -> List[Tuple[str, EventHubEvent]]:
+        """@return: size events, each with its publisher"""
+        return [self.next_event() for _ in range(size)]
@@ -7,12 +7,18 @@ import azure.functions as func
 # Add the project root directory to the Python path
 # sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from shared_code.bmw_to_timescale import convert_bmw_to_timescale
+from shared_code.profiling import profiled
+from shared_code.warm_up import start_warm_up
 
+start_warm_up("bmw_to_timescale")
 
+
+@profiled("bmw_to_timescale")
 def main(
-    event: func.EventHubEvent,
+    events: List[func.EventHubEvent],
     outputEventHubMessage: func.Out[List[str]],
     outputEHMonitor: func.Out[List[str]],
+    context: func.Context,
 ) -> None:
     logging.info("Processing events...")
-    convert_bmw_to_timescale(event, outputEventHubMessage, outputEHMonitor)
+    convert_bmw_to_timescale(events, outputEventHubMessage, outputEHMonitor)
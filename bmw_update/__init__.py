@@ -1,7 +1,15 @@
+from typing import List
+
 import azure.functions as func
-from shared_code.bmw import get_and_serialise_car_data
+
+from shared_code.bmw import publish_car_data
+from shared_code.profiling import profiled
 
 
-def main(mytimer: func.TimerRequest):
-    data: list = get_and_serialise_car_data()
-    return data
+@profiled("bmw_update")
+def main(
+    mytimer: func.TimerRequest,
+    outputEventHubMessage: func.Out[List[str]],
+    context: func.Context,
+) -> None:
+    publish_car_data(outputEventHubMessage)
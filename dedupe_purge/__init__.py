@@ -0,0 +1,6 @@
+import azure.functions as func
+from shared_code.dedupe_backend import purge_dedupe_store
+
+
+def main(mytimer: func.TimerRequest) -> None:
+    purge_dedupe_store()
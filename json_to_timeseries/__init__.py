@@ -4,10 +4,17 @@ from typing import List
 import azure.functions as func
 
 from shared_code.json_converter import convert_json_to_timeseries
+from shared_code.profiling import profiled
+from shared_code.warm_up import start_warm_up
 
+start_warm_up("json_to_timeseries")
 
+
+@profiled("json_to_timeseries")
 def main(
-    events: List[func.EventHubEvent], outputEventHubMessage: func.Out[List[str]]
+    events: List[func.EventHubEvent],
+    outputEventHubMessage: func.Out[List[str]],
+    context: func.Context,
 ) -> None:
     logging.info("Processing events...")
     convert_json_to_timeseries(events, outputEventHubMessage)
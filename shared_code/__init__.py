@@ -1,28 +1,102 @@
 """Shared methods for converting data to timeseries records
 
+The names below are imported from their submodules on first use, so each function only pays at
+cold start for the submodules, and the libraries behind them, that it uses. For example
+json_to_timeseries does not import psycopg, jsonschema or azure.data.tables.
 """
 
-from .timeseries import PayloadType  # noqa F401
-from .timeseries import create_record_recursive  # noqa F401
-from .timeseries import create_atomic_record  # noqa F401
-from .timeseries import get_record_type  # noqa F401
-from .glow import glow_to_timescale  # noqa F401
-from .homie import homie_to_timescale  # noqa F401
-from .emon import emon_to_timescale  # noqa F401
-from .helpers import is_topic_of_interest  # noqa F401
-from .helpers import to_datetime_string  # noqa F401
-from .helpers import create_correlation_id  # noqa F401
-from .helpers import recursively_deserialize  # noqa F401
-from .timescale import create_single_timescale_record  # noqa F401
-from .timescale import parse_measurement_value  # noqa F401
-from .timescale import identify_data_column  # noqa F401
-
-# from .timescale import create_timescale_records_from_batch_of_events  # noqa F401
-from .timescale import validate_all_fields_in_record  # noqa F401
-from .timescale import get_connection_string  # noqa F401
-from .timescale import get_table_name  # noqa F401
-from .timescale import parse_to_geopoint  # noqa F401
-from .bmw_to_timescale import convert_bmw_to_timescale  # noqa F401
-from .duplicate_check import check_duplicate  # noqa F401
-from .duplicate_check import get_table_service_client  # noqa F401
-from .duplicate_check import store_id  # noqa F401
+import importlib
+from typing import TYPE_CHECKING, Any, List
+
+from .settings import load_environment
+
+# every function imports shared_code before reading any setting, so .env (or .env.vault) is
+# loaded here, once per worker, whichever submodules it goes on to use
+load_environment()
+
+# the submodule each name is imported from
+LAZY_ATTRIBUTES = {
+    "PayloadType": "timeseries",
+    "create_record_recursive": "timeseries",
+    "create_record_from_plan": "timeseries",
+    "create_atomic_record": "timeseries",
+    "get_record_type": "timeseries",
+    "glow_to_timescale": "glow",
+    "homie_to_timescale": "homie",
+    "emon_to_timescale": "emon",
+    "is_topic_of_interest": "helpers",
+    "to_datetime_string": "helpers",
+    "create_correlation_id": "helpers",
+    "recursively_deserialize": "helpers",
+    "deserialize_nested_json": "helpers",
+    "create_single_timescale_record": "timescale",
+    "parse_measurement_value": "timescale",
+    "identify_data_column": "timescale",
+    # "create_timescale_records_from_batch_of_events": "timescale",
+    "validate_all_fields_in_record": "timescale",
+    "get_connection_string": "timescale",
+    "get_table_name": "timescale",
+    "parse_to_geopoint": "timescale",
+    "convert_bmw_to_timescale": "bmw_to_timescale",
+    "check_duplicate": "duplicate_check",
+    "get_table_service_client": "duplicate_check",
+    "store_id": "duplicate_check",
+    "claim_id": "duplicate_check",
+    "confirm_id": "duplicate_check",
+    "release_claim": "duplicate_check",
+    "claim_ids": "duplicate_check",
+    "confirm_ids": "duplicate_check",
+    "release_claims": "duplicate_check",
+    "DedupeBackend": "dedupe_backend",
+    "get_dedupe_backend": "dedupe_backend",
+}
+
+__all__ = list(LAZY_ATTRIBUTES)
+
+if TYPE_CHECKING:
+    from .timeseries import PayloadType  # noqa F401
+    from .timeseries import create_record_recursive  # noqa F401
+    from .timeseries import create_record_from_plan  # noqa F401
+    from .timeseries import create_atomic_record  # noqa F401
+    from .timeseries import get_record_type  # noqa F401
+    from .glow import glow_to_timescale  # noqa F401
+    from .homie import homie_to_timescale  # noqa F401
+    from .emon import emon_to_timescale  # noqa F401
+    from .helpers import is_topic_of_interest  # noqa F401
+    from .helpers import to_datetime_string  # noqa F401
+    from .helpers import create_correlation_id  # noqa F401
+    from .helpers import recursively_deserialize  # noqa F401
+    from .helpers import deserialize_nested_json  # noqa F401
+    from .timescale import create_single_timescale_record  # noqa F401
+    from .timescale import parse_measurement_value  # noqa F401
+    from .timescale import identify_data_column  # noqa F401
+    from .timescale import validate_all_fields_in_record  # noqa F401
+    from .timescale import get_connection_string  # noqa F401
+    from .timescale import get_table_name  # noqa F401
+    from .timescale import parse_to_geopoint  # noqa F401
+    from .bmw_to_timescale import convert_bmw_to_timescale  # noqa F401
+    from .duplicate_check import check_duplicate  # noqa F401
+    from .duplicate_check import get_table_service_client  # noqa F401
+    from .duplicate_check import store_id  # noqa F401
+    from .duplicate_check import claim_id  # noqa F401
+    from .duplicate_check import confirm_id  # noqa F401
+    from .duplicate_check import release_claim  # noqa F401
+    from .duplicate_check import claim_ids  # noqa F401
+    from .duplicate_check import confirm_ids  # noqa F401
+    from .duplicate_check import release_claims  # noqa F401
+    from .dedupe_backend import DedupeBackend  # noqa F401
+    from .dedupe_backend import get_dedupe_backend  # noqa F401
+
+
+def __getattr__(name: str) -> Any:
+    if name not in LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(f".{LAZY_ATTRIBUTES[name]}", __name__)
+    value = getattr(module, name)
+    # later lookups find the name without coming back here
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(LAZY_ATTRIBUTES))
@@ -1,39 +1,145 @@
-from typing import List
+from typing import Any, Dict, List, Optional
+from azure.functions import Out
 from bimmer_connected.account import MyBMWAccount
+from bimmer_connected.models import MyBMWAuthError, MyBMWQuotaError
 from bimmer_connected.vehicle import MyBMWVehicle
 from bimmer_connected.api.regions import Regions
 from bimmer_connected.utils import MyBMWJSONEncoder
 import asyncio
 import json
+import logging
+import time
 
 
 # from azure.eventhub import EventHubProducerClient, EventData
 # import json
 import os
 
-from dotenv_vault import load_dotenv
 
-load_dotenv()
+from .bmw_poll_schedule import get_due_vins, record_poll
+from .bmw_to_timescale import MESSAGE_FIELD_PATHS
+from .bmw_token_store import (
+    BMWTokenStore,
+    get_bmw_token_store,
+    persist_tokens,
+    restore_tokens,
+)
+
+# lastUpdatedAt of the last document published for each VIN, kept for the life of the worker.
+# After a restart a vehicle is published once more; bmw_to_timescale discards the duplicate.
+last_published_updated_at: Dict[str, Any] = {}
+
+
+class VehicleFetchResult:
+    """The vehicles whose state was fetched, and why the others were not"""
+
+    def __init__(self):
+        self.vehicles: List[MyBMWVehicle] = []
+        self.errors: Dict[str, str] = {}
+
+
+async def fetch_vehicles_by_vin(
+    account: MyBMWAccount,
+    vins: List[str],
+    max_concurrency: int = 4,
+    call_timeout: float = 30.0,
+    overall_timeout: float = 90.0,
+) -> VehicleFetchResult:
+    """
+    Fetches the state of the vehicles matching the VINs concurrently, so one slow vehicle does not hold up the others.
+
+    Parameters:
+        account (MyBMWAccount): The ConnectedDrive account containing the vehicles.
+        vins (List[str]): The Vehicle Identification Numbers (VINs) to fetch.
+        max_concurrency (int): How many vehicle states to fetch at once.
+        call_timeout (float): Seconds allowed for the vehicle list and for each vehicle state.
+        overall_timeout (float): Seconds allowed for the whole fetch. Vehicles still outstanding are abandoned.
+
+    Returns:
+        VehicleFetchResult: The vehicles fetched, in account order, and an error message for each VIN which was not.
+
+    Raises:
+        MyBMWAuthError, MyBMWQuotaError: As from MyBMWAccount.get_vehicles(), these apply to every vehicle.
+        asyncio.TimeoutError: If the vehicle list could not be fetched in time.
+    """  # noqa: E501
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + overall_timeout
+    result = VehicleFetchResult()
+    if not account.vehicles:
+        # only the vehicle list; get_vehicles() would also fetch every state one after another.
+        # _init_vehicles is private, so bimmer-connected is pinned exactly in pyproject.toml, and
+        # test_bmw checks it is still there before the pin is moved
+        await asyncio.wait_for(
+            account._init_vehicles(), min(call_timeout, overall_timeout)
+        )
+    vehicles = [vehicle for vehicle in account.vehicles if vehicle.vin in vins]
+    found_vins = {vehicle.vin for vehicle in vehicles}
+    for vin in vins:
+        if vin not in found_vins:
+            result.errors[vin] = "Not found on account"
+    if not vehicles:
+        return result
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch_state(vehicle: MyBMWVehicle) -> None:
+        async with semaphore:
+            await asyncio.wait_for(vehicle.get_vehicle_state(), call_timeout)
+
+    tasks = [asyncio.ensure_future(fetch_state(vehicle)) for vehicle in vehicles]
+    _, pending = await asyncio.wait(tasks, timeout=max(deadline - loop.time(), 0))
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    for vehicle, task in zip(vehicles, tasks):
+        if task in pending:
+            result.errors[vehicle.vin] = f"Not fetched within {overall_timeout}s"
+            continue
+        error = task.exception()
+        if isinstance(error, (MyBMWAuthError, MyBMWQuotaError)):
+            raise error
+        if isinstance(error, asyncio.TimeoutError):
+            result.errors[vehicle.vin] = f"Timed out after {call_timeout}s"
+        elif error is not None:
+            result.errors[vehicle.vin] = f"{type(error).__name__}: {error}"
+        else:
+            result.vehicles.append(vehicle)
+    return result
 
 
 def get_vehicle_by_vin(
     account: MyBMWAccount, vin: List[str]
 ) -> List[MyBMWVehicle] | None:
     """
-    Fetches vehicles from a ConnectedDrive account based on a list of VINs.
+    Fetches vehicles from a ConnectedDrive account based on a list of VINs. Vehicles which could not be fetched are logged and left out.
 
     Parameters:
         account (ConnectedDriveAccount): The ConnectedDrive account containing the vehicles.
         vin (List[str]): A list of Vehicle Identification Numbers (VINs) to search for.
 
+    Environment variables used:
+        BMW_FETCH_CONCURRENCY: How many vehicle states to fetch at once (default 4).
+        BMW_FETCH_CALL_TIMEOUT_SECONDS: Seconds allowed for each call to the API (default 30).
+        BMW_FETCH_TIMEOUT_SECONDS: Seconds allowed for the whole fetch (default 90).
+
     Returns:
         Union[List[MyBMWVehicle], None]: A list of MyBMWVehicle objects whose VINs match any of the VINs in the provided list.
                                         Returns None if no matches are found.
 
     """  # noqa: E501
-    asyncio.run(account.get_vehicles())
-    matching_vehicles = [vehicle for vehicle in account.vehicles if vehicle.vin in vin]
-    return matching_vehicles if matching_vehicles else None
+    result = asyncio.run(
+        fetch_vehicles_by_vin(
+            account,
+            vin,
+            max_concurrency=int(os.environ.get("BMW_FETCH_CONCURRENCY") or 4),
+            call_timeout=float(os.environ.get("BMW_FETCH_CALL_TIMEOUT_SECONDS") or 30),
+            overall_timeout=float(os.environ.get("BMW_FETCH_TIMEOUT_SECONDS") or 90),
+        )
+    )
+    for failed_vin, error in result.errors.items():
+        logging.warning(f"bmw: Could not fetch vehicle {failed_vin}: {error}")
+    return result.vehicles if result.vehicles else None
 
 
 def get_bmw_region_from_string(region: str) -> Regions:
@@ -50,10 +156,13 @@ def get_bmw_region_from_string(region: str) -> Regions:
     return Regions[region.upper()]
 
 
-def get_bmw_account() -> MyBMWAccount:
+def get_bmw_account(token_store: BMWTokenStore | None = None) -> MyBMWAccount:
     """
     Creates and returns a MyBMWAccount object using environment variables.
 
+    Parameters:
+        token_store (BMWTokenStore | None): If given, tokens saved by a previous run are loaded into the account.
+
     Environment variables used:
         BMW_USERNAME: The username for the ConnectedDrive account.
         BMW_PASSWORD: The password for the ConnectedDrive account.
@@ -65,24 +174,37 @@ def get_bmw_account() -> MyBMWAccount:
     username = os.environ["BMW_USERNAME"]
     password = os.environ["BMW_PASSWORD"]
     region = get_bmw_region_from_string(os.environ["BMW_REGION"])
-    return MyBMWAccount(username, password, region)
+    account = MyBMWAccount(username, password, region)
+    if token_store is not None:
+        restore_tokens(account, token_store)
+    return account
 
 
-def get_my_cars():
+def get_my_cars(vins: Optional[List[str]] = None):
     """Retrieves a list of MyBMWVehicle objects associated with specific VINs from a ConnectedDrive account.
 
+    Parameters:
+        vins (Optional[List[str]]): The VINs to fetch. Defaults to those in BMW_VINS.
+
     Environment variables used:
         BMW_VINS: Comma-separated list of Vehicle Identification Numbers (VINs) to search for.
+        BMW_TOKEN_STORE: Where to persist the OAuth tokens between runs, see get_bmw_token_store().
 
     Returns:
-        List[MyBMWVehicle]: A list of MyBMWVehicle objects whose VINs match those specified in the BMW_VINS environment variable.
+        List[MyBMWVehicle]: A list of MyBMWVehicle objects whose VINs match those given, or in the BMW_VINS environment variable.
 
     Raises:
-        Exception: If no cars are found matching the VINs specified in the BMW_VINS environment variable.
+        Exception: If no cars are found matching the VINs.
     """  # noqa: E501
-    account = get_bmw_account()
-    my_vins = os.environ["BMW_VINS"].split(",")
-    my_cars = get_vehicle_by_vin(account, my_vins)
+    token_store = get_bmw_token_store()
+    account = get_bmw_account(token_store)
+    my_vins = vins or os.environ["BMW_VINS"].split(",")
+    try:
+        my_cars = get_vehicle_by_vin(account, my_vins)
+    finally:
+        # save whatever tokens we hold, even if the fetch failed after logging in
+        if token_store is not None:
+            persist_tokens(account, token_store)
     if my_cars is None:
         raise Exception("No cars found")
     return my_cars
@@ -92,20 +214,154 @@ def serialise_car_data(cars: List[MyBMWVehicle]) -> List[str]:
     return [json.dumps(car.data, cls=MyBMWJSONEncoder) for car in cars]
 
 
-def get_and_serialise_car_data():
-    """Retrieves a list of MyBMWVehicle objects associated with specific VINs from a ConnectedDrive account, and serialises the data.
+def project_car_data(data: Dict[str, Any], include_raw: bool = False) -> Dict[str, Any]:
+    """
+    Reduces a vehicle document to the fields bmw_to_timescale reads (MESSAGE_FIELD_PATHS).
+
+    Parameters:
+        data (Dict[str, Any]): The vehicle data, as in MyBMWVehicle.data.
+        include_raw (bool): If True, the full document is also included under "raw", for archiving.
+
+    Returns:
+        Dict[str, Any]: The projected document. Fields missing from data are left out.
+    """  # noqa: E501
+    projected: Dict[str, Any] = {}
+    for path in MESSAGE_FIELD_PATHS:
+        value = data
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = projected
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+    if include_raw:
+        projected["raw"] = data
+    return projected
+
+
+def serialise_projected_car_data(
+    cars: List[MyBMWVehicle], include_raw: bool = False
+) -> List[str]:
+    return [
+        json.dumps(project_car_data(car.data, include_raw), cls=MyBMWJSONEncoder)
+        for car in cars
+    ]
+
+
+def filter_unchanged_cars(cars: List[MyBMWVehicle]) -> List[MyBMWVehicle]:
+    """
+    Drops vehicles whose lastUpdatedAt is the same as when they were last published, see record_published().
+
+    Parameters:
+        cars (List[MyBMWVehicle]): The vehicles fetched on this run.
+
+    Returns:
+        List[MyBMWVehicle]: The vehicles with new data. Vehicles without a lastUpdatedAt are always kept.
+    """  # noqa: E501
+    changed_cars = []
+    for car in cars:
+        last_updated_at = car.data.get("state", {}).get("lastUpdatedAt")
+        if (
+            last_updated_at is not None
+            and last_published_updated_at.get(car.vin) == last_updated_at
+        ):
+            logging.info(f"bmw: Skipping unchanged vehicle {car.vin}")
+            continue
+        changed_cars.append(car)
+    return changed_cars
+
+
+def record_published(cars: List[MyBMWVehicle]) -> None:
+    """
+    Remembers the lastUpdatedAt of each vehicle, so filter_unchanged_cars() skips it until it changes.
+    Only call this once the vehicles have been handed to the output binding.
+
+    Parameters:
+        cars (List[MyBMWVehicle]): The vehicles published on this run.
+    """  # noqa: E501
+    for car in cars:
+        last_updated_at = car.data.get("state", {}).get("lastUpdatedAt")
+        if last_updated_at is not None:
+            last_published_updated_at[car.vin] = last_updated_at
+
+
+def is_enabled(environment_variable: str) -> bool:
+    return os.environ.get(environment_variable, "").lower() in {"1", "true", "yes"}
+
+
+def get_publish_mode() -> str:
+    publish_mode = (os.environ.get("BMW_PUBLISH_MODE") or "full").lower()
+    if publish_mode not in {"full", "projected"}:
+        raise ValueError(f"Unknown BMW_PUBLISH_MODE: {publish_mode}")
+    return publish_mode
+
+
+def get_cars_to_publish() -> List[MyBMWVehicle]:
+    """Retrieves the vehicles due for polling from a ConnectedDrive account, leaving out those unchanged since they were last published.
+    Only the vehicles which are due are fetched, and only their polls are recorded.
 
     Environment variables used:
         BMW_VINS: Comma-separated list of Vehicle Identification Numbers (VINs) to search for.
         BMW_USERNAME: The username for the ConnectedDrive account.
         BMW_PASSWORD: The password for the ConnectedDrive account.
         BMW_REGION: The region for the ConnectedDrive account, converted to the correct enum using get_bmw_region_from_string().
+        BMW_SKIP_UNCHANGED: If true, vehicles whose lastUpdatedAt has not changed since they were last published are skipped.
+        BMW_POLL_INTERVAL_*, BMW_ADAPTIVE_POLLING: How often to poll each vehicle depending on its state, see bmw_poll_schedule.
 
     Returns:
-        List[str]: A list of JSON strings representing the data for each vehicle.
+        List[MyBMWVehicle]: The vehicles to publish. Empty if no vehicle was due for polling.
 
     Raises:
         Exception: If no cars are found matching the VINs specified in the BMW_VINS environment variable.
     """  # noqa: E501
-    cars = get_my_cars()
+    now = time.monotonic()
+    vins = [vin for vin in os.environ.get("BMW_VINS", "").split(",") if vin]
+    due_vins = get_due_vins(vins, now)
+    if vins and not due_vins:
+        logging.info("bmw: No vehicles due for polling")
+        return []
+    cars = get_my_cars(due_vins or None)
+    record_poll(cars, now)
+    if is_enabled("BMW_SKIP_UNCHANGED"):
+        cars = filter_unchanged_cars(cars)
+    return cars
+
+
+def serialise_cars_for_publishing(cars: List[MyBMWVehicle]) -> List[str]:
+    """Serialises the vehicles as set by BMW_PUBLISH_MODE.
+
+    Environment variables used:
+        BMW_PUBLISH_MODE: "full" (default) publishes the whole vehicle document, "projected" only the fields bmw_to_timescale reads.
+        BMW_RAW_ARCHIVE: If true, projected documents also carry the whole document under "raw".
+
+    Returns:
+        List[str]: A list of JSON strings representing the data for each vehicle.
+
+    Raises:
+        ValueError: If BMW_PUBLISH_MODE is not "full" or "projected".
+    """  # noqa: E501
+    if get_publish_mode() == "projected":
+        return serialise_projected_car_data(cars, is_enabled("BMW_RAW_ARCHIVE"))
     return serialise_car_data(cars)
+
+
+def publish_car_data(outputEventHubMessage: Out[List[str]]) -> None:
+    """Retrieves, serialises and publishes the vehicles, then records them as published.
+    If fetching, serialising or setting the output fails, nothing is recorded, so the next run publishes them again.
+
+    Parameters:
+        outputEventHubMessage (Out[List[str]]): The output binding to set.
+
+    Raises:
+        Exception: If no cars are found matching the VINs specified in the BMW_VINS environment variable.
+        ValueError: If BMW_PUBLISH_MODE is not "full" or "projected".
+    """  # noqa: E501
+    get_publish_mode()
+    cars = get_cars_to_publish()
+    messages = serialise_cars_for_publishing(cars)
+    if messages:
+        outputEventHubMessage.set(messages)
+    record_published(cars)
@@ -0,0 +1,143 @@
+"""Decide on each bmw_update tick whether the MyBMW API needs to be called
+
+bmw_update ticks every two minutes. A vehicle which is charging or driving is polled on every
+tick; a parked vehicle every ten minutes, and one which has not changed for hours every thirty.
+The API is only called when at least one vehicle is due, and only for the vehicles which are.
+With BMW_ADAPTIVE_POLLING=false every vehicle is polled at the parked interval, every ten
+minutes as before adaptive polling.
+
+The state is kept for the life of the worker. After a restart every vehicle is due.
+"""
+
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from bimmer_connected.vehicle import MyBMWVehicle
+
+CHARGING = "charging"
+DRIVING = "driving"
+PARKED = "parked"
+
+# timer ticks are not exactly on time, so a vehicle is due slightly before its interval is up
+POLL_SLACK_SECONDS = 30
+
+
+class VehiclePollState:
+    """What was seen the last time a vehicle was polled"""
+
+    def __init__(
+        self,
+        activity: str,
+        fingerprint: Tuple[Any, ...],
+        last_polled: float,
+        last_changed: float,
+    ):
+        self.activity = activity
+        self.fingerprint = fingerprint
+        self.last_polled = last_polled
+        self.last_changed = last_changed
+
+
+vehicle_poll_states: Dict[str, VehiclePollState] = {}
+
+
+def get_fingerprint(data: Dict[str, Any]) -> Tuple[Any, ...]:
+    """The fields whose change means the vehicle is doing something
+    @param data: the vehicle data, as in MyBMWVehicle.data
+    @return: lastUpdatedAt, currentMileage, chargingLevelPercent and chargingStatus
+    """
+    state = data.get("state") or {}
+    charging_state = state.get("electricChargingState") or {}
+    return (
+        state.get("lastUpdatedAt"),
+        state.get("currentMileage"),
+        charging_state.get("chargingLevelPercent"),
+        charging_state.get("chargingStatus"),
+    )
+
+
+def get_activity(data: Dict[str, Any], previous: Optional[VehiclePollState]) -> str:
+    """Classify what a vehicle is doing
+    @param data: the vehicle data, as in MyBMWVehicle.data
+    @param previous: the state from the previous poll, if any
+    @return: CHARGING, DRIVING if the mileage has changed since the previous poll, otherwise PARKED
+    """
+    state = data.get("state") or {}
+    charging_state = state.get("electricChargingState") or {}
+    if charging_state.get("chargingStatus") == "CHARGING":
+        return CHARGING
+    mileage = state.get("currentMileage")
+    if (
+        previous is not None
+        and mileage is not None
+        and mileage != previous.fingerprint[1]
+    ):
+        return DRIVING
+    return PARKED
+
+
+def is_adaptive_polling_enabled() -> bool:
+    adaptive_polling = os.environ.get("BMW_ADAPTIVE_POLLING", "").lower()
+    return adaptive_polling not in {"0", "false", "no"}
+
+
+def get_poll_interval(poll_state: VehiclePollState, now: float) -> float:
+    """How long to wait between polls of a vehicle
+
+    Environment variables used:
+        BMW_POLL_INTERVAL_ACTIVE: Seconds between polls while charging or driving (default 120).
+        BMW_POLL_INTERVAL_PARKED: Seconds between polls while parked (default 600).
+        BMW_POLL_INTERVAL_IDLE: Seconds between polls once parked and unchanged for BMW_POLL_IDLE_AFTER (default 1800).
+        BMW_POLL_IDLE_AFTER: Seconds without a change before a parked vehicle counts as idle (default 21600).
+        BMW_ADAPTIVE_POLLING: If false, every vehicle is polled at BMW_POLL_INTERVAL_PARKED whatever it is doing (default true).
+
+    @param poll_state: the state from the last poll
+    @param now: the current time.monotonic()
+    @return: the interval in seconds
+    """  # noqa: E501
+    if not is_adaptive_polling_enabled():
+        return float(os.environ.get("BMW_POLL_INTERVAL_PARKED") or 600)
+    if poll_state.activity in (CHARGING, DRIVING):
+        return float(os.environ.get("BMW_POLL_INTERVAL_ACTIVE") or 120)
+    idle_after = float(os.environ.get("BMW_POLL_IDLE_AFTER") or 21600)
+    if now - poll_state.last_changed >= idle_after:
+        return float(os.environ.get("BMW_POLL_INTERVAL_IDLE") or 1800)
+    return float(os.environ.get("BMW_POLL_INTERVAL_PARKED") or 600)
+
+
+def get_due_vins(vins: List[str], now: Optional[float] = None) -> List[str]:
+    """Find the vehicles which should be polled on this tick
+    @param vins: the VINs to consider
+    @param now: the current time.monotonic(), if already known
+    @return: the VINs which are due, including any never polled
+    """
+    now = time.monotonic() if now is None else now
+    due = []
+    for vin in vins:
+        poll_state = vehicle_poll_states.get(vin)
+        if (
+            poll_state is None
+            or now - poll_state.last_polled + POLL_SLACK_SECONDS
+            >= get_poll_interval(poll_state, now)
+        ):
+            due.append(vin)
+    return due
+
+
+def record_poll(cars: List[MyBMWVehicle], now: Optional[float] = None) -> None:
+    """Remember what was seen for each vehicle fetched on this tick
+    @param cars: the vehicles fetched
+    @param now: the time.monotonic() at which they were fetched
+    """
+    now = time.monotonic() if now is None else now
+    for car in cars:
+        previous = vehicle_poll_states.get(car.vin)
+        fingerprint = get_fingerprint(car.data)
+        changed = previous is None or fingerprint != previous.fingerprint
+        vehicle_poll_states[car.vin] = VehiclePollState(
+            activity=get_activity(car.data, previous),
+            fingerprint=fingerprint,
+            last_polled=now,
+            last_changed=now if changed else previous.last_changed,
+        )
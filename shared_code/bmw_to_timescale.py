@@ -3,10 +3,17 @@ import json
 import logging
 from azure.functions import EventHubEvent, Out
 import shared_code as sc
+from .ingest_lag import LagTracker, get_partition_id, stamp_records
+from .instrumentation import count, instrumented_invocation, timed
+from .structured_log import log_event, log_sampled, truncate
+
+# what a malformed event or update raises: bad JSON or encoding, a missing field, a wrong type
+# or an out of range value. Anything else still fails the whole batch
+MALFORMED_EVENT_ERRORS = (ValueError, KeyError, TypeError)
 
 
 def convert_bmw_to_timescale(
-    event: EventHubEvent,
+    events: List[EventHubEvent] | EventHubEvent,
     outputEventHubMessage: Out[str],
     outputEventHubMessage_monitor: Out[str],
 ) -> None:
@@ -19,35 +26,157 @@ def convert_bmw_to_timescale(
     # state.currentmileage
     # state.electricChargingState[chargingLevelPercent, range, isChargerConnected, chargingStatus]
     logging.info("Processing BMW messages")
-    tsc = sc.get_table_service_client()
-    # for event in events:
-    logging.info(f"Processing event: {event}")
-    event_object = get_event_body(event)
-    vin = get_vin_from_message(event_object)
-    last_updated_at = get_last_updated_at_from_message(event_object)
-    if sc.check_duplicate(last_updated_at, vin, tsc):
-        # we've already processed this message, so we can skip it
-        logging.info(f"Skipping duplicate message: {event_object}")
+    if not isinstance(events, list):
+        events = [events]
+    with instrumented_invocation("bmw_to_timescale"):
+        send_bmw_updates(events, outputEventHubMessage, outputEventHubMessage_monitor)
+
+
+def send_bmw_updates(
+    events: List[EventHubEvent],
+    outputEventHubMessage: Out[str],
+    outputEventHubMessage_monitor: Out[str],
+) -> None:
+    dedupe_backend = sc.get_dedupe_backend()
+    source_events: Dict[Tuple[str, str], EventHubEvent] = {}
+    updates_by_vin = group_updates_by_vin(events, source_events)
+
+    # claim every update in the batch, one call per vin
+    claimed_by_vin: Dict[str, List[str]] = {}
+    # we've already processed (or are processing) these messages, so we can skip them
+    duplicates_by_vin: Dict[str, List[str]] = {}
+    try:
+        for vin, updates in updates_by_vin.items():
+            with timed("dedupe_claim", "bmw"):
+                claimed = dedupe_backend.claim_ids(list(updates), vin)
+            if claimed:
+                claimed_by_vin[vin] = claimed
+            count("duplicates", "bmw", len(updates) - len(claimed))
+            if duplicates := sorted(updates.keys() - set(claimed)):
+                duplicates_by_vin[vin] = duplicates
+    except Exception:
+        # don't leave the vins claimed so far pending, or their updates are skipped as duplicates until it expires
+        for vin, claimed in claimed_by_vin.items():
+            dedupe_backend.release_claims(claimed, vin)
+        raise
+    if duplicates_by_vin:
+        log_event(
+            logging.INFO, "bmw_to_timescale.duplicates", skipped=duplicates_by_vin
+        )
+    if not claimed_by_vin:
         return
-    messages_to_send = construct_messages(vin, last_updated_at, event_object)
-    message_list = [json.dumps(message) for message in messages_to_send]
+
+    message_list = []
+    lag_tracker = LagTracker("converter_output")
     try:
-        outputEventHubMessage.set(message_list)
-        outputEventHubMessage_monitor.set(message_list)
-        sc.store_id(last_updated_at, vin, tsc)
+        for vin in list(claimed_by_vin):
+            converted = []
+            for last_updated_at in claimed_by_vin[vin]:
+                event = source_events[(vin, last_updated_at)]
+                try:
+                    with timed("convert", "bmw"):
+                        messages_to_send = construct_messages(
+                            vin, last_updated_at, updates_by_vin[vin][last_updated_at]
+                        )
+                    stamped = messages_to_send and stamp_records(
+                        messages_to_send, event
+                    )
+                    with timed("serialise", "bmw"):
+                        serialised = [
+                            json.dumps(message) for message in messages_to_send
+                        ]
+                except MALFORMED_EVENT_ERRORS as e:
+                    # skip this update, rather than lose the rest of the batch with it
+                    count("conversion_errors", "bmw")
+                    logging.error(
+                        f"bmw_to_timescale: Skipping update {last_updated_at} of {vin}: {type(e).__name__}: {e}"
+                    )
+                    dedupe_backend.release_claims([last_updated_at], vin)
+                    continue
+                if stamped:
+                    lag_tracker.add(event.enqueued_time, "bmw", get_partition_id(event))
+                message_list.extend(serialised)
+                converted.append(last_updated_at)
+            if converted:
+                claimed_by_vin[vin] = converted
+            else:
+                del claimed_by_vin[vin]
+        if not claimed_by_vin:
+            return
+        with timed("output_set", "bmw"):
+            outputEventHubMessage.set(message_list)
+            outputEventHubMessage_monitor.set(message_list)
+        lag_tracker.complete()
+        lag_tracker.log()
+        count("records", "bmw", len(message_list))
+        for vin, claimed in claimed_by_vin.items():
+            with timed("dedupe_confirm", "bmw"):
+                dedupe_backend.confirm_ids(claimed, vin)
     except Exception as e:
-        logging.error(f"Error sending messages: {message_list} : {e}")
+        logging.error(
+            f"Error sending {len(message_list)} messages: {truncate(str(message_list))} : {e}"
+        )
+        for vin, claimed in claimed_by_vin.items():
+            dedupe_backend.release_claims(claimed, vin)
         raise
-    # for message in messages_to_send:
-    #     str_message = json.dumps(message)
-    #     logging.info(f"Sending message: {str_message}")
-    #     try:
-    #         outputEventHubMessage.set(str_message)
-    #         outputEventHubMessage_monitor.set(str_message)
-    #     except Exception as e:
-    #         logging.error(f"Error sending message: {str_message} : {e}")
-    #         raise
-    # sc.store_id(last_updated_at, vin, tsc)
+
+
+def group_updates_by_vin(
+    events: List[EventHubEvent],
+    source_events: Optional[Dict[Tuple[str, str], EventHubEvent]] = None,
+) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """
+    Parse a batch of events and group them by VIN, dropping repeats of an update within the batch.
+
+    Parameters:
+    - events (List[EventHubEvent]): The events, each carrying one BMW vehicle document.
+    - source_events (Optional[Dict[Tuple[str, str], EventHubEvent]]): If given, filled with the event each
+      kept document came from, keyed on (vin, lastUpdatedAt), for its enqueue time and partition.
+
+    Returns:
+    - Dict[str, Dict[str, Dict[str, Any]]]: For each VIN, the parsed documents keyed on lastUpdatedAt,
+      in the order they arrived. Where an update appears more than once, the first is kept.
+      Events which are not valid JSON, or have no vin or state.lastUpdatedAt, are logged and left out.
+    """  # noqa: E501
+    updates_by_vin: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    repeated = 0
+    malformed = 0
+    for event in events:
+        try:
+            with timed("decode", "bmw"):
+                event_object = get_event_body(event)
+            vin = get_vin_from_message(event_object)
+            last_updated_at = get_last_updated_at_from_message(event_object)
+        except MALFORMED_EVENT_ERRORS as e:
+            malformed += 1
+            count("malformed_events", "bmw")
+            logging.error(
+                f"bmw_to_timescale: Skipping malformed event: {type(e).__name__}: {e}"
+            )
+            continue
+        count("events", "bmw")
+        updates = updates_by_vin.setdefault(vin, {})
+        if last_updated_at in updates:
+            repeated += 1
+            log_sampled(
+                logging.DEBUG,
+                "bmw_to_timescale.repeated_in_batch",
+                vin=vin,
+                last_updated_at=last_updated_at,
+            )
+            continue
+        updates[last_updated_at] = event_object
+        if source_events is not None:
+            source_events[(vin, last_updated_at)] = event
+    log_event(
+        logging.INFO,
+        "bmw_to_timescale.batch",
+        events=len(events),
+        updates=lambda: {vin: len(updates) for vin, updates in updates_by_vin.items()},
+        repeated=repeated,
+        malformed=malformed,
+    )
+    return updates_by_vin
 
 
 def get_event_body(event: EventHubEvent) -> Dict[str, Any]:
@@ -68,6 +197,20 @@ def get_event_body(event: EventHubEvent) -> Dict[str, Any]:
     return json.loads(event_body)
 
 
+# the paths in a BMW vehicle document which convert_bmw_to_timescale reads.
+# bmw_update can publish a projection containing only these, see bmw.project_car_data
+MESSAGE_FIELD_PATHS: List[Tuple[str, ...]] = [
+    ("vin",),
+    ("state", "lastUpdatedAt"),
+    ("state", "currentMileage"),
+    ("state", "location", "coordinates"),
+    ("state", "electricChargingState", "chargingLevelPercent"),
+    ("state", "electricChargingState", "range"),
+    ("state", "electricChargingState", "isChargerConnected"),
+    ("state", "electricChargingState", "chargingStatus"),
+]
+
+
 def construct_messages(
     vin: str, last_updated_at: str, event_object: Dict[str, Any]
 ) -> List[Dict[str, Any]]:
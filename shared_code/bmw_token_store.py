@@ -0,0 +1,195 @@
+"""Persist MyBMW OAuth tokens between bmw_update timer invocations
+
+Without a store, every run logs in with the username and password. With one, a run reuses
+the stored access token while it is valid, and otherwise exchanges the stored refresh token,
+which bimmer_connected tries before falling back to a full login.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.data.tables import TableServiceClient
+from bimmer_connected.account import MyBMWAccount
+
+from .duplicate_check import ensure_table_exists, get_table_service_client
+
+TOKEN_FIELDS = ["access_token", "refresh_token", "gcid", "session_id", "expires_at"]
+
+
+class BMWTokenStore(ABC):
+    """Somewhere to keep the MyBMW tokens between invocations"""
+
+    @abstractmethod
+    def load(self) -> Optional[Dict[str, Any]]:
+        """Load the stored tokens
+        @return: the tokens, or None if nothing has been stored
+        """
+
+    @abstractmethod
+    def save(self, tokens: Dict[str, Any]) -> None:
+        """Store the tokens, replacing any stored before
+        @param tokens: the tokens, as returned by get_tokens_from_account
+        """
+
+
+class FileBMWTokenStore(BMWTokenStore):
+    """Keeps the tokens in a JSON file on the local disk of the functions instance"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, tokens: Dict[str, Any]) -> None:
+        # write to a temporary file and rename, so a concurrent load never sees half a file
+        temporary_path = f"{self.path}.tmp"
+        with open(
+            os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w"
+        ) as f:
+            json.dump(tokens, f)
+        os.replace(temporary_path, self.path)
+
+
+class TableBMWTokenStore(BMWTokenStore):
+    """Keeps the tokens in Azure Table Storage, so they are shared by every functions instance"""
+
+    def __init__(
+        self,
+        table_service_client: TableServiceClient,
+        username: str,
+        table_name: str = "bmwtokens",
+    ):
+        self.table_service_client = table_service_client
+        self.table_name = table_name
+        # the row is keyed on a hash so the username is not stored in the clear
+        self.row_key = hashlib.sha256(username.encode("utf-8")).hexdigest()
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        table_client = self.table_service_client.get_table_client(self.table_name)
+        try:
+            entity = table_client.get_entity("tokens", self.row_key)
+        except ResourceNotFoundError:
+            return None
+        return {field: entity.get(field) for field in TOKEN_FIELDS}
+
+    def save(self, tokens: Dict[str, Any]) -> None:
+        ensure_table_exists(self.table_name, self.table_service_client)
+        table_client = self.table_service_client.get_table_client(self.table_name)
+        table_client.upsert_entity(
+            {"PartitionKey": "tokens", "RowKey": self.row_key, **tokens}
+        )
+
+
+def get_bmw_token_store() -> Optional[BMWTokenStore]:
+    """Get the token store configured in the environment
+
+    Environment variables used:
+        BMW_TOKEN_STORE: "file", "table", or unset / "none" to log in on every run.
+        BMW_TOKEN_FILE: The path for the "file" store. Defaults to bmw_tokens.json in the temp directory.
+        AZURE_STORAGE_CONNECTION_STRING: The storage account for the "table" store.
+        BMW_USERNAME: Identifies the account's row in the "table" store.
+
+    Returns:
+        BMWTokenStore | None: The token store, or None if tokens are not persisted.
+
+    Raises:
+        ValueError: If BMW_TOKEN_STORE is not a known store.
+    """  # noqa: E501
+    store_type = (os.environ.get("BMW_TOKEN_STORE") or "none").lower()
+    if store_type == "none":
+        return None
+    if store_type == "file":
+        return FileBMWTokenStore(
+            os.environ.get("BMW_TOKEN_FILE")
+            or os.path.join(tempfile.gettempdir(), "bmw_tokens.json")
+        )
+    if store_type == "table":
+        return TableBMWTokenStore(
+            get_table_service_client(), os.environ["BMW_USERNAME"]
+        )
+    raise ValueError(f"Unknown BMW_TOKEN_STORE: {store_type}")
+
+
+def get_tokens_from_account(account: MyBMWAccount) -> Dict[str, Any]:
+    """Read the current tokens from an account
+    @param account: the account
+    @return: the tokens, with expires_at as an ISO 8601 string
+    """
+    authentication = account.config.authentication
+    expires_at = authentication.expires_at
+    return {
+        "access_token": authentication.access_token,
+        "refresh_token": authentication.refresh_token,
+        "gcid": authentication.gcid,
+        "session_id": authentication.session_id,
+        "expires_at": expires_at.isoformat() if expires_at else None,
+    }
+
+
+def apply_tokens_to_account(account: MyBMWAccount, tokens: Dict[str, Any]) -> None:
+    """Give an account the stored tokens
+    The access token is only used if it has not expired; otherwise bimmer_connected
+    exchanges the refresh token for a new one when the account is first used.
+    @param account: the account
+    @param tokens: the tokens, as returned by get_tokens_from_account
+    """
+    if not tokens.get("refresh_token"):
+        return
+    expires_at = (
+        datetime.datetime.fromisoformat(tokens["expires_at"])
+        if tokens.get("expires_at")
+        else None
+    )
+    if expires_at is not None and expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+    access_token_valid = expires_at is not None and expires_at > datetime.datetime.now(
+        datetime.timezone.utc
+    )
+    account.set_refresh_token(
+        tokens["refresh_token"],
+        gcid=tokens.get("gcid"),
+        access_token=tokens.get("access_token") if access_token_valid else None,
+        session_id=tokens.get("session_id") if access_token_valid else None,
+    )
+    if access_token_valid:
+        account.config.authentication.expires_at = expires_at
+
+
+def restore_tokens(account: MyBMWAccount, token_store: BMWTokenStore) -> None:
+    """Load tokens from the store into the account. A store which cannot be read is logged and ignored.
+    @param account: the account
+    @param token_store: the token store
+    """
+    try:
+        tokens = token_store.load()
+    except Exception as e:
+        logging.error(f"bmw_token_store: Unable to load tokens, logging in: {e}")
+        return
+    if tokens:
+        apply_tokens_to_account(account, tokens)
+
+
+def persist_tokens(account: MyBMWAccount, token_store: BMWTokenStore) -> None:
+    """Save the account's tokens to the store. A store which cannot be written is logged and ignored.
+    @param account: the account
+    @param token_store: the token store
+    """
+    tokens = get_tokens_from_account(account)
+    if not tokens["refresh_token"]:
+        return
+    try:
+        token_store.save(tokens)
+    except Exception as e:
+        logging.error(f"bmw_token_store: Unable to save tokens: {e}")
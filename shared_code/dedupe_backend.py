@@ -0,0 +1,476 @@
+"""Where bmw_to_timescale records the (vin, lastUpdatedAt) updates it has already sent
+
+Every backend offers the same operations as duplicate_check: check_duplicate and store_id, and
+the claim protocol of claim_id, confirm_id and release_claim. The context is the VIN and the
+identifier is the lastUpdatedAt timestamp.
+"""
+
+import datetime
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+from azure.data.tables import TableServiceClient
+
+from . import duplicate_check
+
+if TYPE_CHECKING:
+    # only the postgres backend needs psycopg, so it is imported when that backend connects
+    import psycopg
+
+
+class DedupeBackend(ABC):
+    """Somewhere to record which messages have been sent"""
+
+    @abstractmethod
+    def check_duplicate(self, identifier: str, context: str) -> bool:
+        """Check whether an identifier has been stored or claimed
+        @param identifier: the unique identifier
+        @param context: the namespace of the identifier
+        @return: True if the identifier is a duplicate
+        """
+
+    @abstractmethod
+    def store_id(self, identifier: str, context: str) -> bool:
+        """Record an identifier as sent
+        @param identifier: the unique identifier
+        @param context: the namespace of the identifier
+        @return: True once the identifier is stored
+        """
+
+    @abstractmethod
+    def claim_id(self, identifier: str, context: str) -> bool:
+        """Atomically claim an identifier before processing it. Stale claims may be taken over.
+        @param identifier: the unique identifier
+        @param context: the namespace of the identifier
+        @return: True if the caller holds the claim, False if the message is a duplicate
+        """
+
+    @abstractmethod
+    def confirm_id(self, identifier: str, context: str) -> None:
+        """Mark a claimed identifier as sent
+        @param identifier: the unique identifier
+        @param context: the namespace of the identifier
+        """
+
+    @abstractmethod
+    def release_claim(self, identifier: str, context: str) -> None:
+        """Give up a claim, so a redelivery can process the message. Errors are ignored.
+        @param identifier: the unique identifier
+        @param context: the namespace of the identifier
+        """
+
+    def claim_ids(self, identifiers: List[str], context: str) -> List[str]:
+        """Claim several identifiers in the same context. Backends override this to use fewer round trips.
+        @param identifiers: the unique identifiers
+        @param context: the namespace of the identifiers
+        @return: the identifiers the caller holds claims on, in the order given
+        """  # noqa: E501
+        return [
+            identifier
+            for identifier in dict.fromkeys(identifiers)
+            if self.claim_id(identifier, context)
+        ]
+
+    def confirm_ids(self, identifiers: List[str], context: str) -> None:
+        """Mark several claimed identifiers in the same context as sent
+        @param identifiers: the unique identifiers
+        @param context: the namespace of the identifiers
+        """
+        for identifier in identifiers:
+            self.confirm_id(identifier, context)
+
+    def release_claims(self, identifiers: List[str], context: str) -> None:
+        """Give up several claims in the same context. Errors are ignored.
+        @param identifiers: the unique identifiers
+        @param context: the namespace of the identifiers
+        """
+        for identifier in identifiers:
+            self.release_claim(identifier, context)
+
+    def purge_expired(self, contexts: Optional[List[str]] = None) -> int:
+        """Delete entries older than the retention period. Backends which expire entries themselves do nothing.
+        @param contexts: the namespaces to purge, or None for every namespace the backend can list
+        @return: the number of entries deleted
+        """  # noqa: E501
+        return 0
+
+    def warm_up(self, contexts: List[str]) -> None:
+        """Open connections and create anything the first claim would, before it is needed.
+        Backends with nothing to prepare do nothing.
+        @param contexts: the namespaces which will be claimed in
+        """
+        return None
+
+
+class TableDedupeBackend(DedupeBackend):
+    """Azure Table Storage, one table per context, via the functions in duplicate_check"""
+
+    def __init__(
+        self,
+        table_service_client: TableServiceClient,
+        retention_seconds: float = 7 * 24 * 3600,
+    ):
+        self.table_service_client = table_service_client
+        self.retention_seconds = retention_seconds
+
+    def check_duplicate(self, identifier: str, context: str) -> bool:
+        return duplicate_check.check_duplicate(
+            identifier, context, self.table_service_client
+        )
+
+    def store_id(self, identifier: str, context: str) -> bool:
+        return duplicate_check.store_id(identifier, context, self.table_service_client)
+
+    def claim_id(self, identifier: str, context: str) -> bool:
+        return duplicate_check.claim_id(identifier, context, self.table_service_client)
+
+    def confirm_id(self, identifier: str, context: str) -> None:
+        duplicate_check.confirm_id(identifier, context, self.table_service_client)
+
+    def release_claim(self, identifier: str, context: str) -> None:
+        duplicate_check.release_claim(identifier, context, self.table_service_client)
+
+    def claim_ids(self, identifiers: List[str], context: str) -> List[str]:
+        return duplicate_check.claim_ids(
+            identifiers, context, self.table_service_client
+        )
+
+    def confirm_ids(self, identifiers: List[str], context: str) -> None:
+        duplicate_check.confirm_ids(identifiers, context, self.table_service_client)
+
+    def release_claims(self, identifiers: List[str], context: str) -> None:
+        duplicate_check.release_claims(identifiers, context, self.table_service_client)
+
+    def warm_up(self, contexts: List[str]) -> None:
+        # also opens the connection to the storage account
+        for context in contexts:
+            duplicate_check.ensure_context_table_exists(
+                context, self.table_service_client
+            )
+
+    def purge_expired(self, contexts: Optional[List[str]] = None) -> int:
+        if contexts is None:
+            # other tables share the storage account, so only the recorded contexts are purged
+            contexts = duplicate_check.list_contexts(self.table_service_client)
+        older_than = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            seconds=self.retention_seconds
+        )
+        deleted = 0
+        for context in contexts:
+            deleted_from_context = duplicate_check.purge_expired_ids(
+                context, self.table_service_client, older_than
+            )
+            logging.info(
+                f"dedupe_backend: Deleted {deleted_from_context} expired entities from {context}"
+            )
+            deleted += deleted_from_context
+        return deleted
+
+
+class PostgresDedupeBackend(DedupeBackend):
+    """A keyed table in Postgres. Each claim is a single INSERT ... ON CONFLICT, and rows not seen
+    for the retention period are deleted at most once per cleanup interval. Every claim of an
+    identifier, including a duplicate, refreshes its last_seen, so the current update of a parked
+    vehicle is never deleted while it is still being polled.
+    """
+
+    # on conflict, every claim refreshes last_seen, but only a stale pending claim is taken over:
+    # its updated_at moves to now(), which a row inserted or taken over by this statement shares
+    CLAIM_CONFLICT_UPDATE = (
+        "last_seen = now(), updated_at = CASE "
+        f"WHEN existing.state = '{duplicate_check.CLAIM_PENDING}' "
+        "AND existing.updated_at < now() - make_interval(secs => %s) "
+        "THEN now() ELSE existing.updated_at END"
+    )
+    CLAIMED = "(existing.xmax = 0 OR existing.updated_at = now())"
+
+    def __init__(
+        self,
+        connection_string: str,
+        table_name: str = "dedupe",
+        claim_ttl_seconds: float = 300,
+        retention_seconds: float = 7 * 24 * 3600,
+        cleanup_interval_seconds: float = 3600,
+    ):
+        self.connection_string = connection_string
+        self.table_name = table_name
+        self.claim_ttl_seconds = claim_ttl_seconds
+        self.retention_seconds = retention_seconds
+        self.cleanup_interval_seconds = cleanup_interval_seconds
+        self.connection: Optional["psycopg.Connection"] = None
+        self.last_cleanup: Optional[float] = None
+
+    def warm_up(self, contexts: List[str]) -> None:
+        self.get_connection()
+
+    def get_connection(self) -> "psycopg.Connection":
+        """Connect on first use, and again if the connection has been lost"""
+        if self.connection is None or self.connection.closed:
+            import psycopg
+
+            self.connection = psycopg.connect(self.connection_string, autocommit=True)
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table_name} ("
+                "context TEXT NOT NULL, "
+                "identifier TEXT NOT NULL, "
+                "state TEXT NOT NULL, "
+                "updated_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+                "last_seen TIMESTAMPTZ NOT NULL DEFAULT now(), "
+                "PRIMARY KEY (context, identifier))"
+            )
+            # tables created before last_seen was added
+            self.connection.execute(
+                f"ALTER TABLE {self.table_name} "
+                "ADD COLUMN IF NOT EXISTS last_seen TIMESTAMPTZ NOT NULL DEFAULT now()"
+            )
+        return self.connection
+
+    def purge_expired(self, contexts: Optional[List[str]] = None) -> int:
+        if contexts is None:
+            cursor = self.get_connection().execute(
+                f"DELETE FROM {self.table_name} "
+                "WHERE last_seen < now() - make_interval(secs => %s)",
+                (self.retention_seconds,),
+            )
+        else:
+            cursor = self.get_connection().execute(
+                f"DELETE FROM {self.table_name} "
+                "WHERE last_seen < now() - make_interval(secs => %s) "
+                "AND context = ANY(%s)",
+                (self.retention_seconds, list(contexts)),
+            )
+        self.last_cleanup = time.monotonic()
+        return cursor.rowcount
+
+    def purge_expired_if_due(self) -> None:
+        if (
+            self.last_cleanup is None
+            or time.monotonic() - self.last_cleanup >= self.cleanup_interval_seconds
+        ):
+            self.purge_expired()
+
+    def check_duplicate(self, identifier: str, context: str) -> bool:
+        row = (
+            self.get_connection()
+            .execute(
+                f"SELECT 1 FROM {self.table_name} WHERE context = %s AND identifier = %s",
+                (context, identifier),
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    def store_id(self, identifier: str, context: str) -> bool:
+        self.get_connection().execute(
+            f"INSERT INTO {self.table_name} (context, identifier, state) "
+            f"VALUES (%s, %s, '{duplicate_check.CLAIM_SENT}') "
+            "ON CONFLICT (context, identifier) DO UPDATE SET last_seen = now()",
+            (context, identifier),
+        )
+        return True
+
+    def claim_id(self, identifier: str, context: str) -> bool:
+        self.purge_expired_if_due()
+        # inserts a new claim, or takes over a stale one; returns false for a duplicate
+        row = (
+            self.get_connection()
+            .execute(
+                f"INSERT INTO {self.table_name} AS existing (context, identifier, state) "
+                f"VALUES (%s, %s, '{duplicate_check.CLAIM_PENDING}') "
+                f"ON CONFLICT (context, identifier) DO UPDATE SET {self.CLAIM_CONFLICT_UPDATE} "
+                f"RETURNING {self.CLAIMED}",
+                (context, identifier, self.claim_ttl_seconds),
+            )
+            .fetchone()
+        )
+        return row is not None and bool(row[0])
+
+    def confirm_id(self, identifier: str, context: str) -> None:
+        self.get_connection().execute(
+            f"UPDATE {self.table_name} "
+            f"SET state = '{duplicate_check.CLAIM_SENT}', updated_at = now(), last_seen = now() "
+            "WHERE context = %s AND identifier = %s",
+            (context, identifier),
+        )
+
+    def release_claim(self, identifier: str, context: str) -> None:
+        try:
+            self.get_connection().execute(
+                f"DELETE FROM {self.table_name} "
+                f"WHERE context = %s AND identifier = %s "
+                f"AND state = '{duplicate_check.CLAIM_PENDING}'",
+                (context, identifier),
+            )
+        except Exception:
+            pass
+
+    def claim_ids(self, identifiers: List[str], context: str) -> List[str]:
+        self.purge_expired_if_due()
+        rows = (
+            self.get_connection()
+            .execute(
+                f"INSERT INTO {self.table_name} AS existing (context, identifier, state) "
+                f"SELECT %s, identifier, '{duplicate_check.CLAIM_PENDING}' "
+                "FROM unnest(%s::text[]) AS identifier "
+                f"ON CONFLICT (context, identifier) DO UPDATE SET {self.CLAIM_CONFLICT_UPDATE} "
+                f"RETURNING identifier, {self.CLAIMED}",
+                (context, list(dict.fromkeys(identifiers)), self.claim_ttl_seconds),
+            )
+            .fetchall()
+        )
+        claimed = {identifier for identifier, is_claimed in rows if is_claimed}
+        return [i for i in dict.fromkeys(identifiers) if i in claimed]
+
+    def confirm_ids(self, identifiers: List[str], context: str) -> None:
+        self.get_connection().execute(
+            f"UPDATE {self.table_name} "
+            f"SET state = '{duplicate_check.CLAIM_SENT}', updated_at = now(), last_seen = now() "
+            "WHERE context = %s AND identifier = ANY(%s)",
+            (context, list(identifiers)),
+        )
+
+    def release_claims(self, identifiers: List[str], context: str) -> None:
+        try:
+            self.get_connection().execute(
+                f"DELETE FROM {self.table_name} "
+                "WHERE context = %s AND identifier = ANY(%s) "
+                f"AND state = '{duplicate_check.CLAIM_PENDING}'",
+                (context, list(identifiers)),
+            )
+        except Exception:
+            pass
+
+
+class MemoryDedupeBackend(DedupeBackend):
+    """Keeps everything in this process. For tests, and for running a single worker locally."""
+
+    def __init__(
+        self,
+        claim_ttl_seconds: float = 300,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.claim_ttl_seconds = claim_ttl_seconds
+        self.clock = clock
+        # (context, identifier) -> (state, time of the last change)
+        self.entries: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        self.lock = threading.Lock()
+
+    def check_duplicate(self, identifier: str, context: str) -> bool:
+        return (context, identifier) in self.entries
+
+    def store_id(self, identifier: str, context: str) -> bool:
+        with self.lock:
+            self.entries.setdefault(
+                (context, identifier), (duplicate_check.CLAIM_SENT, self.clock())
+            )
+        return True
+
+    def claim_id(self, identifier: str, context: str) -> bool:
+        with self.lock:
+            existing = self.entries.get((context, identifier))
+            if existing is not None:
+                state, updated_at = existing
+                if state != duplicate_check.CLAIM_PENDING:
+                    return False
+                if updated_at + self.claim_ttl_seconds > self.clock():
+                    return False
+            self.entries[(context, identifier)] = (
+                duplicate_check.CLAIM_PENDING,
+                self.clock(),
+            )
+            return True
+
+    def confirm_id(self, identifier: str, context: str) -> None:
+        with self.lock:
+            self.entries[(context, identifier)] = (
+                duplicate_check.CLAIM_SENT,
+                self.clock(),
+            )
+
+    def release_claim(self, identifier: str, context: str) -> None:
+        with self.lock:
+            existing = self.entries.get((context, identifier))
+            if existing is not None and existing[0] == duplicate_check.CLAIM_PENDING:
+                del self.entries[(context, identifier)]
+
+
+def get_retention_seconds() -> float:
+    return float(os.environ.get("DEDUPE_RETENTION_SECONDS") or 7 * 24 * 3600)
+
+
+# one backend per configuration, reused by every invocation on this worker
+dedupe_backends: Dict[str, DedupeBackend] = {}
+
+
+def get_dedupe_backend() -> DedupeBackend:
+    """Get the dedupe backend configured in the environment
+
+    Environment variables used:
+        DEDUPE_BACKEND: "table" (the default), "postgres" or "memory".
+        AZURE_STORAGE_CONNECTION_STRING: The storage account for the "table" backend.
+        DEDUPE_POSTGRES_CONNECTION_STRING: The database for the "postgres" backend. Defaults to the
+            timescale database, see timescale.get_connection_string.
+        DEDUPE_CLAIM_TTL_SECONDS: How long a pending claim blocks redeliveries.
+        DEDUPE_RETENTION_SECONDS: How long entries are kept (default 7 days).
+
+    Returns:
+        DedupeBackend: The backend.
+
+    Raises:
+        ValueError: If DEDUPE_BACKEND is not a known backend.
+    """  # noqa: E501
+    backend_type = (os.environ.get("DEDUPE_BACKEND") or "table").lower()
+    if backend_type == "table":
+        # the table service client is itself cached per connection string
+        return TableDedupeBackend(
+            duplicate_check.get_table_service_client(),
+            retention_seconds=get_retention_seconds(),
+        )
+    if backend_type == "postgres":
+        from .timescale import get_connection_string
+
+        connection_string = (
+            os.environ.get("DEDUPE_POSTGRES_CONNECTION_STRING")
+            or get_connection_string()
+        )
+        key = f"postgres:{connection_string}"
+        if key not in dedupe_backends:
+            dedupe_backends[key] = PostgresDedupeBackend(
+                connection_string,
+                claim_ttl_seconds=duplicate_check.get_claim_ttl_seconds(),
+                retention_seconds=get_retention_seconds(),
+            )
+        return dedupe_backends[key]
+    if backend_type == "memory":
+        if "memory" not in dedupe_backends:
+            dedupe_backends["memory"] = MemoryDedupeBackend(
+                claim_ttl_seconds=duplicate_check.get_claim_ttl_seconds()
+            )
+        return dedupe_backends["memory"]
+    raise ValueError(f"Unknown DEDUPE_BACKEND: {backend_type}")
+
+
+def get_vins() -> List[str]:
+    """@return: the VINs in BMW_VINS, each of which is a dedupe context"""
+    return [
+        vin.strip() for vin in os.environ.get("BMW_VINS", "").split(",") if vin.strip()
+    ]
+
+
+def purge_dedupe_store() -> int:
+    """Delete expired entries from the configured dedupe backend, for every context in the store.
+    This includes vehicles which have since been removed from BMW_VINS.
+
+    Environment variables used:
+        DEDUPE_BACKEND, DEDUPE_RETENTION_SECONDS: See get_dedupe_backend.
+
+    Returns:
+        int: The number of entries deleted.
+    """
+    deleted = get_dedupe_backend().purge_expired()
+    logging.info(f"dedupe_backend: Purged {deleted} expired entries")
+    return deleted
@@ -1,10 +1,200 @@
 from azure.data.tables import TableServiceClient, TableEntity
-from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.data.tables import TableTransactionError, UpdateMode
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
 
-from dotenv import load_dotenv
+from collections import OrderedDict
+import datetime
+import hashlib
+import logging
 import os
+import re
+import threading
+import time
+import weakref
+from typing import Dict, List, Optional, Tuple
 
-load_dotenv()
+from .instrumentation import count, timed
+
+# states of a claimed identifier. entities written by store_id have no state and count as sent
+CLAIM_PENDING = "pending"
+CLAIM_SENT = "sent"
+
+# the most operations Azure Table Storage accepts in one transaction
+TABLE_TRANSACTION_LIMIT = 100
+
+# every table used as a dedupe context is recorded here, so the purge can find them all without
+# touching the other tables in the storage account
+CONTEXT_REGISTRY_TABLE = "dedupecontexts"
+CONTEXT_REGISTRY_PARTITION_KEY = "context"
+
+# entities written before identifiers were partitioned all share this partition key
+LEGACY_PARTITION_KEY = "messages"
+DAY_BUCKET_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}")
+
+
+class RecentIdentifierCache:
+    """Bounded, expiring record of (context, identifier) pairs known to be stored.
+    Only positive results are kept: an identifier that is not in the cache still has to be looked up.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict[tuple[str, str], float] = OrderedDict()
+        # invocations running on other threads of the worker share the cache
+        self.lock = threading.Lock()
+
+    def __contains__(self, key: tuple[str, str]) -> bool:
+        with self.lock:
+            expires_at = self.entries.get(key)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return False
+            self.entries.move_to_end(key)
+            return True
+
+    def add(self, key: tuple[str, str]) -> None:
+        with self.lock:
+            self.entries[key] = time.monotonic() + self.ttl_seconds
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+def get_partition_key(identifier: str) -> str:
+    """
+    Returns the partition an identifier's entity is written to.
+
+    Environment variables used:
+    - DEDUPE_PARTITION_SCHEME: "day" (the default) buckets identifiers by the date they start with, so old entities
+      can be purged a partition at a time; identifiers which do not start with a date use the legacy partition.
+      "hash" spreads identifiers over 256 partitions by a prefix of their SHA-256. "messages" keeps the single
+      legacy partition.
+
+    Raises:
+    - ValueError: If DEDUPE_PARTITION_SCHEME is not a known scheme.
+    """  # noqa: E501
+    scheme = (os.environ.get("DEDUPE_PARTITION_SCHEME") or "day").lower()
+    if scheme == "day":
+        if DAY_BUCKET_PATTERN.match(identifier):
+            return identifier[:10]
+        return LEGACY_PARTITION_KEY
+    if scheme == "hash":
+        return hashlib.sha256(identifier.encode("utf-8")).hexdigest()[:2]
+    if scheme == LEGACY_PARTITION_KEY:
+        return LEGACY_PARTITION_KEY
+    raise ValueError(f"Unknown DEDUPE_PARTITION_SCHEME: {scheme}")
+
+
+def needs_legacy_lookup(identifier: str, partition_key: str) -> bool:
+    """
+    Returns whether an identifier might also have been stored in the legacy partition, and so must be looked up there.
+    Entities in the legacy partition were written by store_id and always count as sent.
+
+    Environment variables used:
+    - DEDUPE_LEGACY_PARTITION_UNTIL: a date (YYYY-MM-DD) from which identifiers were no longer written to the legacy
+      partition, so identifiers dated on or after it skip the extra lookup. Unset, every identifier is looked up in
+      both partitions, until the purge has emptied the legacy partition (see legacy_partition_in_use).
+    """  # noqa: E501
+    if partition_key == LEGACY_PARTITION_KEY:
+        return False
+    legacy_until = os.environ.get("DEDUPE_LEGACY_PARTITION_UNTIL")
+    if not legacy_until:
+        return True
+    return not (
+        DAY_BUCKET_PATTERN.match(identifier) and identifier[:10] >= legacy_until
+    )
+
+
+def legacy_partition_in_use(context: str, table_service_client: TableServiceClient) -> bool:
+    """
+    Returns whether the legacy partition of a table still holds entities, so that lookups there can find anything.
+    Nothing is written to it once identifiers are partitioned, and the purge deletes what is there after the
+    retention period; once it is found empty, this is remembered for the life of the worker.
+
+    Environment variables used:
+    - DEDUPE_LEGACY_CHECK_SECONDS: how long to wait before checking again a legacy partition which held entities
+      (default 3600).
+    """  # noqa: E501
+    checked = legacy_partition_checks.setdefault(table_service_client, {})
+    if context in checked:
+        found_entities_at = checked[context]
+        if found_entities_at is None:
+            return False
+        if time.monotonic() - found_entities_at < float(
+            os.environ.get("DEDUPE_LEGACY_CHECK_SECONDS") or 3600
+        ):
+            return True
+    table_client = table_service_client.get_table_client(context)
+    try:
+        with timed("table_lookup"):
+            entities = table_client.query_entities(
+                f"PartitionKey eq '{LEGACY_PARTITION_KEY}'",
+                select=["RowKey"],
+                results_per_page=1,
+            )
+            in_use = next(iter(entities), None) is not None
+    except Exception:
+        return True  # look it up anyway, which reports any error there is
+    checked[context] = time.monotonic() if in_use else None
+    return in_use
+
+
+def find_legacy_entity(table_client, identifier: str) -> Optional[TableEntity]:
+    try:
+        return table_client.get_entity(LEGACY_PARTITION_KEY, identifier)
+    except ResourceNotFoundError:
+        return None
+
+
+# table service clients, one per connection string, shared by every invocation on this worker
+table_service_clients: dict[str, TableServiceClient] = {}
+
+# per client: the tables it has already created or found, and the identifiers it has seen.
+# keyed on the client so that different storage accounts never share state
+tables_known_to_exist: "weakref.WeakKeyDictionary[TableServiceClient, set[str]]" = (
+    weakref.WeakKeyDictionary()
+)
+recently_seen_identifiers: "weakref.WeakKeyDictionary[TableServiceClient, RecentIdentifierCache]" = (
+    weakref.WeakKeyDictionary()
+)
+recently_seen_identifiers_lock = threading.Lock()
+# per client: the contexts it has already recorded in CONTEXT_REGISTRY_TABLE
+registered_contexts: "weakref.WeakKeyDictionary[TableServiceClient, set[str]]" = (
+    weakref.WeakKeyDictionary()
+)
+# per client and table: when its legacy partition was last found to hold entities, or None once it was found empty
+legacy_partition_checks: "weakref.WeakKeyDictionary[TableServiceClient, Dict[str, Optional[float]]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_recently_seen_identifiers(
+    table_service_client: TableServiceClient,
+) -> RecentIdentifierCache:
+    """
+    Returns the cache of identifiers seen through this client, creating it on first use.
+
+    Environment variables used:
+    - DEDUPE_CACHE_SIZE: the maximum number of identifiers to remember (default 1024).
+    - DEDUPE_CACHE_TTL_SECONDS: how long to remember each identifier (default 86400).
+    """
+    with recently_seen_identifiers_lock:
+        cache = recently_seen_identifiers.get(table_service_client)
+        if cache is None:
+            cache = RecentIdentifierCache(
+                max_size=int(os.environ.get("DEDUPE_CACHE_SIZE") or 1024),
+                ttl_seconds=float(os.environ.get("DEDUPE_CACHE_TTL_SECONDS") or 86400),
+            )
+            recently_seen_identifiers[table_service_client] = cache
+        return cache
 
 
 # Function to initialize table service client
@@ -15,16 +205,24 @@ def get_table_service_client() -> TableServiceClient:
     Returns:
     - TableServiceClient: The initialized client.
 
+    The client is created once per connection string and reused by later calls.
+
     Raises:
     - Exception: If unable to initialize the client.
     """
-    return TableServiceClient.from_connection_string(os.environ["AZURE_STORAGE_CONNECTION_STRING"])
+    connection_string = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
+    client = table_service_clients.get(connection_string)
+    if client is None:
+        client = TableServiceClient.from_connection_string(connection_string)
+        table_service_clients[connection_string] = client
+    return client
 
 
 # Function to ensure table exists
 def ensure_table_exists(table_name: str, table_service_client: TableServiceClient):
     """
     Ensures that the specified table exists in Azure Table Storage.
+    Tables which this client has already created or found are not checked again.
 
     Parameters:
     - table_name (str): The name of the table to check or create.
@@ -33,12 +231,72 @@ def ensure_table_exists(table_name: str, table_service_client: TableServiceClien
     Raises:
     - Exception: If unable to ensure that the table exists.
     """
+    known_tables = tables_known_to_exist.setdefault(table_service_client, set())
+    if table_name in known_tables:
+        return
     try:
         table_service_client.create_table(table_name)
     except ResourceExistsError:
         pass  # Table already exists, no action needed
     except Exception as e:
         raise Exception(f"Failed to ensure table exists: {e}")
+    known_tables.add(table_name)
+
+
+def ensure_context_table_exists(context: str, table_service_client: TableServiceClient) -> None:
+    """
+    Ensures that the table of a dedupe context exists, and records it in CONTEXT_REGISTRY_TABLE so that
+    list_contexts can find it. Recording it is retried on a later call if it fails.
+
+    Parameters:
+    - context (str): The table where identifiers will be stored.
+    - table_service_client (TableServiceClient): The client to interact with Azure Table Storage.
+
+    Raises:
+    - Exception: If unable to ensure that the table exists.
+    """  # noqa: E501
+    ensure_table_exists(context, table_service_client)
+    registered = registered_contexts.setdefault(table_service_client, set())
+    if context in registered:
+        return
+    try:
+        registry = table_service_client.create_table_if_not_exists(CONTEXT_REGISTRY_TABLE)
+        registry.upsert_entity(
+            TableEntity(PartitionKey=CONTEXT_REGISTRY_PARTITION_KEY, RowKey=context)
+        )
+    except Exception as e:
+        logging.warning(f"duplicate_check: Failed to record context {context}: {e}")
+        return
+    registered.add(context)
+
+
+def list_contexts(table_service_client: TableServiceClient) -> List[str]:
+    """
+    Returns the dedupe contexts recorded in CONTEXT_REGISTRY_TABLE.
+
+    Parameters:
+    - table_service_client (TableServiceClient): The client to interact with Azure Table Storage.
+
+    Returns:
+    - List[str]: The table of each context.
+
+    Raises:
+    - Exception: If unable to read the registry.
+    """
+    table_client = table_service_client.get_table_client(CONTEXT_REGISTRY_TABLE)
+    try:
+        return [
+            entity["RowKey"]
+            for entity in table_client.query_entities(
+                "PartitionKey eq @context",
+                parameters={"context": CONTEXT_REGISTRY_PARTITION_KEY},
+                select=["RowKey"],
+            )
+        ]
+    except ResourceNotFoundError:
+        return []  # nothing has been recorded yet
+    except Exception as e:
+        raise Exception(f"Failed to list contexts: {e}")
 
 
 # Function to store an identifier in a table
@@ -57,22 +315,25 @@ def store_id(identifier: str, context: str, table_service_client: TableServiceCl
     Raises:
     - Exception: If unable to store the identifier.
     """
-    ensure_table_exists(context, table_service_client)
+    ensure_context_table_exists(context, table_service_client)
     table_client = table_service_client.get_table_client(context)
-    entity = TableEntity(PartitionKey="messages", RowKey=identifier)
+    entity = TableEntity(PartitionKey=get_partition_key(identifier), RowKey=identifier)
     try:
         table_client.create_entity(entity)
-        return True
     except ResourceExistsError:
-        return True  # Already exists, so the operation is idempotent
+        pass  # Already exists, so the operation is idempotent
     except Exception as e:
         raise Exception(f"Failed to write to table: {e}")
+    get_recently_seen_identifiers(table_service_client).add((context, identifier))
+    return True
 
 
 # Function to check if an identifier already exists in a table
 def check_duplicate(identifier: str, context: str, table_service_client: TableServiceClient) -> bool:
     """
     Checks if a unique identifier already exists in a specified Azure Table Storage table.
+    Identifiers recently stored or found through this client are answered without a round trip.
+    Identifiers not found in their partition are also looked for in the legacy partition, see needs_legacy_lookup.
 
     Parameters:
     - identifier (str): The unique identifier to check.
@@ -85,12 +346,463 @@ def check_duplicate(identifier: str, context: str, table_service_client: TableSe
     Raises:
     - Exception: If unable to check for the duplicate identifier.
     """
-    ensure_table_exists(context, table_service_client)
+    recently_seen = get_recently_seen_identifiers(table_service_client)
+    if (context, identifier) in recently_seen:
+        count("dedupe_cache_hits")
+        return True
+    ensure_context_table_exists(context, table_service_client)
     table_client = table_service_client.get_table_client(context)
+    partition_key = get_partition_key(identifier)
     try:
-        table_client.get_entity("messages", identifier)
-        return True  # Entity exists, so it's a duplicate
+        with timed("table_lookup"):
+            table_client.get_entity(partition_key, identifier)
     except ResourceNotFoundError:  # Entity not found
-        return False
+        try:
+            if not needs_legacy_lookup(identifier, partition_key):
+                return False
+            if not legacy_partition_in_use(context, table_service_client):
+                return False
+            if find_legacy_entity(table_client, identifier) is None:
+                return False
+        except Exception as e:
+            raise Exception(f"Failed to check for duplicate: {e}")
     except Exception as e:
         raise Exception(f"Failed to check for duplicate: {e}")
+    recently_seen.add((context, identifier))
+    return True  # Entity exists, so it's a duplicate
+
+
+def get_claim_ttl_seconds() -> float:
+    """
+    Returns how long a pending claim is honoured before another delivery may take it over.
+
+    Environment variables used:
+    - DEDUPE_CLAIM_TTL_SECONDS: the claim lifetime in seconds (default 300).
+    """
+    return float(os.environ.get("DEDUPE_CLAIM_TTL_SECONDS") or 300)
+
+
+# Function to claim an identifier before processing it
+def claim_id(identifier: str, context: str, table_service_client: TableServiceClient) -> bool:
+    """
+    Atomically claims a unique identifier so that only one delivery of a message processes it.
+
+    A conditional insert writes the identifier in the "pending" state, so a new message costs this
+    write and the confirm_ids write once it has been sent: the same two round trips as
+    check_duplicate and store_id, plus a query of the legacy partition while it is in use (see
+    needs_legacy_lookup). What the claim adds is that two deliveries of the same message can no
+    longer both pass the check. The confirm cannot be folded into the claim, as a claim which is
+    never confirmed must expire so that a redelivery can send the message. If the identifier
+    already exists and was sent, or is claimed by a delivery still within DEDUPE_CLAIM_TTL_SECONDS,
+    the claim fails. An expired claim is taken over, conditional on nobody else having taken it
+    over first.
+
+    Parameters:
+    - identifier (str): The unique identifier to claim.
+    - context (str): The table where the identifier will be claimed.
+    - table_service_client (TableServiceClient): The client to interact with Azure Table Storage.
+
+    Returns:
+    - bool: True if the caller now holds the claim and should process the message, False if it is a duplicate.
+
+    Raises:
+    - Exception: If unable to claim the identifier.
+    """  # noqa: E501
+    if (context, identifier) in get_recently_seen_identifiers(table_service_client):
+        count("dedupe_cache_hits")
+        return False
+    ensure_context_table_exists(context, table_service_client)
+    table_client = table_service_client.get_table_client(context)
+    partition_key = get_partition_key(identifier)
+    entity = TableEntity(
+        PartitionKey=partition_key,
+        RowKey=identifier,
+        state=CLAIM_PENDING,
+        claimed_at=time.time(),
+    )
+    if needs_legacy_lookup(identifier, partition_key) and legacy_partition_in_use(
+        context, table_service_client
+    ):
+        try:
+            legacy = find_legacy_entity(table_client, identifier)
+        except Exception as e:
+            raise Exception(f"Failed to claim identifier: {e}")
+        if legacy is not None:
+            return claim_existing_id(legacy, identifier, context, table_service_client)
+    try:
+        with timed("table_write"):
+            table_client.create_entity(entity)
+        return True
+    except ResourceExistsError:
+        pass
+    except Exception as e:
+        raise Exception(f"Failed to claim identifier: {e}")
+
+    try:
+        with timed("table_lookup"):
+            existing = table_client.get_entity(partition_key, identifier)
+    except ResourceNotFoundError:
+        # the claim was released between our insert and this read; let redelivery retry
+        return False
+    except Exception as e:
+        raise Exception(f"Failed to claim identifier: {e}")
+    return claim_existing_id(existing, identifier, context, table_service_client)
+
+
+def claim_existing_id(
+    existing: TableEntity,
+    identifier: str,
+    context: str,
+    table_service_client: TableServiceClient,
+) -> bool:
+    """
+    Decides whether an identifier which is already in the table can be claimed, taking over its claim if it is stale.
+
+    Parameters:
+    - existing (TableEntity): The entity as read from the table.
+    - identifier (str): The unique identifier to claim.
+    - context (str): The table where the identifier will be claimed.
+    - table_service_client (TableServiceClient): The client to interact with Azure Table Storage.
+
+    Returns:
+    - bool: True if the caller now holds the claim, False if it is a duplicate.
+
+    Raises:
+    - Exception: If unable to take over the claim.
+    """  # noqa: E501
+    if existing.get("state", CLAIM_SENT) != CLAIM_PENDING:
+        get_recently_seen_identifiers(table_service_client).add((context, identifier))
+        return False
+    if existing.get("claimed_at", 0) + get_claim_ttl_seconds() > time.time():
+        return False  # another delivery is processing it
+
+    table_client = table_service_client.get_table_client(context)
+    entity = TableEntity(
+        PartitionKey=existing["PartitionKey"],
+        RowKey=identifier,
+        state=CLAIM_PENDING,
+        claimed_at=time.time(),
+    )
+    try:
+        table_client.update_entity(
+            entity,
+            mode=UpdateMode.REPLACE,
+            etag=existing.metadata["etag"],
+            match_condition=MatchConditions.IfNotModified,
+        )
+        return True
+    except ResourceModifiedError:
+        return False  # another delivery took over the stale claim first
+    except Exception as e:
+        raise Exception(f"Failed to claim identifier: {e}")
+
+
+# Function to confirm a claimed identifier once its messages have been sent
+def confirm_id(identifier: str, context: str, table_service_client: TableServiceClient) -> None:
+    """
+    Marks a claimed identifier as sent, so that later deliveries are treated as duplicates.
+
+    Parameters:
+    - identifier (str): The unique identifier previously claimed with claim_id.
+    - context (str): The table where the identifier was claimed.
+    - table_service_client (TableServiceClient): The client to interact with Azure Table Storage.
+
+    Raises:
+    - Exception: If unable to confirm the identifier.
+    """
+    table_client = table_service_client.get_table_client(context)
+    entity = TableEntity(
+        PartitionKey=get_partition_key(identifier), RowKey=identifier, state=CLAIM_SENT
+    )
+    try:
+        with timed("table_write"):
+            table_client.update_entity(entity, mode=UpdateMode.MERGE)
+    except Exception as e:
+        raise Exception(f"Failed to confirm identifier: {e}")
+    get_recently_seen_identifiers(table_service_client).add((context, identifier))
+
+
+# Function to give up a claim so a redelivery can process the message straight away
+def release_claim(identifier: str, context: str, table_service_client: TableServiceClient) -> None:
+    """
+    Deletes a pending claim. Failures are ignored, because the claim expires anyway.
+
+    Parameters:
+    - identifier (str): The unique identifier previously claimed with claim_id.
+    - context (str): The table where the identifier was claimed.
+    - table_service_client (TableServiceClient): The client to interact with Azure Table Storage.
+    """
+    table_client = table_service_client.get_table_client(context)
+    try:
+        table_client.delete_entity(get_partition_key(identifier), identifier)
+    except Exception:
+        pass
+
+
+def chunked(items: List[str], size: int) -> List[List[str]]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def chunked_by_partition(identifiers: List[str]) -> List[tuple[str, List[str]]]:
+    """
+    Splits identifiers into groups which can share a transaction: the same partition, and at most TABLE_TRANSACTION_LIMIT.
+
+    Returns:
+    - List[tuple[str, List[str]]]: The partition key and identifiers of each group.
+    """  # noqa: E501
+    by_partition: Dict[str, List[str]] = {}
+    for identifier in identifiers:
+        by_partition.setdefault(get_partition_key(identifier), []).append(identifier)
+    return [
+        (partition_key, chunk)
+        for partition_key, partition_identifiers in by_partition.items()
+        for chunk in chunked(partition_identifiers, TABLE_TRANSACTION_LIMIT)
+    ]
+
+
+# Function to claim several identifiers in the same table at once
+def claim_ids(identifiers: List[str], context: str, table_service_client: TableServiceClient) -> List[str]:
+    """
+    Claims several identifiers, as claim_id does, using a single query and a single transaction per
+    partition and TABLE_TRANSACTION_LIMIT identifiers. The query also covers the legacy partition while it is in use.
+
+    If the transaction fails because another delivery claimed one of the identifiers in the meantime,
+    the identifiers are claimed one at a time instead.
+
+    Parameters:
+    - identifiers (List[str]): The unique identifiers to claim.
+    - context (str): The table where the identifiers will be claimed.
+    - table_service_client (TableServiceClient): The client to interact with Azure Table Storage.
+
+    Returns:
+    - List[str]: The identifiers the caller now holds claims on, in the order given.
+
+    Raises:
+    - Exception: If unable to claim the identifiers.
+    """  # noqa: E501
+    recently_seen = get_recently_seen_identifiers(table_service_client)
+    candidates = [
+        identifier
+        for identifier in dict.fromkeys(identifiers)
+        if (context, identifier) not in recently_seen
+    ]
+    count("dedupe_cache_hits", amount=len(set(identifiers)) - len(candidates))
+    if not candidates:
+        return []
+    ensure_context_table_exists(context, table_service_client)
+    table_client = table_service_client.get_table_client(context)
+    claimed = set()
+    for partition_key, chunk in chunked_by_partition(candidates):
+        parameters = {f"id{i}": identifier for i, identifier in enumerate(chunk)}
+        # partition keys are dates, hex digits or the legacy key, so are safe to inline
+        partition_filter = f"PartitionKey eq '{partition_key}'"
+        if any(
+            needs_legacy_lookup(i, partition_key) for i in chunk
+        ) and legacy_partition_in_use(context, table_service_client):
+            partition_filter = f"({partition_filter} or PartitionKey eq '{LEGACY_PARTITION_KEY}')"
+        query_filter = "{} and ({})".format(
+            partition_filter,
+            " or ".join(f"RowKey eq @{name}" for name in parameters),
+        )
+        try:
+            with timed("table_lookup"):
+                existing = {
+                    entity["RowKey"]: entity
+                    for entity in table_client.query_entities(
+                        query_filter, parameters=parameters
+                    )
+                }
+        except Exception as e:
+            raise Exception(f"Failed to claim identifiers: {e}")
+        for identifier, entity in existing.items():
+            if claim_existing_id(entity, identifier, context, table_service_client):
+                claimed.add(identifier)
+
+        new_identifiers = [i for i in chunk if i not in existing]
+        if not new_identifiers:
+            continue
+        claimed_at = time.time()
+        operations = [
+            (
+                "create",
+                TableEntity(
+                    PartitionKey=partition_key,
+                    RowKey=identifier,
+                    state=CLAIM_PENDING,
+                    claimed_at=claimed_at,
+                ),
+            )
+            for identifier in new_identifiers
+        ]
+        try:
+            with timed("table_write"):
+                table_client.submit_transaction(operations)
+            claimed.update(new_identifiers)
+        except TableTransactionError:
+            claimed.update(
+                identifier
+                for identifier in new_identifiers
+                if claim_id(identifier, context, table_service_client)
+            )
+        except Exception as e:
+            raise Exception(f"Failed to claim identifiers: {e}")
+    return [identifier for identifier in candidates if identifier in claimed]
+
+
+# Function to confirm several claimed identifiers in the same table at once
+def confirm_ids(identifiers: List[str], context: str, table_service_client: TableServiceClient) -> None:
+    """
+    Marks several claimed identifiers as sent, in one transaction per partition and TABLE_TRANSACTION_LIMIT identifiers.
+
+    Parameters:
+    - identifiers (List[str]): The unique identifiers previously claimed with claim_ids.
+    - context (str): The table where the identifiers were claimed.
+    - table_service_client (TableServiceClient): The client to interact with Azure Table Storage.
+
+    Raises:
+    - Exception: If unable to confirm the identifiers.
+    """  # noqa: E501
+    table_client = table_service_client.get_table_client(context)
+    recently_seen = get_recently_seen_identifiers(table_service_client)
+    for partition_key, chunk in chunked_by_partition(list(identifiers)):
+        operations = [
+            (
+                "update",
+                TableEntity(PartitionKey=partition_key, RowKey=identifier, state=CLAIM_SENT),
+                {"mode": UpdateMode.MERGE},
+            )
+            for identifier in chunk
+        ]
+        try:
+            with timed("table_write"):
+                table_client.submit_transaction(operations)
+        except Exception as e:
+            raise Exception(f"Failed to confirm identifiers: {e}")
+        for identifier in chunk:
+            recently_seen.add((context, identifier))
+
+
+# Function to give up several claims in the same table at once
+def release_claims(identifiers: List[str], context: str, table_service_client: TableServiceClient) -> None:
+    """
+    Deletes several pending claims, in one transaction per partition and TABLE_TRANSACTION_LIMIT identifiers.
+    Failures are ignored, because the claims expire anyway.
+
+    Parameters:
+    - identifiers (List[str]): The unique identifiers previously claimed with claim_ids.
+    - context (str): The table where the identifiers were claimed.
+    - table_service_client (TableServiceClient): The client to interact with Azure Table Storage.
+    """
+    table_client = table_service_client.get_table_client(context)
+    for partition_key, chunk in chunked_by_partition(list(identifiers)):
+        operations = [
+            ("delete", {"PartitionKey": partition_key, "RowKey": identifier})
+            for identifier in chunk
+        ]
+        try:
+            table_client.submit_transaction(operations)
+        except Exception:
+            pass
+
+
+def get_expired_entity_queries(
+    older_than: datetime.datetime,
+) -> List[Tuple[str, Dict[str, object]]]:
+    """
+    Returns the queries which find entities written before a given time, for the current DEDUPE_PARTITION_SCHEME.
+
+    With day partitions, old entities are found by a range over the partition key, without scanning the rest of
+    the table; the legacy partition is found by its timestamps. With hash partitions the whole table is scanned.
+
+    Parameters:
+    - older_than (datetime.datetime): Entities written before this are expired.
+
+    Returns:
+    - List[Tuple[str, Dict[str, object]]]: Each query filter and its parameters.
+    """  # noqa: E501
+    scheme = (os.environ.get("DEDUPE_PARTITION_SCHEME") or "day").lower()
+    if scheme == "hash":
+        return [("Timestamp lt @older_than", {"older_than": older_than})]
+    queries: List[Tuple[str, Dict[str, object]]] = [
+        (
+            "PartitionKey eq @legacy and Timestamp lt @older_than",
+            {"legacy": LEGACY_PARTITION_KEY, "older_than": older_than},
+        )
+    ]
+    if scheme == "day":
+        queries.append(
+            (
+                "PartitionKey lt @older_than_day",
+                {"older_than_day": older_than.date().isoformat()},
+            )
+        )
+    return queries
+
+
+# Function to delete expired identifiers from a table
+def purge_expired_ids(
+    context: str,
+    table_service_client: TableServiceClient,
+    older_than: datetime.datetime,
+) -> int:
+    """
+    Deletes the entities in a table which were written before a given time, in one transaction per partition and
+    TABLE_TRANSACTION_LIMIT entities.
+
+    The newest of them is kept: identifiers are timestamps, and a parked vehicle reports the same one for as long as
+    it is parked, so deleting it would let that update be sent again. Only the newest of the expired entities is
+    looked at, so when newer entities remain one more stale entity is kept than needed, until they expire.
+
+    Parameters:
+    - context (str): The table to purge.
+    - table_service_client (TableServiceClient): The client to interact with Azure Table Storage.
+    - older_than (datetime.datetime): Entities written before this are deleted.
+
+    Returns:
+    - int: The number of entities deleted.
+
+    Raises:
+    - Exception: If unable to purge the table.
+    """  # noqa: E501
+    table_client = table_service_client.get_table_client(context)
+    expired: Dict[str, List[str]] = {}
+    try:
+        for query_filter, parameters in get_expired_entity_queries(older_than):
+            for entity in table_client.query_entities(
+                query_filter,
+                parameters=parameters,
+                select=["PartitionKey", "RowKey"],
+            ):
+                partition_key = entity["PartitionKey"]
+                # a range over the partition key can also match partitions of another scheme
+                if "older_than_day" in parameters and not re.fullmatch(
+                    r"\d{4}-\d{2}-\d{2}", partition_key
+                ):
+                    continue
+                expired.setdefault(partition_key, []).append(entity["RowKey"])
+    except ResourceNotFoundError:
+        return 0  # the table has never been written to
+    except Exception as e:
+        raise Exception(f"Failed to find expired identifiers: {e}")
+
+    if expired:
+        newest = max(
+            (row_key, partition_key)
+            for partition_key, row_keys in expired.items()
+            for row_key in row_keys
+        )
+        expired[newest[1]] = [r for r in expired[newest[1]] if r != newest[0]]
+
+    deleted = 0
+    for partition_key, row_keys in expired.items():
+        for chunk in chunked(list(dict.fromkeys(row_keys)), TABLE_TRANSACTION_LIMIT):
+            operations = [
+                ("delete", {"PartitionKey": partition_key, "RowKey": row_key})
+                for row_key in chunk
+            ]
+            try:
+                table_client.submit_transaction(operations)
+            except Exception as e:
+                raise Exception(f"Failed to delete expired identifiers: {e}")
+            deleted += len(chunk)
+    return deleted
@@ -1,7 +1,7 @@
 import json
 from typing import Any
 
-from .timeseries import create_record_recursive
+from .timeseries import create_record_from_plan
 from .helpers import (
     is_topic_of_interest,
     to_datetime_string,
@@ -37,7 +37,7 @@ def emon_to_timescale(
 
     # for these messages, we need to construct an array of records, one for each value
     records = []
-    return create_record_recursive(
+    return create_record_from_plan(
         payload=message_payload,
         records=records,
         timestamp=timestamp,
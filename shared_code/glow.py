@@ -1,7 +1,7 @@
 import json
 from typing import Any, List
 
-from .timeseries import create_record_recursive
+from .timeseries import create_record_from_plan
 from .helpers import (
     to_datetime_string,
     create_correlation_id,
@@ -30,7 +30,7 @@ def process_measurement_subject(
         return []
 
     energy_payload: dict = message_payload[measurement_subject]["energy"]["import"]
-    records: List[dict[str, Any]] = create_record_recursive(
+    records: List[dict[str, Any]] = create_record_from_plan(
         payload=energy_payload,
         records=records,
         timestamp=timestamp,
@@ -43,7 +43,7 @@ def process_measurement_subject(
 
     if measurement_subject == "electricitymeter":
         power_payload: dict = message_payload[measurement_subject]["power"]
-        records: List[dict[str, Any]] = create_record_recursive(
+        records: List[dict[str, Any]] = create_record_from_plan(
             payload=power_payload,
             records=records,
             timestamp=timestamp,
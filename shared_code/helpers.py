@@ -2,6 +2,8 @@
 common functions used by the azure functions
 """
 import json
+import re
+from functools import lru_cache
 from typing import Any, List
 from datetime import datetime
 from dateutil import parser
@@ -75,24 +77,58 @@ def validate_message_body_type_and_keys(
                 )
 
 
+DATETIME_STRING_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# number of recent timestamps to memoise; glow repeats the same timestamp for every record
+TIMESTAMP_CACHE_SIZE = 256
+
+# ISO-8601 / RFC3339 strings which datetime.fromisoformat parses the same way as dateutil
+ISO_8601_PATTERN = re.compile(
+    r"\d{4}-\d{2}-\d{2}"
+    r"(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d{1,6})?)?(?:Z|[+-]\d{2}:\d{2})?)?"
+)
+
+
 def to_datetime_string(timestamp) -> str:
+    """Convert a timestamp to the string format stored in timescale
+    @param timestamp: epoch seconds (int or float) or a date string
+    @return: the timestamp formatted as %Y-%m-%dT%H:%M:%S.%fZ
+    @throws: ValueError if the timestamp is out of range or cannot be parsed
+    @throws: TypeError if the timestamp is not a number or string
+    """
+    if isinstance(timestamp, (int, float, str)):
+        return convert_timestamp_to_string(timestamp)
+
+    # Raise an error for unsupported types
+    raise TypeError(f"Unsupported type for timestamp: {type(timestamp).__name__}")
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def convert_timestamp_to_string(timestamp: int | float | str) -> str:
+    """Memoised conversion behind to_datetime_string
+    ISO-8601 strings take a fast path through datetime.fromisoformat; anything else,
+    or anything fromisoformat rejects, is parsed by dateutil as before.
+    @param timestamp: epoch seconds (int or float) or a date string
+    @return: the timestamp formatted as %Y-%m-%dT%H:%M:%S.%fZ
+    @throws: ValueError if the timestamp is out of range or cannot be parsed
+    """
     # Check if the input is a number (int or float)
     if isinstance(timestamp, (int, float)):
         if not (0 <= timestamp <= 253402300799):
             raise ValueError(f"Timestamp out of range: {timestamp}")
-        return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        return datetime.fromtimestamp(timestamp).strftime(DATETIME_STRING_FORMAT)
 
-    # Check if the input is a string
-    elif isinstance(timestamp, str):
+    if ISO_8601_PATTERN.fullmatch(timestamp):
         try:
-            parsed_time = parser.parse(timestamp)
-            return parsed_time.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-        except parser.ParserError as pe:
-            raise ValueError(f"Invalid string timestamp format: {timestamp}") from pe
+            return datetime.fromisoformat(timestamp).strftime(DATETIME_STRING_FORMAT)
+        except ValueError:
+            pass  # e.g. day out of range, or "Z" before python 3.11; let dateutil decide
 
-    # Raise an error for unsupported types
-    else:
-        raise TypeError(f"Unsupported type for timestamp: {type(timestamp).__name__}")
+    try:
+        parsed_time = parser.parse(timestamp)
+        return parsed_time.strftime(DATETIME_STRING_FORMAT)
+    except parser.ParserError as pe:
+        raise ValueError(f"Invalid string timestamp format: {timestamp}") from pe
 
 
 def create_correlation_id() -> str:
@@ -138,3 +174,82 @@ def recursively_deserialize(item: Any) -> dict:
     #     )
     # except json.JSONDecodeError:
     #     return item
+
+
+# characters a JSON document can start with, including json.loads' NaN and Infinity extensions
+JSON_FIRST_CHARACTERS = frozenset('{["-0123456789tfnNI')
+JSON_WHITESPACE = " \t\n\r"
+DEFAULT_DESERIALIZE_MAX_DEPTH = 32
+DEFAULT_DESERIALIZE_MAX_SIZE = 1024 * 1024  # event hub messages are at most 1MB
+
+
+def deserialize_nested_json(
+    item: Any,
+    max_depth: int = DEFAULT_DESERIALIZE_MAX_DEPTH,
+    max_size: int = DEFAULT_DESERIALIZE_MAX_SIZE,
+) -> Any:
+    """Recursively deserialize JSON nested in strings, with the same result as recursively_deserialize
+    Only strings which could be JSON are passed to json.loads: a check of the first
+    non-whitespace character skips the failed parse attempt on ordinary text.
+    Bytes are parsed directly rather than being decoded to a string first.
+    @param item: the item to deserialize (str, bytes, dict, list or tuple; anything else is returned as is)
+    @param max_depth: the maximum nesting of containers and encoded strings
+    @param max_size: the maximum length of a string or bytes to attempt to decode
+    @return: the deserialized item
+    @throws: ValueError if the item is nested deeper than max_depth or a string is longer than max_size
+    """
+    return deserialize_nested_json_at_depth(item, max_depth, max_size, 0)
+
+
+def deserialize_nested_json_at_depth(
+    item: Any, max_depth: int, max_size: int, depth: int
+) -> Any:
+    """Worker for deserialize_nested_json which tracks the current depth
+    @param item: the item to deserialize
+    @param max_depth: the maximum nesting of containers and encoded strings
+    @param max_size: the maximum length of a string or bytes to attempt to decode
+    @param depth: the nesting depth of item
+    @return: the deserialized item
+    @throws: ValueError if max_depth or max_size is exceeded
+    """
+    if depth > max_depth:
+        raise ValueError(f"Exceeded maximum depth of {max_depth} while deserializing")
+    if isinstance(item, dict):
+        return {
+            key: deserialize_nested_json_at_depth(value, max_depth, max_size, depth + 1)
+            for key, value in item.items()
+        }
+    if isinstance(item, (list, tuple)):
+        return [
+            deserialize_nested_json_at_depth(value, max_depth, max_size, depth + 1)
+            for value in item
+        ]
+    if isinstance(item, (bytes, bytearray)):
+        if len(item) > max_size:
+            raise ValueError(f"Exceeded maximum size of {max_size} while deserializing")
+        try:
+            # json.loads detects the encoding and decodes bytes as it parses
+            deserialized_item = json.loads(item)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            try:
+                return item.decode("utf-8")
+            except UnicodeDecodeError:
+                # not text, so leave it as it is, as with any other value which is not JSON
+                return item
+        return deserialize_nested_json_at_depth(
+            deserialized_item, max_depth, max_size, depth + 1
+        )
+    if not isinstance(item, str):
+        return item
+    first_character = item.lstrip(JSON_WHITESPACE)[:1]
+    if first_character not in JSON_FIRST_CHARACTERS:
+        return item
+    if len(item) > max_size:
+        raise ValueError(f"Exceeded maximum size of {max_size} while deserializing")
+    try:
+        deserialized_item = json.loads(item)
+    except json.JSONDecodeError:
+        return item
+    return deserialize_nested_json_at_depth(
+        deserialized_item, max_depth, max_size, depth + 1
+    )
@@ -0,0 +1,123 @@
+"""Lag from EventHub enqueue to each stage of the pipeline
+
+The converters copy the enqueue time of the event each record came from into the record, as
+"enqueued_time", so timeseries_to_timescale measures the lag from the original enqueue rather
+than from the event hub between the two functions. Each stage logs the lag percentiles per
+publisher and partition at the end of the invocation, and feeds them to instrumentation.
+"""
+
+import datetime
+import json
+import logging
+import math
+from typing import Any, Dict, List, Optional, Tuple
+
+from azure.functions import EventHubEvent
+from dateutil import parser
+
+from .instrumentation import observe
+
+ENQUEUED_TIME_FIELD = "enqueued_time"
+PERCENTILES = (50, 95, 99)
+
+
+def to_utc(value: datetime.datetime) -> datetime.datetime:
+    """Enqueue times without a timezone are UTC"""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc)
+
+
+def format_enqueued_time(value: datetime.datetime) -> str:
+    return to_utc(value).isoformat(timespec="microseconds").replace("+00:00", "Z")
+
+
+def parse_enqueued_time(value: Any) -> Optional[datetime.datetime]:
+    """@return: the enqueue time, or None if value is not a timestamp"""
+    if isinstance(value, datetime.datetime):
+        return to_utc(value)
+    if isinstance(value, str):
+        try:
+            return to_utc(parser.isoparse(value))
+        except ValueError:
+            return None
+    return None
+
+
+def stamp_records(records: List[Any], event: Any) -> Optional[datetime.datetime]:
+    """Copy the enqueue time of an event into each record converted from it
+    @param records: the records, of which only dicts are stamped
+    @param event: the event the records were converted from
+    @return: the enqueue time, or None if the event does not have one
+    """
+    enqueued_time = getattr(event, "enqueued_time", None)
+    if not isinstance(enqueued_time, datetime.datetime):
+        return None
+    stamp = format_enqueued_time(enqueued_time)
+    for record in records:
+        if isinstance(record, dict):
+            record[ENQUEUED_TIME_FIELD] = stamp
+    return enqueued_time
+
+
+def get_partition_id(event: EventHubEvent) -> str:
+    """@return: the EventHub partition the event was read from, if the host says"""
+    metadata = getattr(event, "metadata", None)
+    context = metadata.get("PartitionContext") if isinstance(metadata, dict) else None
+    if isinstance(context, dict) and context.get("PartitionId") is not None:
+        return str(context["PartitionId"])
+    partition_key = getattr(event, "partition_key", None)
+    return partition_key if isinstance(partition_key, str) else ""
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    """Nearest-rank percentile of already sorted values"""
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+class LagTracker:
+    """Lags from enqueue to one stage, for one invocation
+
+    Records are added as they pass through the stage, and their lag is taken when complete() is
+    called once the stage has finished with them, e.g. after the output binding is set or the
+    transaction commits.
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.pending: List[Tuple[datetime.datetime, str, str]] = []
+        self.lags: Dict[Tuple[str, str], List[float]] = {}
+
+    def add(self, enqueued_time: Any, publisher: str, partition: str) -> None:
+        if (parsed := parse_enqueued_time(enqueued_time)) is not None:
+            self.pending.append((parsed, publisher, partition))
+
+    def discard(self) -> None:
+        self.pending.clear()
+
+    def complete(self, now: Optional[datetime.datetime] = None) -> None:
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        for enqueued_time, publisher, partition in self.pending:
+            lag_ms = (now - enqueued_time).total_seconds() * 1000
+            self.lags.setdefault((publisher, partition), []).append(lag_ms)
+            observe(f"lag_to_{self.stage}", lag_ms, publisher)
+        self.pending.clear()
+
+    def summarise(self) -> List[Dict[str, Any]]:
+        summary = []
+        for (publisher, partition), lags in self.lags.items():
+            lags = sorted(lags)
+            summary.append(
+                {"publisher": publisher, "partition": partition, "count": len(lags)}
+                | {f"p{p}_ms": round(percentile(lags, p), 3) for p in PERCENTILES}
+                | {"max_ms": round(lags[-1], 3)}
+            )
+        return summary
+
+    def log(self) -> None:
+        if self.lags:
+            logging.info(
+                "ingest_lag: "
+                + json.dumps({"stage": self.stage, "lags": self.summarise()})
+            )
@@ -0,0 +1,205 @@
+"""Per-stage timings and counters for the hot path of each function
+
+Disabled unless INSTRUMENTATION is set to "log", in which case each invocation ends with one
+structured log record holding a histogram per stage and publisher, and every counter. The
+histograms and counters follow the OpenTelemetry data model (explicit bucket histogram and
+monotonic sum data points), so a collector can turn them into metrics without reshaping.
+
+The metrics of an invocation are held in a context variable, so invocations running at the
+same time on other threads of the worker each record into their own. The record holds the
+Functions invocation id, which profiled() takes from the context of main, to match it to the
+host's logs. When disabled, timed()
+returns a shared no-op context manager and count() returns at once, so the instrumented code
+pays for a function call and a context variable lookup.
+"""
+
+import bisect
+import contextvars
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+# bucket upper bounds in milliseconds, from 10us to 10s
+HISTOGRAM_BOUNDARIES_MS: Tuple[float, ...] = (
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    25,
+    50,
+    100,
+    250,
+    500,
+    1000,
+    2500,
+    5000,
+    10000,
+)
+EXPORTERS = {"log"}
+
+
+class Histogram:
+    __slots__ = ("bucket_counts", "count", "sum", "min", "max")
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(HISTOGRAM_BOUNDARIES_MS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def record(self, value: float) -> None:
+        self.bucket_counts[bisect.bisect_left(HISTOGRAM_BOUNDARIES_MS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "explicit_bounds": list(HISTOGRAM_BOUNDARIES_MS),
+            "bucket_counts": self.bucket_counts,
+        }
+
+
+class Metrics:
+    """The histograms and counters of one invocation, keyed on (name, publisher)"""
+
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.counters: Dict[Tuple[str, str], int] = {}
+
+    def record(self, name: str, publisher: str, value: float) -> None:
+        key = (name, publisher)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.record(value)
+
+    def increment(self, name: str, publisher: str, amount: int = 1) -> None:
+        key = (name, publisher)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def to_dict(self) -> Dict[str, List[Dict[str, Any]]]:
+        return {
+            "histograms": [
+                {"name": name, "unit": "ms", "attributes": {"publisher": publisher}}
+                | histogram.to_dict()
+                for (name, publisher), histogram in self.histograms.items()
+            ],
+            "counters": [
+                {"name": name, "attributes": {"publisher": publisher}, "value": value}
+                for (name, publisher), value in self.counters.items()
+            ],
+        }
+
+
+class StageTimer:
+    __slots__ = ("metrics", "name", "publisher", "start")
+
+    def __init__(self, metrics: Metrics, name: str, publisher: str):
+        self.metrics = metrics
+        self.name = name
+        self.publisher = publisher
+
+    def __enter__(self) -> "StageTimer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.metrics.record(
+            self.name, self.publisher, (time.perf_counter() - self.start) * 1000
+        )
+
+
+# the metrics of the invocation running in this context, or None when instrumentation is disabled
+current_metrics: contextvars.ContextVar[Optional[Metrics]] = contextvars.ContextVar(
+    "instrumentation_metrics", default=None
+)
+# the Functions invocation id of the invocation running in this context, set by profiled()
+current_invocation_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "instrumentation_invocation_id", default=None
+)
+NO_TIMER = nullcontext()
+
+
+def timed(stage: str, publisher: str = "") -> ContextManager:
+    """Time a stage of the hot path, if instrumentation is enabled
+    @param stage: the stage, e.g. "decode" or "db_execute"
+    @param publisher: the publisher of the message being processed, if known
+    @return: a context manager timing its body
+    """
+    metrics = current_metrics.get()
+    if metrics is None:
+        return NO_TIMER
+    return StageTimer(metrics, stage, publisher)
+
+
+def count(counter: str, publisher: str = "", amount: int = 1) -> None:
+    """Add to a counter, if instrumentation is enabled
+    @param counter: the counter, e.g. "events" or "records"
+    @param publisher: the publisher the counter is for, if known
+    @param amount: how much to add
+    """
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.increment(counter, publisher, amount)
+
+
+def observe(name: str, value_ms: float, publisher: str = "") -> None:
+    """Record a value in milliseconds which is not the duration of a stage, if instrumentation is enabled
+    @param name: the histogram to record in
+    @param value_ms: the value, in milliseconds
+    @param publisher: the publisher the value is for, if known
+    """  # noqa: E501
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.record(name, publisher, value_ms)
+
+
+@contextmanager
+def instrumented_invocation(function_name: str) -> Iterator[None]:
+    """Collect the timings and counters of one invocation, and export them when it ends
+
+    Environment variables used:
+        INSTRUMENTATION: "log" to export each invocation as a structured log record. Unset or empty to disable.
+            Any other value is logged as a warning and disables instrumentation.
+
+    @param function_name: the function being invoked, added to the exported record
+    """  # noqa: E501
+    exporter = (os.environ.get("INSTRUMENTATION") or "").lower()
+    if exporter and exporter not in EXPORTERS:
+        logging.warning(
+            f"instrumentation: Unknown INSTRUMENTATION {exporter}, instrumentation is disabled"
+        )
+        exporter = ""
+    metrics = Metrics() if exporter else None
+    token = current_metrics.set(metrics)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current_metrics.reset(token)
+        if metrics is not None:
+            metrics.record("invocation", "", (time.perf_counter() - start) * 1000)
+            export_metrics(function_name, metrics)
+
+
+def export_metrics(function_name: str, metrics: Metrics) -> None:
+    record: Dict[str, Any] = {"function": function_name}
+    if invocation_id := current_invocation_id.get():
+        record["invocation_id"] = invocation_id
+    logging.info("instrumentation: " + json.dumps(record | metrics.to_dict()))
@@ -1,33 +1,174 @@
+import atexit
 import json
 import logging
-from typing import Any, List, Iterator
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterable, List, Iterator
 from shared_code.glow import glow_to_timescale
 from shared_code.homie import homie_to_timescale
 from shared_code.emon import emon_to_timescale
+from shared_code.ingest_lag import LagTracker, get_partition_id, stamp_records
+from shared_code.instrumentation import count, instrumented_invocation, timed
+from shared_code.structured_log import log_event, log_sampled, truncate
 
 
 # from shared_code import glow_to_timescale, homie_to_timescale, emon_to_timescale
 import azure.functions as func
 
+DEFAULT_PARALLEL_THRESHOLD = 256
+
+# persistent pool for parallel conversion, created on first use
+process_pool: ProcessPoolExecutor | None = None
+process_pool_workers = 0
+
 
 def convert_json_to_timeseries(
     events: List[func.EventHubEvent | str] | func.EventHubEvent | str,
     outputEventHubMessage: func.Out[List[str]],
 ) -> None:
-    array_of_events_as_strings = [get_event_as_str(event) for event in to_list(events)]
+    # when converting serially each stage is a generator, so only one event is decoded and
+    # converted at a time and the only list built is the serialised output for the binding.
+    # The process pool path converts the whole batch into a list first, then streams from it
+    with instrumented_invocation("json_to_timeseries"):
+        events = to_list(events)
+        event_strings = (get_event_as_str(event) for event in events)
+        if workers := get_parallel_workers(len(events)):
+            # stages run in the worker processes are not timed
+            converted_events = convert_events_in_parallel(event_strings, workers)
+        else:
+            converted_events = (convert_event(event) for event in event_strings)
+        lag_tracker = LagTracker("converter_output")
+        converted_events = stamp_enqueued_times(converted_events, events, lag_tracker)
+        send_messages(flatten_converted_events(converted_events), outputEventHubMessage)
+        lag_tracker.complete()
+        lag_tracker.log()
+
+
+def get_parallel_workers(batch_size: int) -> int:
+    """Get the number of worker processes to convert a batch with
+    Parallel conversion is opt-in: set JSON_CONVERTER_WORKERS to the number of processes.
+    Batches smaller than JSON_CONVERTER_PARALLEL_THRESHOLD (default 256) stay serial.
+    @param batch_size: the number of events in the batch
+    @return: the number of workers, or 0 to convert serially
+    @throws: ValueError if either environment variable is not an integer
+    """
+    workers = int(os.environ.get("JSON_CONVERTER_WORKERS") or 0)
+    threshold = int(
+        os.environ.get("JSON_CONVERTER_PARALLEL_THRESHOLD")
+        or DEFAULT_PARALLEL_THRESHOLD
+    )
+    if workers < 1 or batch_size < threshold:
+        return 0
+    return workers
+
+
+def get_process_pool(workers: int) -> ProcessPoolExecutor:
+    """Get the process pool, which persists between invocations on the same worker
+    @param workers: the number of worker processes
+    @return: the process pool
+    """
+    global process_pool, process_pool_workers
+    if process_pool is None or process_pool_workers != workers:
+        shutdown_process_pool()
+        # spawn rather than fork: the functions host process is multithreaded
+        process_pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        process_pool_workers = workers
+    return process_pool
+
+
+def shutdown_process_pool() -> None:
+    """Shut down the process pool, if one has been started"""
+    global process_pool, process_pool_workers
+    if process_pool is not None:
+        process_pool.shutdown(wait=False, cancel_futures=True)
+    process_pool = None
+    process_pool_workers = 0
+
+
+atexit.register(shutdown_process_pool)
+
 
-    # Apply convert_event to each element
-    converted_events = [convert_event(event) for event in array_of_events_as_strings]
+def warm_up_worker() -> int:
+    """Run in each worker process by warm_up_process_pool, which imports the converters there"""
+    return os.getpid()
 
-    # Flatten, handle single dict returns, and filter out None values
-    messages = [
-        event
-        for sublist in converted_events
-        if sublist is not None
-        for event in (sublist if isinstance(sublist, list) else [sublist])
-    ]
 
-    send_messages(messages, outputEventHubMessage)
+def warm_up_process_pool() -> None:
+    """Start the worker processes now, if parallel conversion is enabled, rather than on the first large batch"""  # noqa: E501
+    workers = int(os.environ.get("JSON_CONVERTER_WORKERS") or 0)
+    if workers < 1:
+        return
+    pool = get_process_pool(workers)
+    # as many tasks as workers, submitted together, so the pool starts every process
+    for future in [pool.submit(warm_up_worker) for _ in range(workers)]:
+        future.result()
+
+
+def convert_events_in_parallel(
+    event_strings: Iterable[str], workers: int
+) -> List[List[dict[str, Any]] | None]:
+    """Convert events across a pool of worker processes
+    Results are returned in the same order as the events. convert_event handles errors for
+    each event, so a bad event only loses its own output. If the pool itself breaks, the
+    batch is converted serially instead.
+    @param event_strings: the events as strings
+    @param workers: the number of worker processes
+    @return: the output of convert_event for each event
+    """
+    event_strings = list(event_strings)
+    # a few chunks per worker balances the load without pickling every event separately
+    chunksize = max(1, len(event_strings) // (workers * 4))
+    try:
+        pool = get_process_pool(workers)
+        return list(pool.map(convert_event, event_strings, chunksize=chunksize))
+    except BrokenProcessPool as e:
+        logging.error(f"json_converter: process pool failed, converting serially: {e}")
+        shutdown_process_pool()
+        return [convert_event(event) for event in event_strings]
+
+
+def stamp_enqueued_times(
+    converted_events: Iterable[List[dict[str, Any]] | dict[str, Any] | None],
+    events: List[func.EventHubEvent | str],
+    lag_tracker: LagTracker,
+) -> Iterator[List[dict[str, Any]] | dict[str, Any] | None]:
+    """Copy the enqueue time of each event into the records converted from it
+    @param converted_events: the output of convert_event for each event, in the same order as events
+    @param events: the events, of which only EventHubEvents have an enqueue time
+    @param lag_tracker: where to add each event with records, to measure its lag
+    @return: an iterator over the converted events
+    """
+    for converted, event in zip(converted_events, events):
+        records = converted if isinstance(converted, list) else [converted]
+        if converted and (enqueued_time := stamp_records(records, event)):
+            first = records[0]
+            publisher = (
+                first.get("measurement_publisher", "")
+                if isinstance(first, dict)
+                else ""
+            )
+            lag_tracker.add(enqueued_time, publisher, get_partition_id(event))
+        yield converted
+
+
+def flatten_converted_events(
+    converted_events: Iterable[List[dict[str, Any]] | dict[str, Any] | None]
+) -> Iterator[dict[str, Any]]:
+    """Flatten the converted events, handling single dict returns and skipping None values
+    @param converted_events: the output of convert_event for each event
+    @return: an iterator over the individual messages
+    """
+    for sublist in converted_events:
+        if sublist is None:
+            continue
+        if isinstance(sublist, list):
+            yield from sublist
+        else:
+            yield sublist
 
 
 def to_list(events):
@@ -58,14 +199,23 @@ def get_event_as_str(event):
 
 def convert_event(event_str):
     try:
-        o_messagebody = json.loads(event_str)
-        topic, publisher = extract_topic(o_messagebody)
-        payload = send_to_converter(publisher, o_messagebody, topic)
-        logging.debug(f"Parsed payload: {payload}")
+        with timed("decode"):
+            o_messagebody = json.loads(event_str)
+        with timed("topic_extract"):
+            topic, publisher = extract_topic(o_messagebody)
+        with timed("convert", publisher):
+            payload = send_to_converter(publisher, o_messagebody, topic)
+        count("events", publisher)
+        log_sampled(
+            logging.DEBUG, "json_converter.parsed_payload", topic=topic, payload=payload
+        )
         return payload if payload else None
     except Exception as e:
+        count("conversion_errors")
         logging.error(f"json_converter.convert_event: Error in event conversion: {e}")
-        logging.error(f"json_converter.convert_event: Event: {str(event_str)}")
+        logging.error(
+            f"json_converter.convert_event: Event: {truncate(str(event_str))}"
+        )
         return None
 
 
@@ -73,32 +223,51 @@ def send_messages(
     messages: Iterator[Any], outputEventHubMessage: func.Out[List[str]]
 ) -> None:
     payload_to_send = []
-    correlation_ids = []
+    # a dict rather than a set, to keep the ids in the order they were first seen
+    correlation_ids: Dict[str, None] = {}
+    records_by_publisher: Dict[str, int] = {}
+    failed = 0
     for message in messages:
         try:
-            # add correlation id to correlation_ids only if it doesnt already exist
             if isinstance(message, dict) and "correlation_id" in message:
                 message_correlation_id = message.get("correlation_id")
-                if (
-                    message_correlation_id
-                    and message_correlation_id not in correlation_ids
-                ):
-                    correlation_ids.append(message_correlation_id)
-            payload = json.dumps(message)
+                if message_correlation_id:
+                    correlation_ids[message_correlation_id] = None
+            publisher = (
+                message.get("measurement_publisher", "")
+                if isinstance(message, dict)
+                else ""
+            )
+            with timed("serialise", publisher):
+                payload = json.dumps(message)
             payload_to_send.append(payload)
+            records_by_publisher[publisher] = records_by_publisher.get(publisher, 0) + 1
+            count("records", publisher)
         except (json.JSONDecodeError, ValueError, TypeError):
-            logging.error(f"json_converter: Error serializing message: {message}")
+            failed += 1
+            logging.error(
+                f"json_converter: Error serializing message: {truncate(str(message))}"
+            )
         except Exception as e:
+            failed += 1
             logging.error(f"json_converter: Error sending message: {e}")
     try:
         if payload_to_send:
-            outputEventHubMessage.set(payload_to_send)
-        logging.info(
-            f"json_converter: Sent {len(payload_to_send)} messages with correlation ids: {correlation_ids}"
+            with timed("output_set"):
+                outputEventHubMessage.set(payload_to_send)
+        log_event(
+            logging.INFO,
+            "json_converter.sent",
+            messages=len(payload_to_send),
+            failed=failed,
+            records_by_publisher=records_by_publisher,
+            correlation_id_count=len(correlation_ids),
+            correlation_ids=lambda: list(correlation_ids),
         )
     except Exception as e:
         logging.error(
-            f"json_converter: Error setting outputEventHubMessage for correlation ids '{correlation_ids}': {e}"
+            f"json_converter: Error setting outputEventHubMessage for {len(correlation_ids)} correlation ids "
+            f"'{truncate(str(list(correlation_ids)))}': {e}"
         )
 
 
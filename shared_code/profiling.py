@@ -0,0 +1,294 @@
+"""On-demand profiling of function invocations
+
+Disabled unless PROFILE_MODE is set. One in PROFILE_SAMPLE_RATE invocations of a function wrapped
+with profiled() is then profiled, and the profile is written to PROFILE_DIR as
+<function>.<invocation id>.<kind>, where kind is one of:
+    prof: a cProfile dump, readable with pstats (PROFILE_MODE=cprofile)
+    stacks: the stacks seen by the sampling profiler, in collapsed form as used by flamegraph.pl
+        (PROFILE_MODE=sample)
+    tracemalloc: a tracemalloc snapshot taken at the end of the invocation (PROFILE_TRACEMALLOC=true)
+
+The invocation id is the one the Functions host logs the invocation under, taken from the context
+argument of main, so a profile can be matched to the invocation's logs and instrumentation record.
+
+tracemalloc traces the whole process, so a snapshot also holds whatever other invocations running
+on the worker at the same time allocated. Only one invocation traces at once: another invocation
+which starts while it is tracing is not traced.
+
+PROFILE_DIR defaults to a directory under the temp directory, which is local to each worker; point
+it at an Azure Files share mounted into the function app to collect profiles from every worker.
+
+Summarise the profiles in a directory with:
+    python -m shared_code.profiling DIR [--function NAME] [--top N]
+"""
+
+import argparse
+import cProfile
+import datetime
+import functools
+import glob
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .instrumentation import current_invocation_id
+
+MODES = {"cprofile", "sample"}
+DEFAULT_INTERVAL_MS = 5.0
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread from a background thread
+
+    The profiled thread is not interrupted, so the overhead is the cost of walking its stack at
+    each interval, unlike cProfile which hooks every call and return.
+    """
+
+    def __init__(self, interval_ms: float = DEFAULT_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.stacks: Counter = Counter()
+        self.thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        self.sampler.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.sampler.join()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[get_stack(frame)] += 1
+
+    def dump(self, path: str) -> None:
+        with open(path, "w") as f:
+            for stack, samples in self.stacks.most_common():
+                f.write(f"{stack} {samples}\n")
+
+
+def get_stack(frame: Any) -> str:
+    """@return: the stack of frame, outermost first, as a collapsed stack"""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+        )
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+def get_profile_dir() -> str:
+    return os.environ.get("PROFILE_DIR") or os.path.join(
+        tempfile.gettempdir(), "profiles"
+    )
+
+
+def should_profile() -> bool:
+    """Decide whether to profile this invocation
+
+    Environment variables used:
+        PROFILE_MODE: "cprofile" for deterministic profiles, "sample" for low overhead sampled stacks. Unset or empty to disable.
+        PROFILE_TRACEMALLOC: If true, also take a tracemalloc snapshot. Works with or without PROFILE_MODE.
+        PROFILE_SAMPLE_RATE: Profile one in this many invocations, at random. Defaults to 1, every invocation.
+
+    @return: True to profile this invocation
+    @raises ValueError: if PROFILE_MODE is not a known mode or PROFILE_SAMPLE_RATE is not a positive integer
+    """  # noqa: E501
+    mode = get_mode()
+    if not mode and not is_tracemalloc_enabled():
+        return False
+    sample_rate = int(os.environ.get("PROFILE_SAMPLE_RATE") or 1)
+    if sample_rate < 1:
+        raise ValueError(f"PROFILE_SAMPLE_RATE must be at least 1: {sample_rate}")
+    return random.randrange(sample_rate) == 0
+
+
+def get_mode() -> str:
+    mode = (os.environ.get("PROFILE_MODE") or "").lower()
+    if mode and mode not in MODES:
+        raise ValueError(f"Unknown PROFILE_MODE: {mode}")
+    return mode
+
+
+def is_tracemalloc_enabled() -> bool:
+    return os.environ.get("PROFILE_TRACEMALLOC", "").lower() in {"1", "true", "yes"}
+
+
+def create_invocation_id() -> str:
+    """@return: an id which sorts profiles by when they were taken, for when main has no context"""
+    started = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S")
+    return f"{started}-{uuid.uuid4().hex[:8]}"
+
+
+def profiled(function_name: str) -> Callable[[Callable], Callable]:
+    """Profile a function entry point when PROFILE_MODE or PROFILE_TRACEMALLOC is set
+    @param function_name: the function, used to name its profiles
+    @return: a decorator for main, which should take the func.Context as its context argument
+    """
+
+    def decorator(main: Callable) -> Callable:
+        @functools.wraps(main)
+        def wrapper(*args, **kwargs):
+            invocation_id = getattr(kwargs.get("context"), "invocation_id", None)
+            token = current_invocation_id.set(invocation_id)
+            try:
+                if not should_profile():
+                    return main(*args, **kwargs)
+                with profile_invocation(
+                    function_name, invocation_id or create_invocation_id()
+                ):
+                    return main(*args, **kwargs)
+            finally:
+                current_invocation_id.reset(token)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def profile_invocation(function_name: str, invocation_id: str) -> Iterator[None]:
+    """Profile the body, and write its profiles when it ends, even if it raises
+    @param function_name: the function being invoked
+    @param invocation_id: the id of the invocation, to tell its profiles apart
+    """
+    prefix = os.path.join(get_profile_dir(), f"{function_name}.{invocation_id}")
+    mode = get_mode()
+    trace_memory = is_tracemalloc_enabled()
+    if trace_memory and tracemalloc.is_tracing():
+        # another invocation (or a benchmark) is tracing, and there is only one tracer per process
+        logging.warning(
+            f"Not tracing memory for {function_name}.{invocation_id}, tracemalloc is already tracing"
+        )
+        trace_memory = False
+    profiler: Optional[cProfile.Profile] = None
+    sampler: Optional[SamplingProfiler] = None
+    if trace_memory:
+        tracemalloc.start()
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif mode == "sample":
+        sampler = SamplingProfiler(
+            float(os.environ.get("PROFILE_INTERVAL_MS") or DEFAULT_INTERVAL_MS)
+        )
+        sampler.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if profiler is not None:
+            profiler.disable()
+        if sampler is not None:
+            sampler.stop()
+        snapshot = tracemalloc.take_snapshot() if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+        write_profiles(prefix, profiler, sampler, snapshot)
+        logging.info(f"Profiled invocation in {elapsed_ms:.1f}ms: {prefix}")
+
+
+def write_profiles(
+    prefix: str,
+    profiler: Optional[cProfile.Profile],
+    sampler: Optional[SamplingProfiler],
+    snapshot: Optional[tracemalloc.Snapshot],
+) -> None:
+    try:
+        os.makedirs(os.path.dirname(prefix), exist_ok=True)
+        if profiler is not None:
+            profiler.dump_stats(f"{prefix}.prof")
+        if sampler is not None:
+            sampler.dump(f"{prefix}.stacks")
+        if snapshot is not None:
+            snapshot.dump(f"{prefix}.tracemalloc")
+    except OSError as e:
+        # losing a profile must not fail the invocation
+        logging.error(f"Failed to write profile {prefix}: {e}")
+
+
+def find_profiles(directory: str, function_name: str, kind: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(directory, f"{function_name}.*.{kind}")))
+
+
+def summarise_stacks(paths: List[str]) -> Tuple[int, Dict[str, int], Dict[str, int]]:
+    """Add up the samples in collapsed stack files
+    @return: the number of samples, and the samples in which each frame was running (self) and
+        on the stack (total)
+    """
+    samples = 0
+    self_samples: Counter = Counter()
+    total_samples: Counter = Counter()
+    for path in paths:
+        with open(path, "r") as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                frames = stack.split(";")
+                samples += int(count)
+                self_samples[frames[-1]] += int(count)
+                for frame in set(frames):
+                    total_samples[frame] += int(count)
+    return samples, self_samples, total_samples
+
+
+def summarise_memory(paths: List[str]) -> Counter:
+    """@return: the bytes still allocated at the end of the invocations, by line"""
+    sizes: Counter = Counter()
+    for path in paths:
+        for stat in tracemalloc.Snapshot.load(path).statistics("lineno"):
+            frame = stat.traceback[0]
+            sizes[f"{frame.filename}:{frame.lineno}"] += stat.size
+    return sizes
+
+
+def report(directory: str, function_name: str = "*", top: int = 20) -> Iterator[str]:
+    """Yield the lines of a hotspot report on the profiles in a directory"""
+    if paths := find_profiles(directory, function_name, "prof"):
+        # only the report reads profiles, so the function entry points do not import pstats
+        import pstats
+
+        yield f"== cProfile: {len(paths)} invocations, by own time"
+        stats = pstats.Stats(*paths)
+        width = max(len(f"{func[2]} ({func[0]}:{func[1]})") for func in stats.stats)
+        for func, (_, calls, own, cumulative, _) in sorted(
+            stats.stats.items(), key=lambda item: item[1][2], reverse=True
+        )[:top]:
+            name = f"{func[2]} ({func[0]}:{func[1]})"
+            yield f"{own * 1000:>12.1f}ms own {cumulative * 1000:>12.1f}ms cum {calls:>10} calls  {name:<{width}}"  # noqa: E501
+    if paths := find_profiles(directory, function_name, "stacks"):
+        samples, self_samples, total_samples = summarise_stacks(paths)
+        yield f"== sampled: {len(paths)} invocations, {samples} samples, by own samples"
+        for frame, own in self_samples.most_common(top):
+            yield f"{own / samples:>7.1%} own {total_samples[frame] / samples:>7.1%} total  {frame}"  # noqa: E501
+    if paths := find_profiles(directory, function_name, "tracemalloc"):
+        sizes = summarise_memory(paths)
+        yield f"== tracemalloc: {len(paths)} invocations, by bytes allocated at the end"
+        for line, size in sizes.most_common(top):
+            yield f"{size / len(paths) / 1024:>12.1f}KiB per invocation  {line}"
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Summarise the profiles written by profiled() into a hotspot report"
+    )
+    arg_parser.add_argument("directory", nargs="?", default=get_profile_dir())
+    arg_parser.add_argument("--function", default="*", help="e.g. json_to_timeseries")
+    arg_parser.add_argument("--top", type=int, default=20)
+    args = arg_parser.parse_args()
+    lines = list(report(args.directory, args.function, args.top))
+    print("\n".join(lines) if lines else f"No profiles in {args.directory}")
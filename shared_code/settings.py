@@ -0,0 +1,86 @@
+"""The environment, and the database settings read from it once per worker
+
+The .env file (or .env.vault, when DOTENV_KEY is set) is loaded into the environment once per
+worker, when shared_code is imported, before any module reads a setting. The Postgres settings
+and TABLE_NAME are then read and validated once and shared by every module; tests which change
+the environment call reload_settings() to read them again. The other settings (dedupe, BMW,
+logging, profiling and warm-up) are read from os.environ by the modules which use them.
+"""
+
+import os
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+POSTGRES_VARIABLES = (
+    "POSTGRES_DB",
+    "POSTGRES_USER",
+    "POSTGRES_PASSWORD",
+    "POSTGRES_HOST",
+    "POSTGRES_PORT",
+)
+
+
+@dataclass(frozen=True)
+class Settings:
+    """The database settings"""
+
+    postgres_db: Optional[str]
+    postgres_user: Optional[str]
+    postgres_password: Optional[str]
+    postgres_host: Optional[str]
+    postgres_port: Optional[str]
+    table_name: Optional[str]
+    # None unless every one of POSTGRES_VARIABLES is set
+    connection_string: Optional[str]
+    missing_postgres_variables: Tuple[str, ...]
+
+    @classmethod
+    def from_environment(cls) -> "Settings":
+        missing = tuple(name for name in POSTGRES_VARIABLES if name not in os.environ)
+        postgres = [os.environ.get(name) for name in POSTGRES_VARIABLES]
+        connection_string = None
+        if not missing:
+            db, user, password, host, port = postgres
+            connection_string = f"dbname={db} user={user} password={password} host={host} port={port}"  # noqa: E501
+        return cls(
+            *postgres,
+            table_name=os.environ.get("TABLE_NAME") or None,
+            connection_string=connection_string,
+            missing_postgres_variables=missing,
+        )
+
+
+environment_loaded = False
+settings: Optional[Settings] = None
+
+
+def load_environment() -> None:
+    """Load .env into the environment, once per worker. As with dotenv_vault, its values win."""
+    global environment_loaded
+    if environment_loaded:
+        return
+    # imported here, as decrypting a vault pulls in cryptography
+    from dotenv_vault import load_dotenv
+
+    load_dotenv()
+    environment_loaded = True
+
+
+def get_settings() -> Settings:
+    """Get the settings, reading them from the environment on first use
+    @return: the settings shared by every module on this worker
+    """
+    global settings
+    if settings is None:
+        load_environment()
+        settings = Settings.from_environment()
+    return settings
+
+
+def reload_settings() -> Settings:
+    """Read the settings from the environment again, e.g. after a test has changed it
+    @return: the new settings
+    """
+    global settings
+    settings = None
+    return get_settings()
@@ -0,0 +1,100 @@
+"""Structured log records which cost nothing on the hot path when their level is disabled
+
+log_event() writes one record as "<event>: <json>", the same shape as the instrumentation,
+ingest_lag and warm_up records, so they can all be queried the same way. Nothing is formatted
+unless the level is enabled, and a field given as a callable is only called then. Each field is
+cut to LOG_MAX_FIELD_CHARS once serialised, so a large payload cannot flood the log.
+
+log_sampled() is for messages which would otherwise be written once per record: it writes the
+first of each event and then one in every LOG_SAMPLE_RATE, with how many it has seen.
+"""
+
+import json
+import logging
+import os
+from typing import Any, Dict, Optional
+
+DEFAULT_MAX_FIELD_CHARS = 1000
+DEFAULT_SAMPLE_RATE = 100
+
+# how many times each sampled event has been seen on this worker
+sample_counts: Dict[str, int] = {}
+# each setting is parsed the first time it is used on this worker
+positive_ints: Dict[str, int] = {}
+
+
+def get_positive_int(name: str, default: int) -> int:
+    """Read a setting which must be a positive integer, once per worker
+    @param name: the environment variable
+    @param default: used if it is unset, or is not a positive integer
+    @return: the setting
+    """
+    if name not in positive_ints:
+        value = os.environ.get(name)
+        try:
+            parsed = int(value or default)
+        except ValueError:
+            parsed = 0
+        if parsed < 1:
+            # logging must not fail, as it is how every other failure is reported
+            logging.warning(
+                f"Ignoring {name}={value!r}, which is not a positive integer; using {default}"
+            )
+            parsed = default
+        positive_ints[name] = parsed
+    return positive_ints[name]
+
+
+def truncate(value: str, max_chars: Optional[int] = None) -> str:
+    """Cut a string to a bounded length, saying how much was dropped
+    @param value: the string to cut
+    @param max_chars: the most characters to keep, defaults to LOG_MAX_FIELD_CHARS
+    @return: the string, or its first max_chars characters and a note of how many more there were
+    """  # noqa: E501
+    if max_chars is None:
+        max_chars = get_positive_int("LOG_MAX_FIELD_CHARS", DEFAULT_MAX_FIELD_CHARS)
+    if len(value) <= max_chars:
+        return value
+    return f"{value[:max_chars]}... ({len(value) - max_chars} more characters)"
+
+
+def format_field(value: Any, max_chars: int) -> Any:
+    if callable(value):
+        value = value()
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        return truncate(value, max_chars)
+    serialised = json.dumps(value, default=str)
+    # small values keep their structure in the record
+    return value if len(serialised) <= max_chars else truncate(serialised, max_chars)
+
+
+def log_event(level: int, event: str, **fields: Any) -> None:
+    """Write a structured log record, if the level is enabled
+    @param level: the logging level, e.g. logging.INFO
+    @param event: what happened, e.g. "json_converter.sent"
+    @param fields: the values to record. Callables are called only if the record is written
+    """
+    logger = logging.getLogger()
+    if not logger.isEnabledFor(level):
+        return
+    max_chars = get_positive_int("LOG_MAX_FIELD_CHARS", DEFAULT_MAX_FIELD_CHARS)
+    record = {name: format_field(value, max_chars) for name, value in fields.items()}
+    logger.log(level, f"{event}: " + json.dumps(record, default=str))
+
+
+def log_sampled(level: int, event: str, **fields: Any) -> None:
+    """Write a structured log record for one in every LOG_SAMPLE_RATE times an event happens
+    @param level: the logging level, e.g. logging.DEBUG
+    @param event: what happened, sampled separately from every other event
+    @param fields: the values to record, as for log_event
+    """
+    if not logging.getLogger().isEnabledFor(level):
+        return
+    seen = sample_counts.get(event, 0)
+    sample_counts[event] = seen + 1
+    sample_rate = get_positive_int("LOG_SAMPLE_RATE", DEFAULT_SAMPLE_RATE)
+    if seen % sample_rate:
+        return
+    log_event(level, event, sample_rate=sample_rate, seen=seen + 1, **fields)
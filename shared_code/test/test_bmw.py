@@ -1,30 +1,41 @@
+import asyncio
+import inspect
+import json
 import os
 import pytest
 
-from unittest.mock import MagicMock, patch, Mock, call
+from unittest.mock import AsyncMock, MagicMock, patch, Mock, call
 
+from bimmer_connected.account import MyBMWAccount
 from bimmer_connected.api.regions import Regions
+from bimmer_connected.models import MyBMWAPIError, MyBMWQuotaError
 from bimmer_connected.vehicle import MyBMWVehicle
 from bimmer_connected.utils import MyBMWJSONEncoder
 from shared_code.bmw import (
+    fetch_vehicles_by_vin,
     get_vehicle_by_vin,
     get_bmw_region_from_string,
     get_bmw_account,
     get_my_cars,
     serialise_car_data,
-    get_and_serialise_car_data,
+    project_car_data,
+    filter_unchanged_cars,
+    record_published,
+    publish_car_data,
 )
+from shared_code.bmw_poll_schedule import vehicle_poll_states
+from shared_code.bmw_to_timescale import construct_messages
+from test_utils.bmw_api_stand_in import BMWAPIStandIn
 
 
 # Mock MyBMWVehicle class
 class MockMyBMWVehicle:
     def __init__(self, vin):
         self.vin = vin
+        self.state_calls = 0
 
-
-# Mock asyncio.run
-async def mock_asyncio_run(coroutine):
-    return await coroutine
+    async def get_vehicle_state(self):
+        self.state_calls += 1
 
 
 # Test class
@@ -39,31 +50,108 @@ class TestGetVehicleByVIN:
         ]
         return account
 
-    @pytest.mark.asyncio
-    async def test_no_matching_vehicles(self, mock_account):
-        with patch("asyncio.run", new=mock_asyncio_run):
-            result = get_vehicle_by_vin(mock_account, ["999", "111"])
-            assert result is None
-
-    @pytest.mark.asyncio
-    async def test_single_matching_vehicle(self, mock_account):
-        with patch("asyncio.run", new=mock_asyncio_run):
-            result = get_vehicle_by_vin(mock_account, ["123"])
-            assert len(result) == 1
-            assert result[0].vin == "123"
-
-    @pytest.mark.asyncio
-    async def test_multiple_matching_vehicles(self, mock_account):
-        with patch("asyncio.run", new=mock_asyncio_run):
+    def test_no_matching_vehicles(self, mock_account):
+        result = get_vehicle_by_vin(mock_account, ["999", "111"])
+        assert result is None
+
+    def test_single_matching_vehicle(self, mock_account):
+        result = get_vehicle_by_vin(mock_account, ["123"])
+        assert len(result) == 1
+        assert result[0].vin == "123"
+
+    def test_multiple_matching_vehicles(self, mock_account):
+        result = get_vehicle_by_vin(mock_account, ["123", "789"])
+        assert len(result) == 2
+        assert [vehicle.vin for vehicle in result] == ["123", "789"]
+
+    def test_only_matching_vehicle_states_fetched(self, mock_account):
+        get_vehicle_by_vin(mock_account, ["123"])
+        assert [vehicle.state_calls for vehicle in mock_account.vehicles] == [1, 0, 0]
+
+    def test_failed_vehicles_are_logged_and_left_out(self, mock_account):
+        mock_account.vehicles[0].get_vehicle_state = AsyncMock(
+            side_effect=MyBMWAPIError("unavailable")
+        )
+        with patch("shared_code.bmw.logging") as mock_logging:
             result = get_vehicle_by_vin(mock_account, ["123", "789"])
-            assert len(result) == 2
-            assert [vehicle.vin for vehicle in result] == ["123", "789"]
+        assert [vehicle.vin for vehicle in result] == ["789"]
+        mock_logging.warning.assert_called_once_with(
+            "bmw: Could not fetch vehicle 123: MyBMWAPIError: unavailable"
+        )
 
-    @pytest.mark.asyncio
-    async def test_get_vehicles_called(self, mock_account):
-        with patch("asyncio.run", new=mock_asyncio_run):
-            get_vehicle_by_vin(mock_account, ["123"])
-            mock_account.get_vehicles.assert_called_once()
+
+class TestFetchVehiclesByVIN:
+    """Runs fetch_vehicles_by_vin against the offline stand-in for the MyBMW API"""
+
+    @pytest.fixture
+    def account(self):
+        return MyBMWAccount("user@example.com", "password", Regions.REST_OF_WORLD)
+
+    def fetch(self, stand_in, account, vins, **kwargs):
+        with stand_in.patch():
+            return asyncio.run(fetch_vehicles_by_vin(account, vins, **kwargs))
+
+    def test_private_vehicle_list_method_still_exists(self):
+        # fetch_vehicles_by_vin relies on it; see the bimmer-connected pin in pyproject.toml
+        assert hasattr(
+            MyBMWAccount, "_init_vehicles"
+        ), "MyBMWAccount._init_vehicles is gone: update fetch_vehicles_by_vin"
+        assert asyncio.iscoroutinefunction(MyBMWAccount._init_vehicles)
+        assert list(inspect.signature(MyBMWAccount._init_vehicles).parameters) == [
+            "self"
+        ]
+
+    def test_vehicle_list_fetched_when_account_is_empty(self, account):
+        stand_in = BMWAPIStandIn(vehicles=[{"vin": "VIN1"}, {"vin": "VIN2"}])
+        result = self.fetch(stand_in, account, ["VIN2", "VIN9"])
+        assert [vehicle.vin for vehicle in result.vehicles] == ["VIN2"]
+        assert result.errors == {"VIN9": "Not found on account"}
+        assert stand_in.vehicle_calls == 1
+        assert stand_in.state_calls == 1
+
+    def test_states_fetched_concurrently_within_limit(self, account):
+        vins = [f"VIN{i}" for i in range(6)]
+        stand_in = BMWAPIStandIn(
+            vehicles=[{"vin": vin} for vin in vins],
+            state_delays={vin: 0.05 for vin in vins},
+        )
+        result = self.fetch(stand_in, account, vins, max_concurrency=3)
+        assert [vehicle.vin for vehicle in result.vehicles] == vins
+        assert stand_in.max_concurrent_state_calls == 3
+
+    def test_slow_vehicle_times_out_without_holding_up_others(self, account):
+        stand_in = BMWAPIStandIn(
+            vehicles=[{"vin": "VIN1"}, {"vin": "VIN2"}], state_delays={"VIN1": 5}
+        )
+        result = self.fetch(stand_in, account, ["VIN1", "VIN2"], call_timeout=0.05)
+        assert [vehicle.vin for vehicle in result.vehicles] == ["VIN2"]
+        assert result.errors == {"VIN1": "Timed out after 0.05s"}
+
+    def test_overall_deadline_returns_partial_results(self, account):
+        stand_in = BMWAPIStandIn(
+            vehicles=[{"vin": "VIN1"}, {"vin": "VIN2"}, {"vin": "VIN3"}],
+            state_delays={"VIN1": 0, "VIN2": 5, "VIN3": 5},
+        )
+        result = self.fetch(
+            stand_in,
+            account,
+            ["VIN1", "VIN2", "VIN3"],
+            max_concurrency=1,
+            overall_timeout=0.1,
+        )
+        assert [vehicle.vin for vehicle in result.vehicles] == ["VIN1"]
+        assert result.errors == {
+            "VIN2": "Not fetched within 0.1s",
+            "VIN3": "Not fetched within 0.1s",
+        }
+
+    def test_auth_errors_are_raised(self, account):
+        stand_in = BMWAPIStandIn(
+            vehicles=[{"vin": "VIN1"}, {"vin": "VIN2"}],
+            state_errors={"VIN1": MyBMWQuotaError("quota")},
+        )
+        with pytest.raises(MyBMWQuotaError):
+            self.fetch(stand_in, account, ["VIN1", "VIN2"])
 
 
 class TestGetBMWRegionFromString:
@@ -139,6 +227,16 @@ class TestGetMyCars:
 
         assert result == mock_cars
 
+    def test_get_my_cars_fetches_given_vins(
+        self, mock_environ, mock_account, mock_cars
+    ):
+        with patch("shared_code.bmw.get_bmw_account", return_value=mock_account), patch(
+            "shared_code.bmw.get_vehicle_by_vin", return_value=mock_cars
+        ) as mock_get_vehicle_by_vin:
+            get_my_cars(["456"])
+
+        mock_get_vehicle_by_vin.assert_called_once_with(mock_account, ["456"])
+
     def test_get_my_cars_no_cars_found(self, mock_environ, mock_account):
         with patch("shared_code.bmw.get_bmw_account", return_value=mock_account), patch(
             "shared_code.bmw.get_vehicle_by_vin", return_value=None
@@ -179,9 +277,12 @@ class TestSerialiseCarData:
         assert mock_json_dumps.call_count == 2
         assert result == expected_json
 
-    def test_get_and_serialise_car_data(self):
+    def test_publish_car_data(self, monkeypatch):
+        monkeypatch.delenv("BMW_VINS", raising=False)
+        monkeypatch.delenv("BMW_PUBLISH_MODE", raising=False)
         mock_cars = [Mock(), Mock()]
         mock_serialised_data = ['{"attribute": "value1"}', '{"attribute": "value2"}']
+        mock_output = Mock()
 
         with patch("shared_code.bmw.get_my_cars") as mock_get_my_cars, patch(
             "shared_code.bmw.serialise_car_data"
@@ -191,9 +292,189 @@ class TestSerialiseCarData:
             mock_serialise_car_data.return_value = mock_serialised_data
 
             # Call function under test
-            result = get_and_serialise_car_data()
+            publish_car_data(mock_output)
 
             # Verify interactions and result
             mock_get_my_cars.assert_called_once()
             mock_serialise_car_data.assert_called_once_with(mock_cars)
-            assert result == mock_serialised_data
+            mock_output.set.assert_called_once_with(mock_serialised_data)
+
+
+def get_published() -> list:
+    """Run publish_car_data, as the bmw_update function does
+    @return: the messages set on the output binding, or [] if it was not set
+    """
+    output = Mock()
+    publish_car_data(output)
+    return output.set.call_args[0][0] if output.set.called else []
+
+
+def load_bmw_state() -> dict:
+    state_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "..",
+        "test",
+        "cleaned_bmw_api_state_data.json",
+    )
+    with open(state_path, "r") as f:
+        data = json.load(f)
+    return {"vin": "VIN1", **data}
+
+
+def make_car(vin: str, last_updated_at: str | None):
+    car = MagicMock(spec=MyBMWVehicle)
+    car.vin = vin
+    car.data = {"vin": vin, "state": {"lastUpdatedAt": last_updated_at}}
+    return car
+
+
+class TestProjectCarData:
+    def test_projection_contains_only_message_fields(self):
+        projected = project_car_data(load_bmw_state())
+        assert projected == {
+            "vin": "VIN1",
+            "state": {
+                "lastUpdatedAt": "2023-10-28T15:14:39Z",
+                "currentMileage": 2094,
+                "location": {
+                    "coordinates": {"latitude": 12.3456, "longitude": 34.5678}
+                },
+                "electricChargingState": {
+                    "chargingLevelPercent": 63,
+                    "range": 217,
+                    "isChargerConnected": False,
+                    "chargingStatus": "INVALID",
+                },
+            },
+        }
+
+    def test_projection_produces_the_same_records(self):
+        data = load_bmw_state()
+        projected = json.loads(json.dumps(project_car_data(data)))
+        assert construct_messages("VIN1", "ts", projected) == construct_messages(
+            "VIN1", "ts", data
+        )
+
+    def test_missing_fields_are_left_out(self):
+        assert project_car_data({"vin": "VIN1", "state": {"location": None}}) == {
+            "vin": "VIN1"
+        }
+
+    def test_include_raw(self):
+        data = load_bmw_state()
+        assert project_car_data(data, include_raw=True)["raw"] is data
+
+
+class TestFilterUnchangedCars:
+    @pytest.fixture(autouse=True)
+    def clear_published(self):
+        with patch.dict("shared_code.bmw.last_published_updated_at", clear=True):
+            yield
+
+    def test_unchanged_cars_are_skipped(self):
+        first = [make_car("A", "t1"), make_car("B", "t1")]
+        assert filter_unchanged_cars(first) == first
+        record_published(first)
+        second = [make_car("A", "t1"), make_car("B", "t2")]
+        assert filter_unchanged_cars(second) == [second[1]]
+        record_published([second[1]])
+        assert filter_unchanged_cars(second) == []
+
+    def test_nothing_recorded_until_published(self):
+        cars = [make_car("A", "t1")]
+        assert filter_unchanged_cars(cars) == cars
+        assert filter_unchanged_cars(cars) == cars
+
+    def test_cars_without_last_updated_at_are_kept(self):
+        cars = [make_car("A", None)]
+        assert filter_unchanged_cars(cars) == cars
+        assert filter_unchanged_cars(cars) == cars
+
+
+class TestPublishCarDataModes:
+    @pytest.fixture(autouse=True)
+    def clear_published(self):
+        with patch.dict(
+            "shared_code.bmw.last_published_updated_at", clear=True
+        ), patch.dict("shared_code.bmw_poll_schedule.vehicle_poll_states", clear=True):
+            yield
+
+    @pytest.fixture
+    def cars(self):
+        car = MagicMock(spec=MyBMWVehicle)
+        car.vin = "VIN1"
+        car.data = load_bmw_state()
+        return [car]
+
+    def test_projected_and_skip_unchanged(self, cars, monkeypatch):
+        monkeypatch.setenv("BMW_PUBLISH_MODE", "projected")
+        monkeypatch.setenv("BMW_SKIP_UNCHANGED", "true")
+        monkeypatch.delenv("BMW_RAW_ARCHIVE", raising=False)
+        output = Mock()
+        with patch("shared_code.bmw.get_my_cars", return_value=cars):
+            publish_car_data(output)
+            publish_car_data(output)
+        output.set.assert_called_once()
+        assert [json.loads(message) for message in output.set.call_args[0][0]] == [
+            project_car_data(cars[0].data)
+        ]
+
+    def test_not_recorded_as_published_when_output_fails(self, cars, monkeypatch):
+        monkeypatch.setenv("BMW_SKIP_UNCHANGED", "true")
+        monkeypatch.delenv("BMW_PUBLISH_MODE", raising=False)
+        monkeypatch.delenv("BMW_VINS", raising=False)
+        failing_output = Mock()
+        failing_output.set.side_effect = RuntimeError("binding failed")
+        output = Mock()
+        with patch("shared_code.bmw.get_my_cars", return_value=cars):
+            with pytest.raises(RuntimeError, match="binding failed"):
+                publish_car_data(failing_output)
+            publish_car_data(output)
+        output.set.assert_called_once_with(serialise_car_data(cars))
+
+    def test_raw_archive(self, cars, monkeypatch):
+        monkeypatch.setenv("BMW_PUBLISH_MODE", "projected")
+        monkeypatch.setenv("BMW_RAW_ARCHIVE", "1")
+        with patch("shared_code.bmw.get_my_cars", return_value=cars):
+            result = get_published()
+        assert json.loads(result[0])["raw"] == cars[0].data
+
+    def test_full_mode_is_default(self, cars, monkeypatch):
+        monkeypatch.delenv("BMW_PUBLISH_MODE", raising=False)
+        monkeypatch.delenv("BMW_SKIP_UNCHANGED", raising=False)
+        with patch("shared_code.bmw.get_my_cars", return_value=cars):
+            first = get_published()
+            second = get_published()
+        assert first == second == serialise_car_data(cars)
+
+    def test_unknown_publish_mode(self, monkeypatch):
+        monkeypatch.setenv("BMW_PUBLISH_MODE", "partial")
+        with pytest.raises(ValueError, match="Unknown BMW_PUBLISH_MODE: partial"):
+            get_published()
+
+    def test_skips_api_when_no_vehicle_is_due(self, cars, monkeypatch):
+        monkeypatch.setenv("BMW_VINS", "VIN1")
+        monkeypatch.delenv("BMW_POLL_INTERVAL_PARKED", raising=False)
+        with patch("shared_code.bmw.get_my_cars", return_value=cars) as get_my_cars:
+            first = get_published()
+            second = get_published()
+        get_my_cars.assert_called_once()
+        assert first == serialise_car_data(cars)
+        assert second == []
+
+    def test_only_due_vehicles_fetched(self, cars, monkeypatch):
+        monkeypatch.setenv("BMW_VINS", "VIN1,VIN2")
+        monkeypatch.delenv("BMW_POLL_INTERVAL_PARKED", raising=False)
+        other_car = MagicMock(spec=MyBMWVehicle)
+        other_car.vin = "VIN2"
+        other_car.data = load_bmw_state()
+        with patch("shared_code.bmw.get_my_cars", return_value=cars):
+            get_published()
+        with patch(
+            "shared_code.bmw.get_my_cars", return_value=[other_car]
+        ) as get_my_cars:
+            get_published()
+        # VIN1 was polled on the first run, so only VIN2 is fetched and recorded
+        get_my_cars.assert_called_once_with(["VIN2"])
+        assert set(vehicle_poll_states) == {"VIN1", "VIN2"}
@@ -0,0 +1,109 @@
+import pytest
+from unittest.mock import MagicMock, patch
+
+from bimmer_connected.vehicle import MyBMWVehicle
+from shared_code.bmw_poll_schedule import (
+    CHARGING,
+    DRIVING,
+    PARKED,
+    get_activity,
+    get_due_vins,
+    record_poll,
+    vehicle_poll_states,
+)
+
+
+def make_car(vin: str, mileage: int, charging_status: str = "INVALID", updated="t1"):
+    car = MagicMock(spec=MyBMWVehicle)
+    car.vin = vin
+    car.data = {
+        "vin": vin,
+        "state": {
+            "lastUpdatedAt": updated,
+            "currentMileage": mileage,
+            "electricChargingState": {
+                "chargingLevelPercent": 50,
+                "chargingStatus": charging_status,
+            },
+        },
+    }
+    return car
+
+
+@pytest.fixture(autouse=True)
+def clear_poll_states(monkeypatch):
+    for name in (
+        "BMW_POLL_INTERVAL_ACTIVE",
+        "BMW_POLL_INTERVAL_PARKED",
+        "BMW_POLL_INTERVAL_IDLE",
+        "BMW_POLL_IDLE_AFTER",
+        "BMW_ADAPTIVE_POLLING",
+    ):
+        monkeypatch.delenv(name, raising=False)
+    with patch.dict("shared_code.bmw_poll_schedule.vehicle_poll_states", clear=True):
+        yield
+
+
+class TestGetActivity:
+    def test_charging(self):
+        car = make_car("A", 100, "CHARGING")
+        assert get_activity(car.data, None) == CHARGING
+
+    def test_driving_when_mileage_changes(self):
+        record_poll([make_car("A", 100)], now=0)
+        assert (
+            get_activity(make_car("A", 105).data, vehicle_poll_states["A"]) == DRIVING
+        )
+
+    def test_parked(self):
+        record_poll([make_car("A", 100)], now=0)
+        assert get_activity(make_car("A", 100).data, vehicle_poll_states["A"]) == PARKED
+        assert get_activity({}, None) == PARKED
+
+
+class TestGetDueVINs:
+    def test_never_polled_is_due(self):
+        assert get_due_vins(["A", "B"], now=0) == ["A", "B"]
+
+    def test_parked_vehicle_waits_for_parked_interval(self):
+        record_poll([make_car("A", 100)], now=0)
+        assert get_due_vins(["A"], now=120) == []
+        assert get_due_vins(["A"], now=600) == ["A"]
+
+    def test_active_vehicle_is_due_every_tick(self):
+        record_poll([make_car("A", 100, "CHARGING")], now=0)
+        assert get_due_vins(["A"], now=100) == ["A"]
+        record_poll([make_car("A", 100)], now=0)
+        record_poll([make_car("A", 110)], now=120)
+        assert vehicle_poll_states["A"].activity == DRIVING
+        assert get_due_vins(["A"], now=240) == ["A"]
+
+    def test_idle_vehicle_backs_off(self):
+        record_poll([make_car("A", 100)], now=0)
+        record_poll([make_car("A", 100)], now=21600)
+        assert vehicle_poll_states["A"].last_changed == 0
+        assert get_due_vins(["A"], now=21600 + 600) == []
+        assert get_due_vins(["A"], now=21600 + 1800) == ["A"]
+
+    def test_change_resets_idle(self):
+        record_poll([make_car("A", 100)], now=0)
+        record_poll([make_car("A", 100, updated="t2")], now=21600)
+        assert vehicle_poll_states["A"].last_changed == 21600
+        assert get_due_vins(["A"], now=21600 + 600) == ["A"]
+
+    def test_intervals_from_environment(self, monkeypatch):
+        monkeypatch.setenv("BMW_POLL_INTERVAL_PARKED", "3600")
+        record_poll([make_car("A", 100)], now=0)
+        assert get_due_vins(["A"], now=600) == []
+        assert get_due_vins(["A"], now=3600) == ["A"]
+
+    def test_adaptive_polling_disabled(self, monkeypatch):
+        monkeypatch.setenv("BMW_ADAPTIVE_POLLING", "false")
+        # a charging vehicle waits as if parked
+        record_poll([make_car("A", 100, "CHARGING")], now=0)
+        assert get_due_vins(["A"], now=120) == []
+        assert get_due_vins(["A"], now=600) == ["A"]
+        # and an idle one does not back off
+        record_poll([make_car("B", 100)], now=0)
+        record_poll([make_car("B", 100)], now=21600)
+        assert get_due_vins(["B"], now=21600 + 600) == ["B"]
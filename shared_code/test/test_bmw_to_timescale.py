@@ -18,8 +18,8 @@ from shared_code.bmw_to_timescale import (
     get_last_updated_at_from_message,
 )
 from shared_code import bmw_to_timescale as btc
-import shared_code as sc
 from shared_code import PayloadType
+from shared_code.dedupe_backend import MemoryDedupeBackend, TableDedupeBackend
 from azure.functions import EventHubEvent, Out
 
 
@@ -56,9 +56,9 @@ class TestConvertBmwToTimescaleEndToEnd:
         spy_get_last_updated_at_from_message = mocker.spy(
             btc, "get_last_updated_at_from_message"
         )
-        spy_check_duplicate = mocker.spy(sc, "check_duplicate")
+        spy_claim_id = mocker.spy(TableDedupeBackend, "claim_ids")
         spy_construct_messages = mocker.spy(btc, "construct_messages")
-        spy_store_id = mocker.spy(sc, "store_id")
+        spy_confirm_id = mocker.spy(TableDedupeBackend, "confirm_ids")
 
         for event in events:
             # Call the function
@@ -69,41 +69,172 @@ class TestConvertBmwToTimescaleEndToEnd:
         # Validate that the external functions were called the expected number of times
         assert mock_get_vin_from_message.call_count == 3
         assert spy_get_last_updated_at_from_message.call_count == 3
-        assert spy_check_duplicate.call_count == 3
+        assert spy_claim_id.call_count == 3
         assert spy_construct_messages.call_count == 2  # One duplicate, one not
 
-        assert spy_store_id.call_count == 2  # One duplicate, one not
+        assert spy_confirm_id.call_count == 2  # One duplicate, one not
 
         # Validate that outputEventHubMessage.set was called the expected number of times
         assert mock_outputEventHubMessage.set.call_count == 2
 
+    @patch("shared_code.bmw_to_timescale.sc.get_dedupe_backend")
+    def test_convert_bmw_to_timescale_with_memory_backend(
+        self, mock_get_dedupe_backend, mocker
+    ):
+        mock_get_dedupe_backend.return_value = MemoryDedupeBackend()
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(current_dir, "bmw_topic_messages.json"), "r") as f:
+            event_data = json.load(f)
+        mock_outputEventHubMessage = mocker.MagicMock(spec=Out)
+
+        for data in event_data:
+            convert_bmw_to_timescale(
+                EventHubEvent(body=json.dumps(data).encode("utf-8")),
+                mock_outputEventHubMessage,
+                mocker.MagicMock(spec=Out),
+            )
+
+        assert mock_outputEventHubMessage.set.call_count == 2  # One duplicate
+
+    @patch("shared_code.bmw_to_timescale.sc.get_dedupe_backend")
+    def test_convert_bmw_to_timescale_batch(self, mock_get_dedupe_backend, mocker):
+        backend = MemoryDedupeBackend()
+        mock_get_dedupe_backend.return_value = backend
+        spy_claim_ids = mocker.spy(backend, "claim_ids")
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(current_dir, "bmw_topic_messages.json"), "r") as f:
+            event_data = json.load(f)
+        other_vin = copy(event_data[0])
+        other_vin["vin"] = "OTHERVIN"
+        events = [
+            EventHubEvent(body=json.dumps(data).encode("utf-8"))
+            for data in event_data + [other_vin]
+        ]
+        mock_outputEventHubMessage = mocker.MagicMock(spec=Out)
+        mock_outputEventHubMessage_monitor = mocker.MagicMock(spec=Out)
+
+        convert_bmw_to_timescale(
+            events, mock_outputEventHubMessage, mock_outputEventHubMessage_monitor
+        )
+
+        # one claim per vin, with the repeated update dropped before claiming
+        assert spy_claim_ids.call_count == 2
+        assert len(spy_claim_ids.call_args_list[0].args[0]) == 2
+        # everything is sent in a single set
+        mock_outputEventHubMessage.set.assert_called_once()
+        message_list = mock_outputEventHubMessage.set.call_args.args[0]
+        subjects = {json.loads(m)["measurement_subject"] for m in message_list}
+        assert subjects == {event_data[0]["vin"], "OTHERVIN"}
+        mock_outputEventHubMessage_monitor.set.assert_called_once_with(message_list)
+
+        # redelivering the batch sends nothing
+        mock_outputEventHubMessage.set.reset_mock()
+        convert_bmw_to_timescale(
+            events, mock_outputEventHubMessage, mock_outputEventHubMessage_monitor
+        )
+        mock_outputEventHubMessage.set.assert_not_called()
+
+    @patch("shared_code.bmw_to_timescale.sc.get_dedupe_backend")
+    def test_convert_bmw_to_timescale_batch_with_bad_events(
+        self, mock_get_dedupe_backend, mocker
+    ):
+        backend = MemoryDedupeBackend()
+        mock_get_dedupe_backend.return_value = backend
+        spy_release_claims = mocker.spy(backend, "release_claims")
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(current_dir, "bmw_topic_messages.json"), "r") as f:
+            event_data = json.load(f)
+        no_vin = copy(event_data[0])
+        del no_vin["vin"]
+        bad_location = json.loads(json.dumps(event_data[0]))
+        bad_location["vin"] = "BADVIN"
+        bad_location["state"]["location"]["coordinates"]["latitude"] = 200
+        events = [EventHubEvent(body=b"not json")] + [
+            EventHubEvent(body=json.dumps(data).encode("utf-8"))
+            for data in [no_vin, bad_location] + event_data
+        ]
+        mock_outputEventHubMessage = mocker.MagicMock(spec=Out)
+
+        convert_bmw_to_timescale(
+            events, mock_outputEventHubMessage, mocker.MagicMock(spec=Out)
+        )
+
+        # the good updates are still sent, together
+        mock_outputEventHubMessage.set.assert_called_once()
+        message_list = mock_outputEventHubMessage.set.call_args.args[0]
+        subjects = {json.loads(m)["measurement_subject"] for m in message_list}
+        assert subjects == {event_data[0]["vin"]}
+        # only the claim of the update which could not be converted is released
+        spy_release_claims.assert_called_once_with(
+            [bad_location["state"]["lastUpdatedAt"]], "BADVIN"
+        )
+        assert not backend.check_duplicate(
+            bad_location["state"]["lastUpdatedAt"], "BADVIN"
+        )
+        for data in event_data:
+            assert backend.check_duplicate(data["state"]["lastUpdatedAt"], data["vin"])
+
+    @patch("shared_code.bmw_to_timescale.sc.get_dedupe_backend")
+    def test_convert_bmw_to_timescale_batch_claim_failure(
+        self, mock_get_dedupe_backend, mocker
+    ):
+        backend = MemoryDedupeBackend()
+        mock_get_dedupe_backend.return_value = backend
+        claim_ids = backend.claim_ids
+
+        def claim_ids_then_fail(ids, context):
+            if backend.claim_ids.call_count > 1:
+                raise Exception("An error occurred while claiming")
+            return claim_ids(ids, context)
+
+        mocker.patch.object(backend, "claim_ids", side_effect=claim_ids_then_fail)
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(current_dir, "bmw_topic_messages.json"), "r") as f:
+            event_data = json.load(f)
+        other_vin = copy(event_data[0])
+        other_vin["vin"] = "OTHERVIN"
+        events = [
+            EventHubEvent(body=json.dumps(data).encode("utf-8"))
+            for data in event_data + [other_vin]
+        ]
+        mock_outputEventHubMessage = mocker.MagicMock(spec=Out)
+
+        with pytest.raises(Exception, match="An error occurred while claiming"):
+            convert_bmw_to_timescale(
+                events, mock_outputEventHubMessage, mocker.MagicMock(spec=Out)
+            )
+
+        mock_outputEventHubMessage.set.assert_not_called()
+        # the first vin's claims are released, so a redelivery can process them
+        for data in event_data:
+            assert not backend.check_duplicate(
+                data["state"]["lastUpdatedAt"], data["vin"]
+            )
+
 
 class TestConvertBmwToTimescale:
     @pytest.mark.parametrize("duplicate_status", [True, False])
     @patch("shared_code.bmw_to_timescale.construct_messages")
-    @patch("shared_code.bmw_to_timescale.sc.store_id")
-    @patch("shared_code.bmw_to_timescale.sc.check_duplicate")
     @patch("shared_code.bmw_to_timescale.get_last_updated_at_from_message")
     @patch("shared_code.bmw_to_timescale.get_vin_from_message")
     @patch("shared_code.bmw_to_timescale.get_event_body")
-    @patch("shared_code.bmw_to_timescale.sc.get_table_service_client")
+    @patch("shared_code.bmw_to_timescale.sc.get_dedupe_backend")
     def test_convert_bmw_to_timescale_no_exception(
         self,
-        mock_get_table_service_client,
+        mock_get_dedupe_backend,
         mock_get_event_body,
         mock_get_vin_from_message,
         mock_get_last_updated_at_from_message,
-        mock_check_duplicate,
-        mock_store_id,
         mock_construct_messages,
         duplicate_status,
     ):
         # Mock external functions
-        mock_get_table_service_client.return_value = MagicMock()
+        mock_claim_ids = mock_get_dedupe_backend.return_value.claim_ids
+        mock_confirm_ids = mock_get_dedupe_backend.return_value.confirm_ids
         mock_get_event_body.return_value = {}
         mock_get_vin_from_message.return_value = "VIN123"
         mock_get_last_updated_at_from_message.return_value = "timestamp123"
-        mock_check_duplicate.return_value = duplicate_status
+        mock_claim_ids.return_value = [] if duplicate_status else ["timestamp123"]
         mock_construct_messages.return_value = [[{"some_messages": "some_value"}]]
         mock_outputEventHubMessage = MagicMock()
         mock_outputEventHubMessage_monitor = MagicMock(spec=Out)
@@ -116,15 +247,14 @@ class TestConvertBmwToTimescale:
         )
 
         # Assertions
-        mock_check_duplicate.assert_called_once_with(
-            mock_get_last_updated_at_from_message.return_value,
+        mock_claim_ids.assert_called_once_with(
+            [mock_get_last_updated_at_from_message.return_value],
             mock_get_vin_from_message.return_value,
-            mock_get_table_service_client.return_value,
         )
         if duplicate_status:
             mock_construct_messages.assert_not_called()
             mock_outputEventHubMessage.set.assert_not_called()
-            mock_store_id.assert_not_called()
+            mock_confirm_ids.assert_not_called()
         else:
             mock_construct_messages.assert_called_with(
                 mock_get_vin_from_message.return_value,
@@ -134,10 +264,9 @@ class TestConvertBmwToTimescale:
             mock_outputEventHubMessage.set.assert_called_with(
                 [json.dumps(mock_construct_messages.return_value[0])]
             )
-            mock_store_id.assert_called_with(
-                mock_get_last_updated_at_from_message.return_value,
+            mock_confirm_ids.assert_called_with(
+                [mock_get_last_updated_at_from_message.return_value],
                 mock_get_vin_from_message.return_value,
-                mock_get_table_service_client.return_value,
             )
 
     @patch("shared_code.bmw_to_timescale.get_event_body")
@@ -151,28 +280,26 @@ class TestConvertBmwToTimescale:
         assert str(excinfo.value) == "An error occurred in this test"
 
     @patch("shared_code.bmw_to_timescale.construct_messages")
-    @patch("shared_code.bmw_to_timescale.sc.store_id")
-    @patch("shared_code.bmw_to_timescale.sc.check_duplicate")
     @patch("shared_code.bmw_to_timescale.get_last_updated_at_from_message")
     @patch("shared_code.bmw_to_timescale.get_vin_from_message")
     @patch("shared_code.bmw_to_timescale.get_event_body")
-    @patch("shared_code.bmw_to_timescale.sc.get_table_service_client")
+    @patch("shared_code.bmw_to_timescale.sc.get_dedupe_backend")
     def test_convert_bmw_to_timescale_outputEventHubMessage_exception(
         self,
-        mock_get_table_service_client,
+        mock_get_dedupe_backend,
         mock_get_event_body,
         mock_get_vin_from_message,
         mock_get_last_updated_at_from_message,
-        mock_check_duplicate,
-        mock_store_id,
         mock_construct_messages,
     ):
         # Mock external functions
-        mock_get_table_service_client.return_value = MagicMock()
+        mock_claim_ids = mock_get_dedupe_backend.return_value.claim_ids
+        mock_confirm_ids = mock_get_dedupe_backend.return_value.confirm_ids
+        mock_release_claims = mock_get_dedupe_backend.return_value.release_claims
         mock_get_event_body.return_value = {}
         mock_get_vin_from_message.return_value = "VIN123"
         mock_get_last_updated_at_from_message.return_value = "timestamp123"
-        mock_check_duplicate.return_value = False
+        mock_claim_ids.return_value = ["timestamp123"]
         mock_construct_messages.return_value = [[{"some_messages": "some_value"}]]
 
         # Mock outputEventHubMessage to raise an exception
@@ -193,6 +320,12 @@ class TestConvertBmwToTimescale:
 
         # Assert the exception message
         assert str(excinfo.value) == "An error occurred while sending message"
+        # the claim is released so a redelivery can process the message
+        mock_confirm_ids.assert_not_called()
+        mock_release_claims.assert_called_once_with(
+            [mock_get_last_updated_at_from_message.return_value],
+            mock_get_vin_from_message.return_value,
+        )
 
 
 class TestGetEventBody:
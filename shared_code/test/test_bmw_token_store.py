@@ -0,0 +1,244 @@
+import datetime
+import json
+import os
+import pytest
+from unittest.mock import MagicMock, patch
+
+from azure.core.exceptions import ResourceNotFoundError
+from bimmer_connected.account import MyBMWAccount
+from bimmer_connected.api.regions import Regions
+
+from shared_code.bmw import get_my_cars
+from shared_code.bmw_token_store import (
+    FileBMWTokenStore,
+    TableBMWTokenStore,
+    apply_tokens_to_account,
+    get_bmw_token_store,
+    get_tokens_from_account,
+    persist_tokens,
+    restore_tokens,
+)
+from test_utils.bmw_api_stand_in import BMWAPIStandIn
+
+
+def make_account() -> MyBMWAccount:
+    return MyBMWAccount("user@example.com", "password", Regions.REST_OF_WORLD)
+
+
+def make_tokens(expires_in: datetime.timedelta) -> dict:
+    return {
+        "access_token": "stored-access",
+        "refresh_token": "stored-refresh",
+        "gcid": "stored-gcid",
+        "session_id": "stored-session",
+        "expires_at": (
+            datetime.datetime.now(datetime.timezone.utc) + expires_in
+        ).isoformat(),
+    }
+
+
+class TestFileBMWTokenStore:
+    def test_load_missing_file(self, tmp_path):
+        assert FileBMWTokenStore(str(tmp_path / "tokens.json")).load() is None
+
+    def test_save_and_load(self, tmp_path):
+        store = FileBMWTokenStore(str(tmp_path / "tokens.json"))
+        tokens = make_tokens(datetime.timedelta(hours=1))
+        store.save(tokens)
+        assert store.load() == tokens
+        assert os.stat(store.path).st_mode & 0o777 == 0o600
+        assert not os.path.exists(f"{store.path}.tmp")
+
+
+class TestTableBMWTokenStore:
+    def test_load_missing_entity(self):
+        table_service_client = MagicMock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.get_entity.side_effect = ResourceNotFoundError("missing")
+        assert TableBMWTokenStore(table_service_client, "user").load() is None
+
+    def test_load(self):
+        table_service_client = MagicMock()
+        tokens = make_tokens(datetime.timedelta(hours=1))
+        table_client = table_service_client.get_table_client.return_value
+        table_client.get_entity.return_value = {
+            "PartitionKey": "tokens",
+            "RowKey": "row",
+            **tokens,
+        }
+        store = TableBMWTokenStore(table_service_client, "user")
+        assert store.load() == tokens
+        table_client.get_entity.assert_called_once_with("tokens", store.row_key)
+
+    @patch("shared_code.bmw_token_store.ensure_table_exists")
+    def test_save(self, mock_ensure_table_exists):
+        table_service_client = MagicMock()
+        tokens = make_tokens(datetime.timedelta(hours=1))
+        store = TableBMWTokenStore(table_service_client, "user@example.com")
+        store.save(tokens)
+        mock_ensure_table_exists.assert_called_once_with(
+            "bmwtokens", table_service_client
+        )
+        table_service_client.get_table_client.return_value.upsert_entity.assert_called_once_with(
+            {"PartitionKey": "tokens", "RowKey": store.row_key, **tokens}
+        )
+        assert "user" not in store.row_key
+
+
+class TestGetBMWTokenStore:
+    @pytest.mark.parametrize("value", [None, "", "none", "NONE"])
+    def test_no_store(self, monkeypatch, value):
+        if value is None:
+            monkeypatch.delenv("BMW_TOKEN_STORE", raising=False)
+        else:
+            monkeypatch.setenv("BMW_TOKEN_STORE", value)
+        assert get_bmw_token_store() is None
+
+    def test_file_store(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("BMW_TOKEN_STORE", "file")
+        monkeypatch.setenv("BMW_TOKEN_FILE", str(tmp_path / "tokens.json"))
+        store = get_bmw_token_store()
+        assert isinstance(store, FileBMWTokenStore)
+        assert store.path == str(tmp_path / "tokens.json")
+
+    @patch("shared_code.bmw_token_store.get_table_service_client")
+    def test_table_store(self, mock_get_table_service_client, monkeypatch):
+        monkeypatch.setenv("BMW_TOKEN_STORE", "table")
+        monkeypatch.setenv("BMW_USERNAME", "user@example.com")
+        store = get_bmw_token_store()
+        assert isinstance(store, TableBMWTokenStore)
+        assert store.table_service_client is mock_get_table_service_client.return_value
+
+    def test_unknown_store(self, monkeypatch):
+        monkeypatch.setenv("BMW_TOKEN_STORE", "floppy")
+        with pytest.raises(ValueError, match="Unknown BMW_TOKEN_STORE: floppy"):
+            get_bmw_token_store()
+
+
+class TestApplyTokensToAccount:
+    def test_valid_access_token_is_used(self):
+        account = make_account()
+        apply_tokens_to_account(account, make_tokens(datetime.timedelta(hours=1)))
+        authentication = account.config.authentication
+        assert authentication.access_token == "stored-access"
+        assert authentication.refresh_token == "stored-refresh"
+        assert authentication.gcid == "stored-gcid"
+        assert authentication.session_id == "stored-session"
+
+    def test_expired_access_token_is_dropped(self):
+        account = make_account()
+        apply_tokens_to_account(account, make_tokens(-datetime.timedelta(minutes=1)))
+        authentication = account.config.authentication
+        assert authentication.access_token is None
+        assert authentication.refresh_token == "stored-refresh"
+
+    def test_no_refresh_token(self):
+        account = make_account()
+        apply_tokens_to_account(account, {"access_token": "a"})
+        assert account.config.authentication.access_token is None
+
+    def test_round_trip(self):
+        account = make_account()
+        tokens = make_tokens(datetime.timedelta(hours=1))
+        apply_tokens_to_account(account, tokens)
+        assert get_tokens_from_account(account) == tokens
+
+
+class TestStoreFailures:
+    def test_restore_ignores_load_errors(self):
+        store = MagicMock()
+        store.load.side_effect = Exception("unavailable")
+        account = make_account()
+        with patch("shared_code.bmw_token_store.logging") as mock_logging:
+            restore_tokens(account, store)
+        mock_logging.error.assert_called_once()
+        assert account.config.authentication.refresh_token is None
+
+    def test_persist_ignores_save_errors(self):
+        store = MagicMock()
+        store.save.side_effect = Exception("unavailable")
+        account = make_account()
+        apply_tokens_to_account(account, make_tokens(datetime.timedelta(hours=1)))
+        with patch("shared_code.bmw_token_store.logging") as mock_logging:
+            persist_tokens(account, store)
+        mock_logging.error.assert_called_once()
+
+    def test_persist_skips_accounts_without_tokens(self):
+        store = MagicMock()
+        persist_tokens(make_account(), store)
+        store.save.assert_not_called()
+
+
+class TestTokensAcrossInvocations:
+    """Runs get_my_cars repeatedly against the offline stand-in for the MyBMW API"""
+
+    @pytest.fixture
+    def environment(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("BMW_USERNAME", "user@example.com")
+        monkeypatch.setenv("BMW_PASSWORD", "password")
+        monkeypatch.setenv("BMW_REGION", "rest_of_world")
+        monkeypatch.setenv("BMW_VINS", "VIN1")
+        monkeypatch.setenv("BMW_TOKEN_STORE", "file")
+        monkeypatch.setenv("BMW_TOKEN_FILE", str(tmp_path / "tokens.json"))
+        return tmp_path / "tokens.json"
+
+    @pytest.fixture
+    def stand_in(self):
+        stand_in = BMWAPIStandIn(vehicles=[{"vin": "VIN1"}, {"vin": "VIN2"}])
+        with stand_in.patch():
+            yield stand_in
+
+    def test_first_run_logs_in_and_saves_tokens(self, environment, stand_in):
+        cars = get_my_cars()
+        assert [car.vin for car in cars] == ["VIN1"]
+        assert stand_in.login_calls == 1
+        assert json.loads(environment.read_text())["refresh_token"] == "refresh-1"
+
+    def test_later_runs_reuse_access_token(self, environment, stand_in):
+        for _ in range(3):
+            get_my_cars()
+        assert stand_in.login_calls == 1
+        assert stand_in.refresh_calls == 0
+        assert stand_in.vehicle_calls == 3
+
+    def test_expired_access_token_is_refreshed(self, environment, stand_in):
+        get_my_cars()
+        stand_in.expire_access_tokens()
+        get_my_cars()
+        assert stand_in.login_calls == 1
+        assert stand_in.refresh_calls == 1
+        stored = json.loads(environment.read_text())
+        assert stored["access_token"] == "access-2"
+        assert stored["refresh_token"] == "refresh-2"
+
+    def test_locally_expired_access_token_is_refreshed_up_front(
+        self, environment, stand_in
+    ):
+        get_my_cars()
+        stored = json.loads(environment.read_text())
+        stored["expires_at"] = "2000-01-01T00:00:00+00:00"
+        environment.write_text(json.dumps(stored))
+        get_my_cars()
+        assert stand_in.refresh_calls == 1
+        assert stand_in.login_calls == 1
+
+    def test_revoked_refresh_token_falls_back_to_login(self, environment, stand_in):
+        get_my_cars()
+        stand_in.expire_access_tokens()
+        stand_in.revoke_refresh_tokens()
+        get_my_cars()
+        assert stand_in.refresh_calls == 1
+        assert stand_in.login_calls == 2
+
+    def test_without_store_every_run_logs_in(self, environment, stand_in, monkeypatch):
+        monkeypatch.setenv("BMW_TOKEN_STORE", "none")
+        get_my_cars()
+        get_my_cars()
+        assert stand_in.login_calls == 2
+        assert not environment.exists()
+
+    def test_tokens_saved_when_no_cars_found(self, environment, stand_in, monkeypatch):
+        monkeypatch.setenv("BMW_VINS", "VIN9")
+        with pytest.raises(Exception, match="No cars found"):
+            get_my_cars()
+        assert environment.exists()
@@ -0,0 +1,288 @@
+import datetime
+import uuid
+import pytest
+from unittest.mock import MagicMock, patch
+
+from shared_code.dedupe_backend import (
+    MemoryDedupeBackend,
+    PostgresDedupeBackend,
+    TableDedupeBackend,
+    get_dedupe_backend,
+    purge_dedupe_store,
+)
+from shared_code.timescale import get_connection_string
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestMemoryDedupeBackend:
+    def test_claim_confirm(self):
+        backend = MemoryDedupeBackend()
+        assert backend.check_duplicate("t1", "VIN1") is False
+        assert backend.claim_id("t1", "VIN1") is True
+        assert backend.claim_id("t1", "VIN1") is False
+        backend.confirm_id("t1", "VIN1")
+        assert backend.claim_id("t1", "VIN1") is False
+        assert backend.check_duplicate("t1", "VIN1") is True
+        assert backend.claim_id("t1", "VIN2") is True
+
+    def test_release(self):
+        backend = MemoryDedupeBackend()
+        backend.claim_id("t1", "VIN1")
+        backend.release_claim("t1", "VIN1")
+        assert backend.claim_id("t1", "VIN1") is True
+
+    def test_release_does_not_remove_sent(self):
+        backend = MemoryDedupeBackend()
+        backend.store_id("t1", "VIN1")
+        backend.release_claim("t1", "VIN1")
+        assert backend.check_duplicate("t1", "VIN1") is True
+        assert backend.claim_id("t1", "VIN1") is False
+
+    def test_batch(self):
+        backend = MemoryDedupeBackend()
+        backend.store_id("t1", "VIN1")
+        assert backend.claim_ids(["t1", "t2", "t2", "t3"], "VIN1") == ["t2", "t3"]
+        backend.release_claims(["t2"], "VIN1")
+        backend.confirm_ids(["t3"], "VIN1")
+        assert backend.claim_ids(["t2", "t3"], "VIN1") == ["t2"]
+
+    def test_stale_claim_is_taken_over(self):
+        clock = FakeClock()
+        backend = MemoryDedupeBackend(claim_ttl_seconds=60, clock=clock)
+        backend.claim_id("t1", "VIN1")
+        clock.now += 59
+        assert backend.claim_id("t1", "VIN1") is False
+        clock.now += 2
+        assert backend.claim_id("t1", "VIN1") is True
+
+
+class TestPostgresDedupeBackend:
+    @pytest.fixture
+    def connection(self):
+        with patch("psycopg.connect") as mock_connect:
+            connection = mock_connect.return_value
+            connection.closed = False
+            yield connection
+
+    def test_table_created_once(self, connection):
+        backend = PostgresDedupeBackend("dsn", cleanup_interval_seconds=3600)
+        backend.check_duplicate("t1", "VIN1")
+        backend.check_duplicate("t2", "VIN1")
+        create_calls = [
+            c
+            for c in connection.execute.call_args_list
+            if c.args[0].startswith("CREATE TABLE IF NOT EXISTS dedupe")
+        ]
+        assert len(create_calls) == 1
+
+    @pytest.mark.parametrize(
+        "row, expected", [((True,), True), ((False,), False), (None, False)]
+    )
+    def test_claim_is_one_statement(self, connection, row, expected):
+        backend = PostgresDedupeBackend("dsn", claim_ttl_seconds=60)
+        backend.last_cleanup = float("inf")  # not due
+        connection.execute.return_value.fetchone.return_value = row
+
+        assert backend.claim_id("t1", "VIN1") is expected
+
+        sql, parameters = connection.execute.call_args.args
+        assert (
+            "ON CONFLICT (context, identifier) DO UPDATE SET last_seen = now()" in sql
+        )
+        assert "RETURNING (existing.xmax = 0 OR existing.updated_at = now())" in sql
+        assert parameters == ("VIN1", "t1", 60)
+
+    def test_claim_ids_is_one_statement(self, connection):
+        backend = PostgresDedupeBackend("dsn", claim_ttl_seconds=60)
+        backend.last_cleanup = float("inf")
+        connection.execute.return_value.fetchall.return_value = [
+            ("t3", True),
+            ("t1", True),
+            ("t2", False),
+        ]
+
+        assert backend.claim_ids(["t1", "t2", "t3", "t1"], "VIN1") == ["t1", "t3"]
+
+        sql, parameters = connection.execute.call_args.args
+        assert "unnest(%s::text[])" in sql
+        assert "SET last_seen = now()" in sql
+        assert "RETURNING identifier, (existing.xmax = 0" in sql
+        assert parameters == ("VIN1", ["t1", "t2", "t3"], 60)
+
+    def test_cleanup_runs_when_due(self, connection):
+        backend = PostgresDedupeBackend(
+            "dsn", retention_seconds=10, cleanup_interval_seconds=3600
+        )
+        connection.execute.return_value.rowcount = 3
+        backend.claim_id("t1", "VIN1")
+        backend.claim_id("t2", "VIN1")
+        delete_calls = [
+            c
+            for c in connection.execute.call_args_list
+            if c.args[0].startswith("DELETE FROM dedupe WHERE last_seen")
+        ]
+        assert len(delete_calls) == 1
+        assert delete_calls[0].args[1] == (10,)
+
+    def test_purge_contexts(self, connection):
+        backend = PostgresDedupeBackend("dsn", retention_seconds=10)
+        connection.execute.return_value.rowcount = 4
+        assert backend.purge_expired(["VIN1", "VIN2"]) == 4
+        sql, parameters = connection.execute.call_args.args
+        assert "AND context = ANY(%s)" in sql
+        assert parameters == (10, ["VIN1", "VIN2"])
+
+    def test_reconnects_when_closed(self, connection):
+        backend = PostgresDedupeBackend("dsn")
+        backend.check_duplicate("t1", "VIN1")
+        connection.closed = True
+        with patch("psycopg.connect") as mock_connect:
+            backend.check_duplicate("t1", "VIN1")
+        mock_connect.assert_called_once_with("dsn", autocommit=True)
+
+    def test_release_ignores_errors(self, connection):
+        backend = PostgresDedupeBackend("dsn")
+        backend.get_connection()
+        connection.execute.side_effect = Exception("down")
+        backend.release_claim("t1", "VIN1")
+
+
+class TestPostgresDedupeBackendAgainstActualDatabase:
+    @pytest.fixture
+    def backend(self):
+        backend = PostgresDedupeBackend(
+            get_connection_string(),
+            table_name="dedupe_test",
+            claim_ttl_seconds=60,
+            retention_seconds=1800,
+        )
+        backend.last_cleanup = float("inf")  # purged explicitly below
+        context = f"test_{uuid.uuid4()}"
+        yield backend, context
+        backend.get_connection().execute(
+            "DELETE FROM dedupe_test WHERE context = %s", (context,)
+        )
+
+    def test_sent_identifier_is_still_a_duplicate_after_retention(self, backend):
+        backend, context = backend
+        assert backend.claim_id("t1", context) is True
+        backend.confirm_id("t1", context)
+        # sent long ago, and the parked vehicle has re-sent it ever since
+        backend.get_connection().execute(
+            "UPDATE dedupe_test SET updated_at = now() - interval '2 hours', "
+            "last_seen = now() - interval '2 hours' WHERE context = %s",
+            (context,),
+        )
+        assert backend.claim_id("t1", context) is False
+        assert backend.purge_expired([context]) == 0
+        assert backend.claim_id("t1", context) is False
+        assert backend.claim_ids(["t1", "t2"], context) == ["t2"]
+
+
+class TestTableDedupeBackend:
+    @pytest.mark.parametrize(
+        "method", ["check_duplicate", "store_id", "claim_id", "confirm_id"]
+    )
+    def test_delegates_to_duplicate_check(self, method):
+        table_service_client = MagicMock()
+        with patch(f"shared_code.dedupe_backend.duplicate_check.{method}") as mock:
+            result = getattr(TableDedupeBackend(table_service_client), method)(
+                "t1", "VIN1"
+            )
+        mock.assert_called_once_with("t1", "VIN1", table_service_client)
+        if method != "confirm_id":
+            assert result is mock.return_value
+
+    @patch("shared_code.dedupe_backend.duplicate_check.purge_expired_ids")
+    def test_purge_expired(self, mock_purge_expired_ids):
+        table_service_client = MagicMock()
+        mock_purge_expired_ids.side_effect = [2, 3]
+        backend = TableDedupeBackend(table_service_client, retention_seconds=3600)
+
+        assert backend.purge_expired(["VIN1", "VIN2"]) == 5
+
+        contexts = [c.args[0] for c in mock_purge_expired_ids.call_args_list]
+        assert contexts == ["VIN1", "VIN2"]
+        older_than = mock_purge_expired_ids.call_args.args[2]
+        expected = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            hours=1
+        )
+        assert abs((older_than - expected).total_seconds()) < 60
+
+    @patch("shared_code.dedupe_backend.duplicate_check.list_contexts")
+    @patch("shared_code.dedupe_backend.duplicate_check.purge_expired_ids")
+    def test_purge_expired_lists_contexts(
+        self, mock_purge_expired_ids, mock_list_contexts
+    ):
+        table_service_client = MagicMock()
+        mock_list_contexts.return_value = ["VIN1", "OLDVIN"]
+        mock_purge_expired_ids.side_effect = [2, 3]
+
+        assert TableDedupeBackend(table_service_client).purge_expired() == 5
+
+        mock_list_contexts.assert_called_once_with(table_service_client)
+        contexts = [c.args[0] for c in mock_purge_expired_ids.call_args_list]
+        assert contexts == ["VIN1", "OLDVIN"]
+
+
+class TestPurgeDedupeStore:
+    @patch("shared_code.dedupe_backend.get_dedupe_backend")
+    def test_purges_every_context(self, mock_get_dedupe_backend, monkeypatch):
+        monkeypatch.setenv("BMW_VINS", "VIN1")
+        mock_get_dedupe_backend.return_value.purge_expired.return_value = 7
+
+        assert purge_dedupe_store() == 7
+
+        # not only BMW_VINS, so vehicles which have been removed are purged too
+        mock_get_dedupe_backend.return_value.purge_expired.assert_called_once_with()
+
+    def test_memory_backend_has_nothing_to_purge(self):
+        assert MemoryDedupeBackend().purge_expired(["VIN1"]) == 0
+
+
+class TestGetDedupeBackend:
+    @pytest.fixture(autouse=True)
+    def clear_backends(self):
+        with patch.dict("shared_code.dedupe_backend.dedupe_backends", clear=True):
+            yield
+
+    @pytest.mark.parametrize("value", [None, "", "table", "TABLE"])
+    @patch("shared_code.dedupe_backend.duplicate_check.get_table_service_client")
+    def test_table_backend(self, mock_get_table_service_client, monkeypatch, value):
+        if value is None:
+            monkeypatch.delenv("DEDUPE_BACKEND", raising=False)
+        else:
+            monkeypatch.setenv("DEDUPE_BACKEND", value)
+        backend = get_dedupe_backend()
+        assert isinstance(backend, TableDedupeBackend)
+        assert (
+            backend.table_service_client is mock_get_table_service_client.return_value
+        )
+
+    def test_postgres_backend(self, monkeypatch):
+        monkeypatch.setenv("DEDUPE_BACKEND", "postgres")
+        monkeypatch.setenv("DEDUPE_POSTGRES_CONNECTION_STRING", "dbname=dedupe")
+        monkeypatch.setenv("DEDUPE_RETENTION_SECONDS", "60")
+        backend = get_dedupe_backend()
+        assert isinstance(backend, PostgresDedupeBackend)
+        assert backend.connection_string == "dbname=dedupe"
+        assert backend.retention_seconds == 60
+        assert get_dedupe_backend() is backend
+
+    def test_memory_backend_is_shared(self, monkeypatch):
+        monkeypatch.setenv("DEDUPE_BACKEND", "memory")
+        backend = get_dedupe_backend()
+        assert isinstance(backend, MemoryDedupeBackend)
+        assert get_dedupe_backend() is backend
+
+    def test_unknown_backend(self, monkeypatch):
+        monkeypatch.setenv("DEDUPE_BACKEND", "floppy")
+        with pytest.raises(ValueError, match="Unknown DEDUPE_BACKEND: floppy"):
+            get_dedupe_backend()
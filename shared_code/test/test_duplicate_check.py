@@ -1,19 +1,46 @@
+import datetime
 import pytest
 import uuid
-from unittest.mock import Mock, patch
-from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
-from azure.data.tables import TableEntity
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, call, patch
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
+from azure.data.tables import TableEntity, TableTransactionError, UpdateMode
 
 
 # Assuming the original function is imported like this
 from shared_code.duplicate_check import (
     ensure_table_exists,
+    ensure_context_table_exists,
+    list_contexts,
     store_id,
     check_duplicate,
     get_table_service_client,
+    RecentIdentifierCache,
+    claim_id,
+    confirm_id,
+    release_claim,
+    claim_ids,
+    confirm_ids,
+    release_claims,
+    TABLE_TRANSACTION_LIMIT,
+    get_partition_key,
+    needs_legacy_lookup,
+    legacy_partition_in_use,
+    purge_expired_ids,
 )
 
 
+def make_existing_entity(**properties):
+    entity = TableEntity(PartitionKey="messages", RowKey="some_id", **properties)
+    entity._metadata = {"etag": "some_etag"}
+    return entity
+
+
 class TestEnsureTableExists:
     @patch("shared_code.duplicate_check.TableServiceClient")
     def test_ensure_table_exists_creates_table(self, MockTableServiceClient):
@@ -221,6 +248,611 @@ class TestGetTableServiceClient:
         assert result is MockTableServiceClient.return_value
 
 
+class TestInProcessCaches:
+    def test_table_created_once_per_client(self):
+        table_service_client = Mock()
+        ensure_table_exists("some_table", table_service_client)
+        ensure_table_exists("some_table", table_service_client)
+        table_service_client.create_table.assert_called_once_with("some_table")
+
+        other_client = Mock()
+        ensure_table_exists("some_table", other_client)
+        other_client.create_table.assert_called_once_with("some_table")
+
+    def test_failed_create_is_retried(self):
+        table_service_client = Mock()
+        table_service_client.create_table.side_effect = [Exception("down"), None]
+        with pytest.raises(Exception):
+            ensure_table_exists("some_table", table_service_client)
+        ensure_table_exists("some_table", table_service_client)
+        assert table_service_client.create_table.call_count == 2
+
+    def test_context_recorded_once_per_client(self):
+        table_service_client = Mock()
+        ensure_context_table_exists("VIN1", table_service_client)
+        ensure_context_table_exists("VIN1", table_service_client)
+        table_service_client.create_table.assert_called_once_with("VIN1")
+        table_service_client.create_table_if_not_exists.assert_called_once_with(
+            "dedupecontexts"
+        )
+        registry = table_service_client.create_table_if_not_exists.return_value
+        registry.upsert_entity.assert_called_once_with(
+            TableEntity(PartitionKey="context", RowKey="VIN1")
+        )
+
+    def test_failed_record_is_retried(self):
+        table_service_client = Mock()
+        registry = table_service_client.create_table_if_not_exists.return_value
+        registry.upsert_entity.side_effect = [Exception("down"), None]
+        ensure_context_table_exists("VIN1", table_service_client)
+        ensure_context_table_exists("VIN1", table_service_client)
+        assert registry.upsert_entity.call_count == 2
+
+    def test_list_contexts(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.return_value = [
+            {"RowKey": "VIN1"},
+            {"RowKey": "VIN2"},
+        ]
+        assert list_contexts(table_service_client) == ["VIN1", "VIN2"]
+        table_service_client.get_table_client.assert_called_once_with("dedupecontexts")
+
+    def test_list_contexts_before_any_recorded(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.side_effect = ResourceNotFoundError("no table")
+        assert list_contexts(table_service_client) == []
+
+    def test_stored_id_is_duplicate_without_lookup(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        store_id("some_id", "some_context", table_service_client)
+        assert check_duplicate("some_id", "some_context", table_service_client) is True
+        table_client.get_entity.assert_not_called()
+        # a different context is a different vehicle
+        table_client.get_entity.side_effect = ResourceNotFoundError("missing")
+        assert (
+            check_duplicate("some_id", "other_context", table_service_client) is False
+        )
+
+    def test_found_duplicate_is_remembered(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        assert check_duplicate("some_id", "some_context", table_service_client) is True
+        assert check_duplicate("some_id", "some_context", table_service_client) is True
+        table_client.get_entity.assert_called_once_with("messages", "some_id")
+
+    def test_not_found_is_not_remembered(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.get_entity.side_effect = ResourceNotFoundError("missing")
+        check_duplicate("some_id", "some_context", table_service_client)
+        check_duplicate("some_id", "some_context", table_service_client)
+        assert table_client.get_entity.call_count == 2
+
+    @patch("shared_code.duplicate_check.TableServiceClient")
+    @patch.dict(
+        "shared_code.duplicate_check.os.environ",
+        {"AZURE_STORAGE_CONNECTION_STRING": "reused_connection_string"},
+    )
+    def test_client_reused(self, MockTableServiceClient):
+        assert get_table_service_client() is get_table_service_client()
+        MockTableServiceClient.from_connection_string.assert_called_once_with(
+            "reused_connection_string"
+        )
+
+
+class TestRecentIdentifierCache:
+    def test_least_recently_used_evicted(self):
+        cache = RecentIdentifierCache(max_size=2, ttl_seconds=60)
+        cache.add(("vin", "1"))
+        cache.add(("vin", "2"))
+        assert ("vin", "1") in cache
+        cache.add(("vin", "3"))
+        assert ("vin", "2") not in cache
+        assert ("vin", "1") in cache
+        assert ("vin", "3") in cache
+
+    @patch("shared_code.duplicate_check.time.monotonic")
+    def test_entries_expire(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        cache = RecentIdentifierCache(max_size=2, ttl_seconds=60)
+        cache.add(("vin", "1"))
+        mock_monotonic.return_value = 159.0
+        assert ("vin", "1") in cache
+        mock_monotonic.return_value = 161.0
+        assert ("vin", "1") not in cache
+        assert len(cache.entries) == 0
+
+    def test_concurrent_access(self):
+        cache = RecentIdentifierCache(max_size=50, ttl_seconds=60)
+
+        def use_cache(thread: int) -> int:
+            hits = 0
+            for i in range(2000):
+                cache.add(("vin", str((thread * i) % 100)))
+                hits += ("vin", str(i % 100)) in cache
+            return hits
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(use_cache, range(8)))
+        assert len(cache.entries) == 50
+
+
+class TestClaimID:
+    @patch("shared_code.duplicate_check.time.time", return_value=1000.0)
+    def test_new_identifier_claimed_in_one_call(self, _):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+
+        assert claim_id("some_id", "some_context", table_service_client) is True
+
+        table_client.create_entity.assert_called_once_with(
+            TableEntity(
+                PartitionKey="messages",
+                RowKey="some_id",
+                state="pending",
+                claimed_at=1000.0,
+            )
+        )
+        table_client.get_entity.assert_not_called()
+
+    @pytest.mark.parametrize("properties", [{"state": "sent"}, {}])
+    def test_sent_identifier_is_duplicate(self, properties):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.create_entity.side_effect = ResourceExistsError("exists")
+        table_client.get_entity.return_value = make_existing_entity(**properties)
+
+        assert claim_id("some_id", "some_context", table_service_client) is False
+        # remembered, so the next delivery does not leave the process
+        assert claim_id("some_id", "some_context", table_service_client) is False
+        table_client.create_entity.assert_called_once()
+
+    @patch("shared_code.duplicate_check.time.time", return_value=1000.0)
+    def test_fresh_pending_claim_is_respected(self, _):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.create_entity.side_effect = ResourceExistsError("exists")
+        table_client.get_entity.return_value = make_existing_entity(
+            state="pending", claimed_at=990.0
+        )
+
+        assert claim_id("some_id", "some_context", table_service_client) is False
+        table_client.update_entity.assert_not_called()
+
+    @patch.dict(
+        "shared_code.duplicate_check.os.environ", {"DEDUPE_CLAIM_TTL_SECONDS": "60"}
+    )
+    @patch("shared_code.duplicate_check.time.time", return_value=1000.0)
+    def test_stale_claim_is_taken_over(self, _):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.create_entity.side_effect = ResourceExistsError("exists")
+        table_client.get_entity.return_value = make_existing_entity(
+            state="pending", claimed_at=900.0
+        )
+
+        assert claim_id("some_id", "some_context", table_service_client) is True
+        table_client.update_entity.assert_called_once_with(
+            TableEntity(
+                PartitionKey="messages",
+                RowKey="some_id",
+                state="pending",
+                claimed_at=1000.0,
+            ),
+            mode=UpdateMode.REPLACE,
+            etag="some_etag",
+            match_condition=MatchConditions.IfNotModified,
+        )
+
+    def test_stale_claim_taken_over_by_someone_else(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.create_entity.side_effect = ResourceExistsError("exists")
+        table_client.get_entity.return_value = make_existing_entity(
+            state="pending", claimed_at=0.0
+        )
+        table_client.update_entity.side_effect = ResourceModifiedError("modified")
+
+        assert claim_id("some_id", "some_context", table_service_client) is False
+
+    def test_claim_released_before_read(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.create_entity.side_effect = ResourceExistsError("exists")
+        table_client.get_entity.side_effect = ResourceNotFoundError("missing")
+
+        assert claim_id("some_id", "some_context", table_service_client) is False
+
+    def test_raises_exception(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.create_entity.side_effect = Exception("Random exception")
+
+        with pytest.raises(Exception) as e:
+            claim_id("some_id", "some_context", table_service_client)
+        assert str(e.value) == "Failed to claim identifier: Random exception"
+
+
+class TestConfirmAndRelease:
+    def test_confirm_marks_sent_and_remembers(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+
+        confirm_id("some_id", "some_context", table_service_client)
+
+        table_client.update_entity.assert_called_once_with(
+            TableEntity(PartitionKey="messages", RowKey="some_id", state="sent"),
+            mode=UpdateMode.MERGE,
+        )
+        assert check_duplicate("some_id", "some_context", table_service_client) is True
+        table_client.get_entity.assert_not_called()
+
+    def test_confirm_raises_exception(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.update_entity.side_effect = Exception("Random exception")
+
+        with pytest.raises(Exception) as e:
+            confirm_id("some_id", "some_context", table_service_client)
+        assert str(e.value) == "Failed to confirm identifier: Random exception"
+
+    def test_release_deletes_claim_and_ignores_errors(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.delete_entity.side_effect = Exception("Random exception")
+
+        release_claim("some_id", "some_context", table_service_client)
+
+        table_client.delete_entity.assert_called_once_with("messages", "some_id")
+
+
+class TestBatchClaims:
+    def test_new_identifiers_claimed_in_one_transaction(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.return_value = []
+
+        assert claim_ids(["t1", "t2", "t1"], "VIN1", table_service_client) == [
+            "t1",
+            "t2",
+        ]
+
+        table_client.query_entities.assert_called_once_with(
+            "PartitionKey eq 'messages' and (RowKey eq @id0 or RowKey eq @id1)",
+            parameters={"id0": "t1", "id1": "t2"},
+        )
+        table_client.submit_transaction.assert_called_once()
+        operations = table_client.submit_transaction.call_args.args[0]
+        assert [(o[0], o[1]["RowKey"], o[1]["state"]) for o in operations] == [
+            ("create", "t1", "pending"),
+            ("create", "t2", "pending"),
+        ]
+
+    def test_existing_identifiers_are_not_created(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.return_value = [make_existing_entity(state="sent")]
+        table_client.query_entities.return_value[0]["RowKey"] = "t1"
+
+        assert claim_ids(["t1", "t2"], "VIN1", table_service_client) == ["t2"]
+        operations = table_client.submit_transaction.call_args.args[0]
+        assert [o[1]["RowKey"] for o in operations] == ["t2"]
+        # t1 is now known to be sent
+        assert claim_ids(["t1"], "VIN1", table_service_client) == []
+        assert table_client.query_entities.call_count == 1
+
+    def test_large_batches_are_split(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.return_value = []
+        identifiers = [f"t{i}" for i in range(TABLE_TRANSACTION_LIMIT + 1)]
+
+        assert claim_ids(identifiers, "VIN1", table_service_client) == identifiers
+        assert table_client.submit_transaction.call_count == 2
+
+    @patch("shared_code.duplicate_check.claim_id")
+    def test_falls_back_to_single_claims_on_conflict(self, mock_claim_id):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.return_value = []
+        table_client.submit_transaction.side_effect = TableTransactionError(
+            message="conflict"
+        )
+        mock_claim_id.side_effect = [False, True]
+
+        assert claim_ids(["t1", "t2"], "VIN1", table_service_client) == ["t2"]
+
+    def test_confirm_ids(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+
+        confirm_ids(["t1", "t2"], "VIN1", table_service_client)
+
+        table_client.submit_transaction.assert_called_once_with(
+            [
+                (
+                    "update",
+                    TableEntity(PartitionKey="messages", RowKey=i, state="sent"),
+                    {"mode": UpdateMode.MERGE},
+                )
+                for i in ["t1", "t2"]
+            ]
+        )
+        assert claim_ids(["t1", "t2"], "VIN1", table_service_client) == []
+
+    def test_release_claims_ignores_errors(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.submit_transaction.side_effect = Exception("down")
+
+        release_claims(["t1"], "VIN1", table_service_client)
+
+        table_client.submit_transaction.assert_called_once_with(
+            [("delete", {"PartitionKey": "messages", "RowKey": "t1"})]
+        )
+
+
+class TestPartitioning:
+    @pytest.mark.parametrize(
+        "scheme, identifier, expected",
+        [
+            (None, "2023-10-27T21:55:00.0000000Z", "2023-10-27"),
+            ("day", "2023-10-27T21:55:00.0000000Z", "2023-10-27"),
+            ("day", "some_id", "messages"),
+            ("messages", "2023-10-27T21:55:00.0000000Z", "messages"),
+            ("hash", "some_id", "64"),
+        ],
+    )
+    def test_get_partition_key(self, monkeypatch, scheme, identifier, expected):
+        if scheme is None:
+            monkeypatch.delenv("DEDUPE_PARTITION_SCHEME", raising=False)
+        else:
+            monkeypatch.setenv("DEDUPE_PARTITION_SCHEME", scheme)
+        assert get_partition_key(identifier) == expected
+
+    def test_unknown_scheme(self, monkeypatch):
+        monkeypatch.setenv("DEDUPE_PARTITION_SCHEME", "floppy")
+        with pytest.raises(ValueError, match="Unknown DEDUPE_PARTITION_SCHEME"):
+            get_partition_key("some_id")
+
+    @pytest.mark.parametrize(
+        "legacy_until, identifier, expected",
+        [
+            (None, "2023-10-27T21:55:00Z", True),
+            ("2023-10-28", "2023-10-27T21:55:00Z", True),
+            ("2023-10-28", "2023-10-28T00:00:00Z", False),
+            ("2023-10-28", "not-a-date", True),
+        ],
+    )
+    def test_needs_legacy_lookup(self, monkeypatch, legacy_until, identifier, expected):
+        if legacy_until is None:
+            monkeypatch.delenv("DEDUPE_LEGACY_PARTITION_UNTIL", raising=False)
+        else:
+            monkeypatch.setenv("DEDUPE_LEGACY_PARTITION_UNTIL", legacy_until)
+        assert needs_legacy_lookup(identifier, "ab") is expected
+
+    def test_legacy_partition_never_needs_lookup(self):
+        assert needs_legacy_lookup("some_id", "messages") is False
+
+    def test_check_duplicate_finds_legacy_entity(self, monkeypatch):
+        monkeypatch.delenv("DEDUPE_LEGACY_PARTITION_UNTIL", raising=False)
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.return_value = [{"RowKey": "some_id"}]
+        table_client.get_entity.side_effect = [ResourceNotFoundError("missing"), {}]
+
+        assert (
+            check_duplicate("2023-10-27T21:55:00Z", "VIN1", table_service_client)
+            is True
+        )
+        assert table_client.get_entity.call_args_list == [
+            call("2023-10-27", "2023-10-27T21:55:00Z"),
+            call("messages", "2023-10-27T21:55:00Z"),
+        ]
+
+    def test_check_duplicate_skips_legacy_lookup(self, monkeypatch):
+        monkeypatch.setenv("DEDUPE_LEGACY_PARTITION_UNTIL", "2023-01-01")
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.get_entity.side_effect = ResourceNotFoundError("missing")
+
+        assert (
+            check_duplicate("2023-10-27T21:55:00Z", "VIN1", table_service_client)
+            is False
+        )
+        table_client.get_entity.assert_called_once()
+
+    def test_claim_id_writes_to_day_partition(self, monkeypatch):
+        monkeypatch.delenv("DEDUPE_LEGACY_PARTITION_UNTIL", raising=False)
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.return_value = [{"RowKey": "some_id"}]
+        table_client.get_entity.side_effect = ResourceNotFoundError("missing")
+
+        assert claim_id("2023-10-27T21:55:00Z", "VIN1", table_service_client) is True
+
+        table_client.get_entity.assert_called_once_with(
+            "messages", "2023-10-27T21:55:00Z"
+        )
+        assert (
+            table_client.create_entity.call_args.args[0]["PartitionKey"] == "2023-10-27"
+        )
+
+    def test_claim_id_respects_legacy_entity(self, monkeypatch):
+        monkeypatch.delenv("DEDUPE_LEGACY_PARTITION_UNTIL", raising=False)
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.return_value = [{"RowKey": "some_id"}]
+        table_client.get_entity.return_value = make_existing_entity()
+
+        assert claim_id("2023-10-27T21:55:00Z", "VIN1", table_service_client) is False
+        table_client.create_entity.assert_not_called()
+
+    def test_claim_ids_groups_by_day(self, monkeypatch):
+        monkeypatch.setenv("DEDUPE_LEGACY_PARTITION_UNTIL", "2023-10-28")
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.side_effect = lambda query_filter, **kwargs: (
+            [{"RowKey": "some_id"}] if query_filter == "PartitionKey eq 'messages'" else []
+        )
+        identifiers = ["2023-10-27T23:59:00Z", "2023-10-28T00:00:00Z"]
+
+        assert claim_ids(identifiers, "VIN1", table_service_client) == identifiers
+
+        assert [c.args[0] for c in table_client.query_entities.call_args_list] == [
+            "PartitionKey eq 'messages'",
+            "(PartitionKey eq '2023-10-27' or PartitionKey eq 'messages') "
+            "and (RowKey eq @id0)",
+            "PartitionKey eq '2023-10-28' and (RowKey eq @id0)",
+        ]
+        assert [
+            [o[1]["PartitionKey"] for o in c.args[0]]
+            for c in table_client.submit_transaction.call_args_list
+        ] == [["2023-10-27"], ["2023-10-28"]]
+
+        confirm_ids(identifiers, "VIN1", table_service_client)
+        assert table_client.submit_transaction.call_count == 4
+
+    def test_legacy_lookup_stops_once_partition_is_empty(self, monkeypatch):
+        monkeypatch.delenv("DEDUPE_LEGACY_PARTITION_UNTIL", raising=False)
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.return_value = []
+        table_client.get_entity.side_effect = ResourceNotFoundError("missing")
+
+        for identifier in ["2023-10-27T21:55:00Z", "2023-10-27T21:56:00Z"]:
+            assert check_duplicate(identifier, "VIN1", table_service_client) is False
+
+        # the empty partition is found with one query, and never looked up
+        table_client.query_entities.assert_called_once_with(
+            "PartitionKey eq 'messages'", select=["RowKey"], results_per_page=1
+        )
+        assert [c.args[0] for c in table_client.get_entity.call_args_list] == [
+            "2023-10-27",
+            "2023-10-27",
+        ]
+
+    def test_legacy_partition_in_use_checked_again_later(self, monkeypatch):
+        monkeypatch.setenv("DEDUPE_LEGACY_CHECK_SECONDS", "60")
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.side_effect = [[{"RowKey": "some_id"}], []]
+
+        with patch("shared_code.duplicate_check.time.monotonic") as monotonic:
+            monotonic.return_value = 1000.0
+            assert legacy_partition_in_use("VIN1", table_service_client) is True
+            monotonic.return_value = 1059.0
+            assert legacy_partition_in_use("VIN1", table_service_client) is True
+            assert table_client.query_entities.call_count == 1
+            monotonic.return_value = 1061.0
+            assert legacy_partition_in_use("VIN1", table_service_client) is False
+            assert legacy_partition_in_use("VIN1", table_service_client) is False
+        assert table_client.query_entities.call_count == 2
+
+
+class TestPurgeExpiredIDs:
+    older_than = datetime.datetime(2023, 10, 27, 12, 0, tzinfo=datetime.timezone.utc)
+
+    def test_day_partitions_purged_by_range(self, monkeypatch):
+        monkeypatch.delenv("DEDUPE_PARTITION_SCHEME", raising=False)
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        legacy = [
+            {"PartitionKey": "messages", "RowKey": f"2023-10-01T0{i}"} for i in range(2)
+        ]
+        days = [
+            {"PartitionKey": "2023-10-25", "RowKey": f"2023-10-25T{i:03d}"}
+            for i in range(TABLE_TRANSACTION_LIMIT + 1)
+        ] + [
+            {"PartitionKey": "2023-10-26", "RowKey": "2023-10-26T000"},
+            {"PartitionKey": "1f", "RowKey": "hashed"},
+        ]
+        table_client.query_entities.side_effect = [legacy, days]
+
+        assert (
+            purge_expired_ids("VIN1", table_service_client, self.older_than)
+            == TABLE_TRANSACTION_LIMIT + 3
+        )
+
+        assert table_client.query_entities.call_args_list == [
+            call(
+                "PartitionKey eq @legacy and Timestamp lt @older_than",
+                parameters={"legacy": "messages", "older_than": self.older_than},
+                select=["PartitionKey", "RowKey"],
+            ),
+            call(
+                "PartitionKey lt @older_than_day",
+                parameters={"older_than_day": "2023-10-27"},
+                select=["PartitionKey", "RowKey"],
+            ),
+        ]
+        transactions = [
+            c.args[0] for c in table_client.submit_transaction.call_args_list
+        ]
+        assert [len(t) for t in transactions] == [2, TABLE_TRANSACTION_LIMIT, 1]
+        assert all(
+            len({operation[1]["PartitionKey"] for operation in t}) == 1
+            for t in transactions
+        )
+        deleted = [o[1] for t in transactions for o in t]
+        assert {"PartitionKey": "1f", "RowKey": "hashed"} not in deleted
+        # the newest identifier is kept
+        assert {"PartitionKey": "2023-10-26", "RowKey": "2023-10-26T000"} not in deleted
+
+    def test_hash_partitions_scan_timestamps(self, monkeypatch):
+        monkeypatch.setenv("DEDUPE_PARTITION_SCHEME", "hash")
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.return_value = [
+            {"PartitionKey": "1f", "RowKey": "2023-10-20T00:00:00Z"},
+            {"PartitionKey": "2a", "RowKey": "2023-10-21T00:00:00Z"},
+        ]
+
+        assert purge_expired_ids("VIN1", table_service_client, self.older_than) == 1
+        table_client.submit_transaction.assert_called_once_with(
+            [("delete", {"PartitionKey": "1f", "RowKey": "2023-10-20T00:00:00Z"})]
+        )
+        table_client.query_entities.assert_called_once_with(
+            "Timestamp lt @older_than",
+            parameters={"older_than": self.older_than},
+            select=["PartitionKey", "RowKey"],
+        )
+
+    def test_parked_vehicle_keeps_its_identifier(self, monkeypatch):
+        monkeypatch.delenv("DEDUPE_PARTITION_SCHEME", raising=False)
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.side_effect = [
+            [],
+            [{"PartitionKey": "2023-10-20", "RowKey": "2023-10-20T08:00:00Z"}],
+        ]
+
+        assert purge_expired_ids("VIN1", table_service_client, self.older_than) == 0
+        table_client.submit_transaction.assert_not_called()
+
+    def test_missing_table(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.side_effect = ResourceNotFoundError("no table")
+
+        assert purge_expired_ids("VIN1", table_service_client, self.older_than) == 0
+
+    def test_delete_failure_raises(self):
+        table_service_client = Mock()
+        table_client = table_service_client.get_table_client.return_value
+        table_client.query_entities.return_value = [
+            {"PartitionKey": "messages", "RowKey": "m1"},
+            {"PartitionKey": "messages", "RowKey": "m2"},
+        ]
+        table_client.submit_transaction.side_effect = Exception("down")
+
+        with pytest.raises(Exception, match="Failed to delete expired identifiers"):
+            purge_expired_ids("VIN1", table_service_client, self.older_than)
+
+
 class TestWithRealTableServiceCall:
     def test_end_to_end(self):
         tsc = get_table_service_client()
@@ -40,10 +40,10 @@ class TestEmonToTimescale:
     @patch("shared_code.emon.json.loads")
     @patch("shared_code.emon.extract_timestamp")
     @patch("shared_code.emon.create_correlation_id")
-    @patch("shared_code.emon.create_record_recursive")
+    @patch("shared_code.emon.create_record_from_plan")
     def test_emon_to_timescale_subject_none(
         self,
-        mock_create_record_recursive,
+        mock_create_record_from_plan,
         mock_create_correlation_id,
         mock_extract_timestamp,
         mock_json_loads,
@@ -63,7 +63,7 @@ class TestEmonToTimescale:
         mock_validate_message_body.assert_called_once_with(payload, this_service)
         mock_validate_publisher.assert_called_once_with(publisher, this_service)
         mock_is_topic_of_interest.assert_called_once_with(topic, ["emonTx4"])
-        mock_create_record_recursive.assert_not_called()
+        mock_create_record_from_plan.assert_not_called()
 
     @patch("shared_code.emon.validate_message_body_type_and_keys")
     @patch("shared_code.emon.validate_publisher")
@@ -71,10 +71,10 @@ class TestEmonToTimescale:
     @patch("shared_code.emon.json.loads")
     @patch("shared_code.emon.extract_timestamp")
     @patch("shared_code.emon.create_correlation_id")
-    @patch("shared_code.emon.create_record_recursive")
+    @patch("shared_code.emon.create_record_from_plan")
     def test_emon_to_timescale_valid(
         self,
-        mock_create_record_recursive,
+        mock_create_record_from_plan,
         mock_create_correlation_id,
         mock_extract_timestamp,
         mock_json_loads,
@@ -86,7 +86,7 @@ class TestEmonToTimescale:
         mock_json_loads.return_value = {"payload_data": "some_data"}
         mock_extract_timestamp.return_value = "2023-01-01T00:00:00"
         mock_create_correlation_id.return_value = "correlation_id"
-        mock_create_record_recursive.return_value = "sample_record"
+        mock_create_record_from_plan.return_value = "sample_record"
         this_service = "emon"
         publisher = "test_publisher"
         topic = "abc/def"
@@ -100,7 +100,7 @@ class TestEmonToTimescale:
         mock_json_loads.assert_called_once_with('{"payload_data":"some_data"}')
         mock_extract_timestamp.assert_called_once_with({"payload_data": "some_data"})
         mock_create_correlation_id.assert_called_once()
-        mock_create_record_recursive.assert_called_once_with(
+        mock_create_record_from_plan.assert_called_once_with(
             payload=mock_json_loads.return_value,
             records=[],
             timestamp=mock_extract_timestamp.return_value,
@@ -109,4 +109,4 @@ class TestEmonToTimescale:
             measurement_subject=mock_is_topic_of_interest.return_value,
             ignore_keys=["time"],
         )
-        assert result == mock_create_record_recursive.return_value
+        assert result == mock_create_record_from_plan.return_value
@@ -55,9 +55,9 @@ class TestGetIgnoreKeys:
 
 class TestProcessMeasurementSubject:
     @pytest.fixture
-    def mock_create_record_recursive(self):
-        with patch("shared_code.glow.create_record_recursive") as mock:
-            # Simulate return values for create_record_recursive
+    def mock_create_record_from_plan(self):
+        with patch("shared_code.glow.create_record_from_plan") as mock:
+            # Simulate return values for create_record_from_plan
             mock.side_effect = lambda payload, records, **kwargs: records + [
                 "mocked_record"
             ]
@@ -71,7 +71,7 @@ class TestProcessMeasurementSubject:
     def test_process_measurement_subject(
         self,
         mock_get_ignore_keys,
-        mock_create_record_recursive,
+        mock_create_record_from_plan,
         measurement_subject,
         expected_calls,
     ):
@@ -91,11 +91,11 @@ class TestProcessMeasurementSubject:
             message_payload, timestamp, correlation_id, publisher, measurement_subject
         )
 
-        assert mock_create_record_recursive.call_count == expected_calls
+        assert mock_create_record_from_plan.call_count == expected_calls
         assert actual_result == ["mocked_record"] * expected_calls
 
         if measurement_subject in message_payload:
-            energy_call_args = mock_create_record_recursive.call_args_list[0]
+            energy_call_args = mock_create_record_from_plan.call_args_list[0]
             assert energy_call_args == (
                 {
                     "payload": message_payload[measurement_subject]["energy"]["import"],
@@ -110,7 +110,7 @@ class TestProcessMeasurementSubject:
             )
 
             if measurement_subject == "electricitymeter":
-                power_call_args = mock_create_record_recursive.call_args_list[1]
+                power_call_args = mock_create_record_from_plan.call_args_list[1]
                 assert power_call_args == (
                     {
                         "payload": message_payload[measurement_subject]["power"],
@@ -125,7 +125,7 @@ class TestProcessMeasurementSubject:
                     },
                 )
 
-    def test_invalid_measurement_subject(self, mock_create_record_recursive):
+    def test_invalid_measurement_subject(self, mock_create_record_from_plan):
         message_payload = {"valid_subject": {"some": "data"}}
         invalid_subject = "invalid_subject"
         records = glow.process_measurement_subject(
@@ -137,7 +137,7 @@ class TestProcessMeasurementSubject:
         )
 
         assert records == []
-        mock_create_record_recursive.assert_not_called()
+        mock_create_record_from_plan.assert_not_called()
 
 
 class TestGlowToTimescale:
@@ -1,5 +1,9 @@
 from shared_code import helpers
 from uuid import UUID
+from dateutil import parser
+import json
+import os
+import random
 from unittest.mock import patch
 import pytest
 
@@ -174,6 +178,72 @@ class TestToDatetime:
         assert f"Invalid string timestamp format: {timestamp}" in str(exc_info.value)
 
 
+class TestToDatetimeMatchesDateutil:
+    """Property test: the fast path must agree with plain dateutil parsing"""
+
+    @staticmethod
+    def reference_to_datetime_string(timestamp: str) -> str:
+        return parser.parse(timestamp).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+    @staticmethod
+    def random_iso_timestamps(count: int, seed: int = 20240101):
+        rng = random.Random(seed)
+        for _ in range(count):
+            value = f"{rng.randint(1, 9999):04d}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+            if rng.random() < 0.9:
+                value += rng.choice(["T", " "])
+                value += f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}"
+                if rng.random() < 0.8:
+                    value += f":{rng.randint(0, 59):02d}"
+                    if rng.random() < 0.5:
+                        value += "." + "".join(
+                            rng.choice("0123456789") for _ in range(rng.randint(1, 9))
+                        )
+                value += rng.choice(
+                    ["", "Z", f"+{rng.randint(0, 14):02d}:{rng.choice(['00', '30'])}"]
+                    + [f"-{rng.randint(0, 12):02d}:00"]
+                )
+            yield value
+
+    def test_random_iso_timestamps_match_dateutil(self):
+        for timestamp in self.random_iso_timestamps(2000):
+            assert helpers.to_datetime_string(
+                timestamp
+            ) == self.reference_to_datetime_string(timestamp), timestamp
+
+    @pytest.mark.parametrize(
+        "timestamp",
+        [
+            "2021-01-01T00:00:00.1234567",
+            "Sat, 26 Nov 2022 16:30:00 GMT",
+            "2022-11-26T16:30:00+0100",
+            "26/11/2022 16:30",
+            "2021-01-01T00:00:00z",
+        ],
+    )
+    def test_non_fast_path_strings_match_dateutil(self, timestamp):
+        assert helpers.to_datetime_string(
+            timestamp
+        ) == self.reference_to_datetime_string(timestamp)
+
+    def test_invalid_iso_shaped_string_falls_back(self):
+        with pytest.raises(ValueError, match="Invalid string timestamp format"):
+            helpers.to_datetime_string("2021-02-30")
+
+    def test_repeated_timestamp_is_memoised(self):
+        helpers.convert_timestamp_to_string.cache_clear()
+        with patch(
+            "shared_code.helpers.datetime", wraps=helpers.datetime
+        ) as mock_datetime:
+            for _ in range(3):
+                assert (
+                    helpers.to_datetime_string("2021-01-01T00:00:00Z")
+                    == "2021-01-01T00:00:00.000000Z"
+                )
+        assert mock_datetime.fromisoformat.call_count == 1
+        assert helpers.convert_timestamp_to_string.cache_info().hits == 2
+
+
 class TestValidatePublisher:
     def test_with_valid_publisher(self):
         result = helpers.validate_publisher("test_pub", "test_pub")
@@ -241,3 +311,86 @@ class TestRecursivelyDeserialize:
     def test_recursively_deserialize(self, test_data, expected_value):
         actual_value = helpers.recursively_deserialize(test_data)
         assert actual_value == expected_value
+
+
+class TestDeserializeNestedJson:
+    @pytest.mark.parametrize(
+        "test_data",
+        [
+            '{"a": 1}',
+            '{"a": 1',
+            None,
+            "",
+            "plain text",
+            " 12",
+            "true",
+            "-Infinity",
+            '"{\\"a\\": [1, \\"2\\"]}"',
+            '{"a": [{"b": 1}, {"c": 2}, "d"]}',
+            {"a": '{"b": "[1, 2]"}', "c": ("x", "3")},
+        ],
+    )
+    def test_matches_recursively_deserialize(self, test_data):
+        assert helpers.deserialize_nested_json(
+            test_data
+        ) == helpers.recursively_deserialize(test_data)
+
+    def test_matches_recursively_deserialize_on_bmw_state(self):
+        bmw_state_path = os.sep.join(
+            [
+                os.path.dirname(os.path.abspath(__file__)),
+                "..",
+                "..",
+                "test",
+                "cleaned_bmw_api_state_data.json",
+            ]
+        )
+        with open(bmw_state_path, "rb") as f:
+            raw = f.read()
+        expected = helpers.recursively_deserialize(raw.decode("utf-8"))
+        assert helpers.deserialize_nested_json(raw) == expected
+        assert helpers.deserialize_nested_json(raw.decode("utf-8")) == expected
+
+    @pytest.mark.parametrize(
+        "test_data, expected_value",
+        [
+            (b'{"a": "[1]"}', {"a": [1]}),
+            (bytearray(b"[1, 2]"), [1, 2]),
+            (b"not json", "not json"),
+            ("caf\u00e9".encode("latin-1"), "caf\u00e9".encode("latin-1")),
+            (b'{"a": "\xff"}', b'{"a": "\xff"}'),
+            (b"\xff\xfe\x00", b"\xff\xfe\x00"),
+        ],
+    )
+    def test_bytes(self, test_data, expected_value):
+        assert helpers.deserialize_nested_json(test_data) == expected_value
+
+    def test_plain_strings_are_not_parsed(self):
+        with patch("shared_code.helpers.json.loads", wraps=json.loads) as mock_loads:
+            result = helpers.deserialize_nested_json(
+                {"a": "kWh", "b": ["SSE", "electricitymeter"], "c": "1"}
+            )
+        assert result == {"a": "kWh", "b": ["SSE", "electricitymeter"], "c": 1}
+        mock_loads.assert_called_once_with("1")
+
+    def test_max_depth(self):
+        nested = {"a": {"b": {"c": "1"}}}
+        # the decoded value of "1" sits one level below the string that held it
+        assert helpers.deserialize_nested_json(nested, max_depth=4) == {
+            "a": {"b": {"c": 1}}
+        }
+        with pytest.raises(ValueError, match="Exceeded maximum depth of 3"):
+            helpers.deserialize_nested_json(nested, max_depth=3)
+
+    def test_max_depth_counts_encoded_strings(self):
+        encoded = json.dumps(json.dumps(json.dumps({"a": 1})))
+        with pytest.raises(ValueError, match="Exceeded maximum depth of 2"):
+            helpers.deserialize_nested_json(encoded, max_depth=2)
+
+    @pytest.mark.parametrize("test_data", ['{"a": 12345}', b'{"a": 12345}'])
+    def test_max_size(self, test_data):
+        with pytest.raises(ValueError, match="Exceeded maximum size of 5"):
+            helpers.deserialize_nested_json(test_data, max_size=5)
+
+    def test_max_size_ignores_plain_text(self):
+        assert helpers.deserialize_nested_json("x" * 10, max_size=5) == "x" * 10
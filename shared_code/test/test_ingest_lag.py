@@ -0,0 +1,152 @@
+import datetime
+import json
+from unittest.mock import Mock, patch
+
+import azure.functions as func
+
+from shared_code.ingest_lag import (
+    LagTracker,
+    format_enqueued_time,
+    get_partition_id,
+    parse_enqueued_time,
+    percentile,
+    stamp_records,
+)
+from shared_code.json_converter import convert_json_to_timeseries
+from test_utils.get_test_data import create_event_hub_event, load_test_data
+
+ENQUEUED = datetime.datetime(2024, 1, 1, 12, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def get_logged_lags(mock_logging) -> dict:
+    mock_logging.info.assert_called_once()
+    message = mock_logging.info.call_args[0][0]
+    assert message.startswith("ingest_lag: ")
+    return json.loads(message.removeprefix("ingest_lag: "))
+
+
+class TestEnqueuedTime:
+    def test_format_is_utc(self):
+        enqueued = datetime.datetime(
+            2024, 1, 1, 13, 0, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=1))
+        )
+        assert format_enqueued_time(enqueued) == "2024-01-01T12:00:00.000000Z"
+
+    def test_naive_times_are_utc(self):
+        assert format_enqueued_time(ENQUEUED.replace(tzinfo=None)) == (
+            "2024-01-01T12:00:00.000000Z"
+        )
+
+    def test_parse_round_trips(self):
+        assert parse_enqueued_time(format_enqueued_time(ENQUEUED)) == ENQUEUED
+
+    def test_parse_rejects_other_values(self):
+        assert parse_enqueued_time("not a time") is None
+        assert parse_enqueued_time(None) is None
+        assert parse_enqueued_time(12345) is None
+
+
+class TestStampRecords:
+    def test_stamps_dict_records(self):
+        records = [{"a": 1}, "not a record", {"b": 2}]
+        event = Mock(enqueued_time=ENQUEUED)
+        assert stamp_records(records, event) == ENQUEUED
+        assert records[0]["enqueued_time"] == "2024-01-01T12:00:00.000000Z"
+        assert records[1] == "not a record"
+        assert records[2]["enqueued_time"] == "2024-01-01T12:00:00.000000Z"
+
+    def test_leaves_records_alone_without_an_enqueue_time(self):
+        records = [{"a": 1}]
+        assert stamp_records(records, "a string event") is None
+        assert records == [{"a": 1}]
+
+
+class TestGetPartitionId:
+    def test_from_partition_context(self):
+        event = Mock(spec=func.EventHubEvent)
+        event.metadata = {"PartitionContext": {"PartitionId": 3}}
+        assert get_partition_id(event) == "3"
+
+    def test_falls_back_to_partition_key(self):
+        event = Mock(spec=func.EventHubEvent)
+        event.metadata = {}
+        event.partition_key = "key"
+        assert get_partition_id(event) == "key"
+
+    def test_unknown(self):
+        assert get_partition_id(Mock(spec=func.EventHubEvent)) == ""
+
+
+class TestPercentile:
+    def test_nearest_rank(self):
+        values = [float(i) for i in range(1, 101)]
+        assert percentile(values, 50) == 50
+        assert percentile(values, 99) == 99
+        assert percentile([7.0], 99) == 7
+
+
+class TestLagTracker:
+    def test_summarises_per_publisher_and_partition(self):
+        tracker = LagTracker("db_commit")
+        for seconds in (1, 2, 3):
+            tracker.add(ENQUEUED - datetime.timedelta(seconds=seconds), "glow", "0")
+        tracker.add(format_enqueued_time(ENQUEUED), "homie", "1")
+        tracker.add("not a time", "homie", "1")
+        tracker.complete(ENQUEUED)
+        assert tracker.pending == []
+        assert tracker.summarise() == [
+            {
+                "publisher": "glow",
+                "partition": "0",
+                "count": 3,
+                "p50_ms": 2000.0,
+                "p95_ms": 3000.0,
+                "p99_ms": 3000.0,
+                "max_ms": 3000.0,
+            },
+            {
+                "publisher": "homie",
+                "partition": "1",
+                "count": 1,
+                "p50_ms": 0.0,
+                "p95_ms": 0.0,
+                "p99_ms": 0.0,
+                "max_ms": 0.0,
+            },
+        ]
+
+    def test_discarded_records_have_no_lag(self):
+        tracker = LagTracker("db_commit")
+        tracker.add(ENQUEUED, "glow", "0")
+        tracker.discard()
+        tracker.complete(ENQUEUED)
+        with patch("shared_code.ingest_lag.logging") as mock_logging:
+            tracker.log()
+        mock_logging.info.assert_not_called()
+
+    def test_feeds_instrumentation(self):
+        tracker = LagTracker("converter_output")
+        tracker.add(ENQUEUED, "glow", "0")
+        with patch("shared_code.ingest_lag.observe") as mock_observe:
+            tracker.complete(ENQUEUED + datetime.timedelta(milliseconds=5))
+        mock_observe.assert_called_once_with("lag_to_converter_output", 5.0, "glow")
+
+
+class TestConverterOutputLag:
+    def test_records_carry_enqueue_time(self):
+        properties = dict(load_test_data()["homie_mode"]["properties"])
+        properties["enqueued_time"] = "2024-01-01T12:00:00Z"
+        event = create_event_hub_event(properties)
+        output = Mock(spec=func.Out)
+        with patch("shared_code.ingest_lag.logging") as mock_logging:
+            convert_json_to_timeseries([event], output)
+        messages = [json.loads(message) for message in output.set.call_args[0][0]]
+        assert messages
+        assert all(
+            message["enqueued_time"] == "2024-01-01T12:00:00.000000Z"
+            for message in messages
+        )
+        logged = get_logged_lags(mock_logging)
+        assert logged["stage"] == "converter_output"
+        assert [lag["publisher"] for lag in logged["lags"]] == ["homie"]
+        assert logged["lags"][0]["count"] == 1
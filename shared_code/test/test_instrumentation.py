@@ -0,0 +1,155 @@
+import json
+import pytest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
+
+import azure.functions as func
+
+from shared_code import instrumentation
+from shared_code.instrumentation import (
+    HISTOGRAM_BOUNDARIES_MS,
+    Histogram,
+    NO_TIMER,
+    count,
+    instrumented_invocation,
+    observe,
+    timed,
+)
+from shared_code.json_converter import convert_json_to_timeseries
+from shared_code.profiling import profiled
+from test_utils.get_test_data import create_event_hub_event, load_test_data
+
+
+def get_exported(mock_logging) -> dict:
+    mock_logging.info.assert_called_once()
+    message = mock_logging.info.call_args[0][0]
+    assert message.startswith("instrumentation: ")
+    return json.loads(message.removeprefix("instrumentation: "))
+
+
+def find(items: list, name: str, publisher: str = "") -> dict:
+    return next(
+        item
+        for item in items
+        if item["name"] == name and item["attributes"]["publisher"] == publisher
+    )
+
+
+class TestHistogram:
+    def test_buckets(self):
+        histogram = Histogram()
+        for value in (0.005, 0.01, 0.02, 20000):
+            histogram.record(value)
+        assert histogram.bucket_counts[0] == 2
+        assert histogram.bucket_counts[1] == 1
+        assert histogram.bucket_counts[len(HISTOGRAM_BOUNDARIES_MS)] == 1
+        assert histogram.to_dict()["count"] == 4
+        assert histogram.to_dict()["min"] == 0.005
+        assert histogram.to_dict()["max"] == 20000
+
+
+class TestInstrumentedInvocation:
+    def test_disabled_by_default(self, monkeypatch):
+        monkeypatch.delenv("INSTRUMENTATION", raising=False)
+        with patch("shared_code.instrumentation.logging") as mock_logging:
+            with instrumented_invocation("test"):
+                assert timed("decode") is NO_TIMER
+                count("events")
+                observe("lag", 10)
+        mock_logging.info.assert_not_called()
+        assert instrumentation.current_metrics.get() is None
+
+    def test_log_exporter(self, monkeypatch):
+        monkeypatch.setenv("INSTRUMENTATION", "log")
+        with patch("shared_code.instrumentation.logging") as mock_logging:
+            with instrumented_invocation("test"):
+                with timed("convert", "glow"):
+                    pass
+                count("records", "glow", 3)
+                count("records", "glow")
+                observe("lag", 10, "glow")
+        exported = get_exported(mock_logging)
+        assert exported["function"] == "test"
+        convert = find(exported["histograms"], "convert", "glow")
+        assert convert["count"] == 1
+        assert convert["unit"] == "ms"
+        assert find(exported["histograms"], "lag", "glow")["sum"] == 10
+        assert find(exported["histograms"], "invocation")["count"] == 1
+        assert find(exported["counters"], "records", "glow")["value"] == 4
+        assert instrumentation.current_metrics.get() is None
+        assert "invocation_id" not in exported
+
+    def test_invocation_id_from_profiled_context(self, monkeypatch):
+        monkeypatch.setenv("INSTRUMENTATION", "log")
+
+        def main(context):
+            with instrumented_invocation("test"):
+                pass
+
+        with patch("shared_code.instrumentation.logging") as mock_logging:
+            profiled("test")(main)(context=Mock(invocation_id="host-invocation-id"))
+        assert get_exported(mock_logging)["invocation_id"] == "host-invocation-id"
+        assert instrumentation.current_invocation_id.get() is None
+
+    def test_exported_when_invocation_fails(self, monkeypatch):
+        monkeypatch.setenv("INSTRUMENTATION", "log")
+        with patch("shared_code.instrumentation.logging") as mock_logging:
+            with pytest.raises(ValueError):
+                with instrumented_invocation("test"):
+                    raise ValueError("failed")
+        get_exported(mock_logging)
+
+    def test_unknown_exporter_disables(self, monkeypatch):
+        monkeypatch.setenv("INSTRUMENTATION", "statsd")
+        with patch("shared_code.instrumentation.logging") as mock_logging:
+            with instrumented_invocation("test"):
+                assert timed("decode") is NO_TIMER
+                count("events")
+        mock_logging.warning.assert_called_once()
+        assert "statsd" in mock_logging.warning.call_args[0][0]
+        mock_logging.info.assert_not_called()
+
+    def test_concurrent_invocations_kept_apart(self, monkeypatch):
+        monkeypatch.setenv("INSTRUMENTATION", "log")
+        both_started = threading.Barrier(2)
+
+        def invoke(publisher: str, events: int) -> None:
+            with instrumented_invocation(publisher):
+                both_started.wait()
+                count("events", publisher, events)
+                with timed("convert", publisher):
+                    both_started.wait()
+
+        with patch("shared_code.instrumentation.logging") as mock_logging:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(invoke, ["glow", "emon"], [1, 2]))
+        exported = {}
+        for c in mock_logging.info.call_args_list:
+            record = json.loads(c.args[0].removeprefix("instrumentation: "))
+            exported[record["function"]] = record
+        for publisher, events in [("glow", 1), ("emon", 2)]:
+            counters = exported[publisher]["counters"]
+            assert [c["attributes"]["publisher"] for c in counters] == [publisher]
+            assert find(counters, "events", publisher)["value"] == events
+            assert find(exported[publisher]["histograms"], "convert", publisher)
+
+
+class TestInstrumentedFunctions:
+    def test_json_converter_stages(self, monkeypatch):
+        monkeypatch.setenv("INSTRUMENTATION", "log")
+        monkeypatch.delenv("JSON_CONVERTER_WORKERS", raising=False)
+        test_data = load_test_data()
+        events = [
+            create_event_hub_event(test_data[name]["properties"])
+            for name in ("glow_electricitymeter", "emontx4_json", "homie_mode")
+        ]
+        with patch("shared_code.instrumentation.logging") as mock_logging:
+            convert_json_to_timeseries(events, Mock(spec=func.Out))
+        exported = get_exported(mock_logging)
+        for publisher in ("glow", "emon", "homie"):
+            assert find(exported["histograms"], "convert", publisher)["count"] == 1
+            assert find(exported["counters"], "events", publisher)["value"] == 1
+            assert find(exported["counters"], "records", publisher)["value"] > 0
+        assert find(exported["histograms"], "decode")["count"] == 3
+        assert find(exported["histograms"], "output_set")["count"] == 1
@@ -3,9 +3,12 @@ import json
 import datetime
 from typing import List
 from unittest.mock import Mock, patch
+from concurrent.futures.process import BrokenProcessPool
 import azure.functions as func
 
 from shared_code import json_converter
+from shared_code.ingest_lag import format_enqueued_time
+from test_utils.get_test_data import create_event_hub_event, load_test_data
 
 
 def create_eventhub_event(body: str) -> func.EventHubEvent:
@@ -198,10 +201,12 @@ class TestSendMessages:
             ),
         ],
     )
+    @patch("shared_code.structured_log.logging")
     @patch("shared_code.json_converter.logging")
     def test_send_messages_success(
         self,
         mock_logging,
+        mock_structured_logging,
         messages,
         expected_message_count,
         ids,
@@ -214,10 +219,17 @@ class TestSendMessages:
         assert len(message_payload) == expected_message_count
         assert isinstance(message_payload, List)
         assert all(isinstance(message, str) for message in message_payload)
-        assert mock_logging.info.call_count == 1
-        assert mock_logging.info.call_args[0][0] == (
-            f"json_converter: Sent {expected_message_count} messages with correlation ids: {ids}"
-        )
+        logger = mock_structured_logging.getLogger.return_value
+        assert logger.log.call_count == 1
+        message = logger.log.call_args[0][1]
+        assert message.startswith("json_converter.sent: ")
+        assert json.loads(message.removeprefix("json_converter.sent: ")) == {
+            "messages": expected_message_count,
+            "failed": 0,
+            "records_by_publisher": {"": expected_message_count},
+            "correlation_id_count": len(ids),
+            "correlation_ids": ids,
+        }
         assert mock_logging.error.call_count == 0
 
     @pytest.mark.parametrize(
@@ -385,10 +397,9 @@ class TestConvertJsonToTimeseries:
 
         # Assert that send_messages is called correctly
         mock_send_messages.assert_called_once()
-        # Extract the first argument passed to send_messages
-        sent_messages = mock_send_messages.call_args[0][0]
+        # Extract the first argument passed to send_messages; it is a lazy iterator
+        sent_messages = list(mock_send_messages.call_args[0][0])
         # check that we have list[Any] and not list[list[Any]] | None]
-        assert isinstance(sent_messages, list)
         assert all(not isinstance(item, list) for item in sent_messages)
         assert all(item is not None for item in sent_messages)
         # check that the correct messages are sent
@@ -403,6 +414,137 @@ class TestConvertJsonToTimeseries:
         assert mock_convert_event.call_count == len(events)
 
 
+class TestFlattenConvertedEvents:
+    def test_flatten_converted_events(self):
+        converted_events = [[{"a": 1}, {"b": 2}], None, {"c": 3}, [], [{"d": 4}]]
+        assert list(json_converter.flatten_converted_events(converted_events)) == [
+            {"a": 1},
+            {"b": 2},
+            {"c": 3},
+            {"d": 4},
+        ]
+
+    def test_flatten_converted_events_is_lazy(self):
+        def converted_events():
+            yield [{"a": 1}]
+            raise AssertionError("should not be consumed")
+
+        flattened = json_converter.flatten_converted_events(converted_events())
+        assert next(flattened) == {"a": 1}
+
+
+class TestConvertJsonToTimeseriesEndToEnd:
+    def test_output_matches_eager_pipeline(self):
+        test_data = load_test_data()
+        events = [
+            create_event_hub_event(test_data[name]["properties"])
+            for name in ["glow_electricitymeter", "homie_mode", "emontx4_json"]
+        ]
+        output = Mock(spec=func.Out)
+        with patch("shared_code.helpers.uuid4", return_value="fixed-id"):
+            json_converter.convert_json_to_timeseries(events, output)
+            # each message carries the enqueue time of its event
+            expected = [
+                json.dumps(
+                    message
+                    | {"enqueued_time": format_enqueued_time(event.enqueued_time)}
+                )
+                for event in events
+                for message in (
+                    json_converter.convert_event(event.get_body().decode("utf-8")) or []
+                )
+            ]
+        output.set.assert_called_once_with(expected)
+
+
+class TestGetParallelWorkers:
+    @pytest.mark.parametrize(
+        "workers, threshold, batch_size, expected",
+        [
+            (None, None, 1000, 0),  # off by default
+            ("0", None, 1000, 0),
+            ("4", None, 255, 0),  # below the default threshold
+            ("4", None, 256, 4),
+            ("2", "10", 9, 0),
+            ("2", "10", 10, 2),
+        ],
+    )
+    def test_get_parallel_workers(
+        self, monkeypatch, workers, threshold, batch_size, expected
+    ):
+        for name, value in [
+            ("JSON_CONVERTER_WORKERS", workers),
+            ("JSON_CONVERTER_PARALLEL_THRESHOLD", threshold),
+        ]:
+            if value is None:
+                monkeypatch.delenv(name, raising=False)
+            else:
+                monkeypatch.setenv(name, value)
+        assert json_converter.get_parallel_workers(batch_size) == expected
+
+
+class TestConvertEventsInParallel:
+    @pytest.fixture(autouse=True)
+    def shutdown_pool(self):
+        yield
+        json_converter.shutdown_process_pool()
+
+    def test_preserves_order_and_isolates_errors(self):
+        test_data = load_test_data()
+        event_strings = [
+            create_event_hub_event(test_data[name]["properties"])
+            .get_body()
+            .decode("utf-8")
+            for name in ["homie_mode", "emontx4_json", "glow_gasmeter"]
+        ] * 5
+        event_strings.insert(7, "not json")
+        event_strings.insert(3, '{"topic": "unknown/publisher"}')
+
+        with patch("shared_code.helpers.uuid4", return_value="fixed-id"):
+            expected = [json_converter.convert_event(event) for event in event_strings]
+        actual = json_converter.convert_events_in_parallel(event_strings, 2)
+
+        def without_correlation_ids(converted):
+            return [
+                (
+                    None
+                    if records is None
+                    else [{**r, "correlation_id": None} for r in records]
+                )
+                for records in converted
+            ]
+
+        assert without_correlation_ids(actual) == without_correlation_ids(expected)
+        assert actual[3] is None and actual[8] is None
+        assert sum(records is not None for records in actual) == 15
+
+    def test_pool_is_reused(self):
+        first = json_converter.get_process_pool(2)
+        assert json_converter.get_process_pool(2) is first
+        assert json_converter.get_process_pool(3) is not first
+
+    @patch("shared_code.json_converter.get_process_pool")
+    def test_broken_pool_falls_back_to_serial(self, mock_get_process_pool):
+        mock_get_process_pool.return_value.map.side_effect = BrokenProcessPool("dead")
+        with patch("shared_code.json_converter.convert_event") as mock_convert_event:
+            mock_convert_event.side_effect = lambda event: [event]
+            result = json_converter.convert_events_in_parallel(["a", "b"], 2)
+        assert result == [["a"], ["b"]]
+
+    @patch("shared_code.json_converter.convert_events_in_parallel")
+    @patch("shared_code.json_converter.send_messages")
+    def test_convert_json_to_timeseries_uses_pool_above_threshold(
+        self, mock_send_messages, mock_convert_events_in_parallel, monkeypatch
+    ):
+        monkeypatch.setenv("JSON_CONVERTER_WORKERS", "2")
+        monkeypatch.setenv("JSON_CONVERTER_PARALLEL_THRESHOLD", "2")
+        mock_convert_events_in_parallel.return_value = [[{"a": 1}], None]
+        json_converter.convert_json_to_timeseries(["x", "y"], Mock(spec=func.Out))
+        assert list(mock_convert_events_in_parallel.call_args[0][0]) == ["x", "y"]
+        assert mock_convert_events_in_parallel.call_args[0][1] == 2
+        assert list(mock_send_messages.call_args[0][0]) == [{"a": 1}]
+
+
 class TestConvertEvent:
     @pytest.mark.parametrize(
         "event_str, expected_payload",
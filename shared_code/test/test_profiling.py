@@ -0,0 +1,126 @@
+import os
+import time
+import tracemalloc
+from unittest.mock import Mock, patch
+
+import pytest
+
+from shared_code.profiling import (
+    SamplingProfiler,
+    profiled,
+    report,
+    should_profile,
+    summarise_stacks,
+)
+
+
+def busy(milliseconds: float) -> int:
+    deadline = time.perf_counter() + milliseconds / 1000
+    total = 0
+    while time.perf_counter() < deadline:
+        total += sum(range(100))
+    return total
+
+
+@pytest.fixture
+def profile_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("PROFILE_DIR", str(tmp_path))
+    for name in ["PROFILE_MODE", "PROFILE_SAMPLE_RATE", "PROFILE_TRACEMALLOC"]:
+        monkeypatch.delenv(name, raising=False)
+    return tmp_path
+
+
+class TestShouldProfile:
+    def test_disabled_by_default(self, profile_dir):
+        assert should_profile() is False
+
+    def test_unknown_mode(self, profile_dir, monkeypatch):
+        monkeypatch.setenv("PROFILE_MODE", "perf")
+        with pytest.raises(ValueError, match="Unknown PROFILE_MODE: perf"):
+            should_profile()
+
+    def test_invalid_sample_rate(self, profile_dir, monkeypatch):
+        monkeypatch.setenv("PROFILE_MODE", "cprofile")
+        monkeypatch.setenv("PROFILE_SAMPLE_RATE", "0")
+        with pytest.raises(ValueError, match="PROFILE_SAMPLE_RATE must be at least 1"):
+            should_profile()
+
+    def test_one_in_n(self, profile_dir, monkeypatch):
+        monkeypatch.setenv("PROFILE_MODE", "sample")
+        monkeypatch.setenv("PROFILE_SAMPLE_RATE", "10")
+        with patch("shared_code.profiling.random.randrange", side_effect=[0, 3]):
+            assert should_profile() is True
+            assert should_profile() is False
+
+
+class TestProfiled:
+    def test_not_profiled_when_disabled(self, profile_dir):
+        assert profiled("test")(busy)(1) > 0
+        assert os.listdir(profile_dir) == []
+
+    def test_cprofile_and_tracemalloc(self, profile_dir, monkeypatch):
+        monkeypatch.setenv("PROFILE_MODE", "cprofile")
+        monkeypatch.setenv("PROFILE_TRACEMALLOC", "true")
+        profiled("test")(busy)(5)
+        kinds = sorted(name.rsplit(".", 1)[1] for name in os.listdir(profile_dir))
+        assert kinds == ["prof", "tracemalloc"]
+        lines = list(report(str(profile_dir), "test"))
+        assert lines[0] == "== cProfile: 1 invocations, by own time"
+        assert any("busy" in line for line in lines)
+        assert "== tracemalloc: 1 invocations, by bytes allocated at the end" in lines
+
+    def test_profile_written_when_main_raises(self, profile_dir, monkeypatch):
+        monkeypatch.setenv("PROFILE_MODE", "sample")
+
+        def main():
+            busy(20)
+            raise RuntimeError("converter failed")
+
+        with pytest.raises(RuntimeError, match="converter failed"):
+            profiled("test")(main)()
+        assert [name.rsplit(".", 1)[1] for name in os.listdir(profile_dir)] == [
+            "stacks"
+        ]
+
+    def test_named_with_invocation_id_from_context(self, profile_dir, monkeypatch):
+        monkeypatch.setenv("PROFILE_MODE", "sample")
+
+        def main(context):
+            busy(5)
+
+        profiled("test")(main)(context=Mock(invocation_id="host-invocation-id"))
+        assert os.listdir(profile_dir) == ["test.host-invocation-id.stacks"]
+
+    def test_memory_not_traced_while_already_tracing(self, profile_dir, monkeypatch):
+        monkeypatch.setenv("PROFILE_TRACEMALLOC", "true")
+        tracemalloc.start()
+        try:
+            with patch("shared_code.profiling.logging") as mock_logging:
+                profiled("test")(busy)(1)
+            # the other tracer is left running
+            assert tracemalloc.is_tracing()
+        finally:
+            tracemalloc.stop()
+        assert os.listdir(profile_dir) == []
+        assert "already tracing" in mock_logging.warning.call_args[0][0]
+
+    def test_keeps_the_signature_of_main(self):
+        def main(events: list, outputEventHubMessage: str) -> None:
+            pass
+
+        assert profiled("test")(main).__wrapped__ is main
+
+
+class TestSamplingProfiler:
+    def test_samples_the_calling_thread(self, tmp_path):
+        sampler = SamplingProfiler(interval_ms=1)
+        sampler.start()
+        busy(50)
+        sampler.stop()
+        path = str(tmp_path / "test.1.stacks")
+        sampler.dump(path)
+        samples, self_samples, total_samples = summarise_stacks([path])
+        assert samples > 0
+        busy_frames = [frame for frame in total_samples if frame.startswith("busy ")]
+        assert busy_frames
+        assert sum(total_samples[frame] for frame in busy_frames) > samples / 2
@@ -0,0 +1,58 @@
+import os
+from unittest.mock import patch
+
+import pytest
+
+from shared_code import settings
+from shared_code.settings import Settings, get_settings, reload_settings
+
+POSTGRES_ENVIRONMENT = {
+    "POSTGRES_DB": "db",
+    "POSTGRES_USER": "user",
+    "POSTGRES_PASSWORD": "password",
+    "POSTGRES_HOST": "host",
+    "POSTGRES_PORT": "5432",
+}
+
+
+@pytest.fixture(autouse=True)
+def restore_settings():
+    yield
+    reload_settings()
+
+
+class TestSettings:
+    def test_from_environment(self):
+        with patch.dict(
+            os.environ, POSTGRES_ENVIRONMENT | {"TABLE_NAME": "conditions"}, clear=True
+        ):
+            loaded = Settings.from_environment()
+        assert loaded.table_name == "conditions"
+        assert loaded.missing_postgres_variables == ()
+        assert (
+            loaded.connection_string
+            == "dbname=db user=user password=password host=host port=5432"
+        )
+
+    def test_missing_postgres_variables(self):
+        environment = dict(POSTGRES_ENVIRONMENT)
+        del environment["POSTGRES_HOST"]
+        with patch.dict(os.environ, environment, clear=True):
+            loaded = Settings.from_environment()
+        assert loaded.missing_postgres_variables == ("POSTGRES_HOST",)
+        assert loaded.connection_string is None
+        assert loaded.table_name is None
+
+
+class TestGetSettings:
+    def test_loaded_once_and_shared(self):
+        first = reload_settings()
+        assert get_settings() is first
+        assert reload_settings() is not first
+
+    def test_environment_file_loaded_once(self, monkeypatch):
+        monkeypatch.setattr(settings, "environment_loaded", False)
+        with patch("dotenv_vault.load_dotenv") as mock_load_dotenv:
+            reload_settings()
+            reload_settings()
+        mock_load_dotenv.assert_called_once_with()
@@ -0,0 +1,118 @@
+import json
+import logging
+from unittest.mock import Mock, patch
+
+import pytest
+
+from shared_code import structured_log
+from shared_code.structured_log import log_event, log_sampled, truncate
+
+
+@pytest.fixture(autouse=True)
+def reset_settings(monkeypatch):
+    for name in ["LOG_MAX_FIELD_CHARS", "LOG_SAMPLE_RATE"]:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(structured_log, "positive_ints", {})
+
+
+@pytest.fixture
+def mock_logger(monkeypatch):
+    monkeypatch.setattr(structured_log, "sample_counts", {})
+    with patch("shared_code.structured_log.logging") as mock_logging:
+        logger = mock_logging.getLogger.return_value
+        logger.isEnabledFor.return_value = True
+        yield logger
+
+
+def get_logged_records(mock_logger, event: str) -> list:
+    records = []
+    for call in mock_logger.log.call_args_list:
+        level, message = call.args
+        assert message.startswith(f"{event}: ")
+        records.append(json.loads(message.removeprefix(f"{event}: ")))
+    return records
+
+
+class TestTruncate:
+    def test_short_value_unchanged(self):
+        assert truncate("abc", 3) == "abc"
+
+    def test_long_value_cut(self):
+        assert truncate("abcdef", 3) == "abc... (3 more characters)"
+
+    def test_default_from_environment(self, monkeypatch):
+        monkeypatch.setenv("LOG_MAX_FIELD_CHARS", "2")
+        assert truncate("abcdef") == "ab... (4 more characters)"
+
+    @pytest.mark.parametrize("max_chars", ["0", "ten"])
+    def test_invalid_max_chars(self, monkeypatch, caplog, max_chars):
+        monkeypatch.setenv("LOG_MAX_FIELD_CHARS", max_chars)
+        assert truncate("x" * 1001) == "x" * 1000 + "... (1 more characters)"
+        assert f"Ignoring LOG_MAX_FIELD_CHARS='{max_chars}'" in caplog.text
+
+    def test_setting_read_once(self, monkeypatch):
+        monkeypatch.setenv("LOG_MAX_FIELD_CHARS", "2")
+        truncate("abc")
+        monkeypatch.setenv("LOG_MAX_FIELD_CHARS", "5")
+        assert truncate("abcdef") == "ab... (4 more characters)"
+
+
+class TestLogEvent:
+    def test_writes_one_structured_record(self, mock_logger):
+        log_event(logging.INFO, "test.sent", messages=2, ids=["a", "b"], error=None)
+        mock_logger.log.assert_called_once()
+        assert mock_logger.log.call_args.args[0] == logging.INFO
+        assert get_logged_records(mock_logger, "test.sent") == [
+            {"messages": 2, "ids": ["a", "b"], "error": None}
+        ]
+
+    def test_nothing_formatted_when_level_disabled(self, mock_logger):
+        mock_logger.isEnabledFor.return_value = False
+        payload = Mock()
+        log_event(logging.DEBUG, "test.payload", payload=payload)
+        payload.assert_not_called()
+        mock_logger.log.assert_not_called()
+
+    def test_callable_fields_called_when_written(self, mock_logger):
+        log_event(logging.INFO, "test.sent", ids=lambda: ["a"])
+        assert get_logged_records(mock_logger, "test.sent") == [{"ids": ["a"]}]
+
+    def test_large_fields_truncated(self, mock_logger, monkeypatch):
+        monkeypatch.setenv("LOG_MAX_FIELD_CHARS", "10")
+        log_event(logging.INFO, "test.sent", text="x" * 15, ids=["abc", "def"])
+        assert get_logged_records(mock_logger, "test.sent") == [
+            {
+                "text": "xxxxxxxxxx... (5 more characters)",
+                "ids": '["abc", "d... (4 more characters)',
+            }
+        ]
+
+
+class TestLogSampled:
+    def test_writes_first_and_every_nth(self, mock_logger, monkeypatch):
+        monkeypatch.setenv("LOG_SAMPLE_RATE", "3")
+        for i in range(7):
+            log_sampled(logging.DEBUG, "test.record", i=i)
+        assert get_logged_records(mock_logger, "test.record") == [
+            {"sample_rate": 3, "seen": 1, "i": 0},
+            {"sample_rate": 3, "seen": 4, "i": 3},
+            {"sample_rate": 3, "seen": 7, "i": 6},
+        ]
+
+    def test_invalid_sample_rate(self, mock_logger, monkeypatch):
+        monkeypatch.setenv("LOG_SAMPLE_RATE", "-1")
+        log_sampled(logging.DEBUG, "test.record")
+        assert get_logged_records(mock_logger, "test.record") == [
+            {"sample_rate": 100, "seen": 1}
+        ]
+
+    def test_events_sampled_separately(self, mock_logger):
+        log_sampled(logging.DEBUG, "test.first")
+        log_sampled(logging.DEBUG, "test.second")
+        assert mock_logger.log.call_count == 2
+
+    def test_not_counted_when_level_disabled(self, mock_logger):
+        mock_logger.isEnabledFor.return_value = False
+        log_sampled(logging.DEBUG, "test.record")
+        assert structured_log.sample_counts == {}
+        mock_logger.log.assert_not_called()
@@ -4,6 +4,7 @@ from typing import Any, Tuple
 from dateutil import parser
 from dotenv import load_dotenv
 from shared_code import timescale
+from shared_code.settings import load_environment, reload_settings
 import azure.functions as func
 
 
@@ -127,13 +128,33 @@ class db_helpers:
             db_helpers.check_record(actual_record[0], expected_record)
 
 
+@pytest.fixture
+def restore_settings():
+    # load .env first, so loading it later cannot override the environment a test patches
+    load_environment()
+    yield
+    # settings are read once per worker, so read them again once the environment is restored
+    reload_settings()
+
+
+@pytest.mark.usefixtures("restore_settings")
 class Test_get_table_name:
     def test_get_table_name_success(self):
         with patch.dict(os.environ, {"TABLE_NAME": "test_table"}):
+            reload_settings()
             assert get_table_name() == "test_table"
 
+    def test_get_table_name_is_read_once(self):
+        with patch.dict(os.environ, {"TABLE_NAME": "test_table"}):
+            reload_settings()
+            os.environ["TABLE_NAME"] = "changed"
+            assert get_table_name() == "test_table"
+            reload_settings()
+            assert get_table_name() == "changed"
+
     def test_get_table_name_failure(self):
         with patch.dict(os.environ, {}, clear=True):
+            reload_settings()
             with pytest.raises(ValueError) as excinfo:
                 get_table_name()
             assert (
@@ -142,6 +163,7 @@ class Test_get_table_name:
             )
 
 
+@pytest.mark.usefixtures("restore_settings")
 class Test_get_connection_string:
     def test_get_connection_string_from_components(self):
         mock_env_vars = {
@@ -152,11 +174,13 @@ class Test_get_connection_string:
             "POSTGRES_PORT": "test_port",
         }
         with patch.dict(os.environ, mock_env_vars, clear=True):
+            reload_settings()
             expected_conn_string = "dbname=test_db user=test_user password=test_password host=test_host port=test_port"
             assert get_connection_string() == expected_conn_string
 
     def test_get_connection_string_missing_env_vars(self):
         with patch.dict(os.environ, {}, clear=True):
+            reload_settings()
             with pytest.raises(ValueError) as excinfo:
                 get_connection_string()
             assert str(excinfo.value).startswith(
@@ -626,8 +650,9 @@ class TestStoreData:
         # Call the function
         timescale.store_data(events)
 
-        assert mock_conn.__enter__.call_count == 1
-        assert mock_conn.__exit__.call_count == 1
+        mock_conn.commit.assert_called_once()
+        # a Mock connection is never idle, so it is closed rather than kept in the pool
+        mock_conn.close.assert_called_once()
         mock_create_single_timescale_record.assert_called()
         assert mock_create_single_timescale_record.call_count == len(events)
 
@@ -656,8 +681,9 @@ class TestStoreData:
         with pytest.raises(Exception) as exc_info:
             timescale.store_data(events)
 
-        assert mock_conn.__enter__.call_count == 1
-        assert mock_conn.__exit__.call_count == 1
+        mock_conn.commit.assert_called_once()
+        # a Mock connection is never idle, so it is closed rather than kept in the pool
+        mock_conn.close.assert_called_once()
         assert len(exc_info.value.args[0]) == 1
         assert error in exc_info.value.args[0]
 
@@ -682,7 +708,7 @@ class TestStoreData:
         # Simulate raised errors for certain events
         raised_errors = [Exception("Error 1"), Exception("Error 2")]
         mock_create_single_timescale_record.side_effect = (
-            lambda conn, record_batch, table_name: raised_errors
+            lambda conn, record_batch, table_name, **kwargs: raised_errors
             if "error_event" in record_batch
             else []
         )
@@ -701,6 +727,84 @@ class TestStoreData:
             assert error in exc_info.value.args[0]
 
         mock_connect.assert_called_once_with("test_connection_string")
-        assert mock_conn.__enter__.call_count == 1
-        assert mock_conn.__exit__.call_count == 1
+        mock_conn.commit.assert_called_once()
+        # a Mock connection is never idle, so it is closed rather than kept in the pool
+        mock_conn.close.assert_called_once()
         assert mock_create_single_timescale_record.call_count == len(events)
+
+
+def create_mock_connection(transaction_status=psycopg.pq.TransactionStatus.IDLE):
+    conn = Mock(closed=False)
+    conn.info.transaction_status = transaction_status
+    return conn
+
+
+class TestConnectionPool:
+    @patch("shared_code.timescale.psycopg.connect")
+    def test_reuses_idle_connection(self, mock_connect):
+        mock_connect.side_effect = lambda _: create_mock_connection()
+        pool = timescale.ConnectionPool("dsn")
+        first = pool.acquire()
+        pool.release(first)
+        assert pool.acquire() is first
+        assert mock_connect.call_count == 1
+
+    @patch("shared_code.timescale.psycopg.connect")
+    def test_concurrent_invocations_get_their_own_connection(self, mock_connect):
+        mock_connect.side_effect = lambda _: create_mock_connection()
+        pool = timescale.ConnectionPool("dsn")
+        assert pool.acquire() is not pool.acquire()
+
+    def test_closes_connection_left_in_a_transaction(self):
+        pool = timescale.ConnectionPool("dsn")
+        conn = create_mock_connection(psycopg.pq.TransactionStatus.INERROR)
+        pool.release(conn)
+        conn.close.assert_called_once()
+        assert pool.idle == []
+
+    def test_skips_closed_connections(self):
+        pool = timescale.ConnectionPool("dsn")
+        conn = create_mock_connection()
+        pool.release(conn)
+        conn.closed = True
+        with patch("shared_code.timescale.psycopg.connect") as mock_connect:
+            assert pool.acquire() is mock_connect.return_value
+
+    def test_replaces_dead_connection(self):
+        pool = timescale.ConnectionPool("dsn")
+        conn = create_mock_connection()
+        pool.release(conn)
+        conn.execute.side_effect = psycopg.OperationalError("server closed the connection")
+        with patch("shared_code.timescale.psycopg.connect") as mock_connect:
+            assert pool.acquire() is mock_connect.return_value
+        conn.execute.assert_called_once_with("SELECT 1")
+        conn.close.assert_called_once()
+        assert pool.idle == []
+
+    def test_checks_idle_connection_before_reuse(self):
+        pool = timescale.ConnectionPool("dsn")
+        conn = create_mock_connection()
+        pool.release(conn)
+        assert pool.acquire() is conn
+        conn.execute.assert_called_once_with("SELECT 1")
+        conn.rollback.assert_called_once()
+
+    def test_keeps_at_most_max_idle(self):
+        pool = timescale.ConnectionPool("dsn", max_idle=1)
+        connections = [create_mock_connection() for _ in range(2)]
+        for conn in connections:
+            pool.release(conn)
+        assert pool.idle == connections[:1]
+        connections[1].close.assert_called_once()
+
+    @patch("shared_code.timescale.psycopg.connect")
+    def test_warm_up(self, mock_connect):
+        mock_connect.side_effect = lambda _: create_mock_connection()
+        pool = timescale.ConnectionPool("dsn")
+        pool.warm_up(2)
+        pool.warm_up(2)
+        assert len(pool.idle) == 2
+        assert mock_connect.call_count == 2
+        for conn in pool.idle:
+            conn.execute.assert_called_once_with("SELECT 1")
+            conn.rollback.assert_called_once()
@@ -247,3 +247,123 @@ class TestCreateRecordRecursive:
             measurement_data_type=mock_get_record_type.return_value,
             correlation_id="test_correlation_id",
         )
+
+
+class TestCreateRecordFromPlan:
+    @pytest.fixture(autouse=True)
+    def clear_plans(self):
+        timeseries.clear_record_plan_cache()
+        yield
+        timeseries.clear_record_plan_cache()
+
+    @pytest.mark.parametrize(
+        "payload, ignore_keys, measurement_of_prefix",
+        [
+            ({"level1": {"level2": {"data": 100}}}, None, None),
+            ({"ignore": 100, "data": 200}, ["ignore"], None),
+            ({"data": 200, "nested": {"flag": True, "name": "x"}}, None, "prefix"),
+            ({"location": [51.5, -0.1], "empty": {}, "value": 1.5}, ["units"], None),
+            (
+                {
+                    "cumulative": 1.1,
+                    "units": "kWh",
+                    "price": {"unitrate": 0.3, "standingcharge": 0.5},
+                },
+                ["units", "mpan"],
+                "import",
+            ),
+        ],
+    )
+    def test_matches_create_record_recursive(
+        self, payload, ignore_keys, measurement_of_prefix
+    ):
+        args = ("2023-01-01T00:00:00+00:00", "correlation_id", "glow", "subject")
+        expected = timeseries.create_record_recursive(
+            payload, [], *args, ignore_keys, measurement_of_prefix
+        )
+        # run twice so that the second call is served from the cached plan
+        for _ in range(2):
+            actual = timeseries.create_record_from_plan(
+                payload, [], *args, ignore_keys, measurement_of_prefix
+            )
+            assert actual == expected
+
+    def test_plan_reused_for_same_shape(self):
+        args = ("2023-01-01T00:00:00+00:00", "correlation_id", "emon", "emonTx4")
+        with patch(
+            "shared_code.timeseries.compile_record_plan",
+            wraps=timeseries.compile_record_plan,
+        ) as mock_compile:
+            first = timeseries.create_record_from_plan(
+                {"a": 1, "b": {"c": 2}}, [], *args
+            )
+            compile_calls = mock_compile.call_count
+            second = timeseries.create_record_from_plan(
+                {"a": 3, "b": {"c": 4}}, [], *args
+            )
+        assert mock_compile.call_count == compile_calls
+        assert [r["measurement_value"] for r in first] == [1, 2]
+        assert [r["measurement_value"] for r in second] == [3, 4]
+
+    def test_new_plan_when_leaf_type_changes(self):
+        args = ("2023-01-01T00:00:00+00:00", "correlation_id", "emon", "emonTx4")
+        number = timeseries.create_record_from_plan({"a": 1}, [], *args)
+        boolean = timeseries.create_record_from_plan({"a": True}, [], *args)
+        assert number[0]["measurement_data_type"] == "number"
+        assert boolean[0]["measurement_data_type"] == "boolean"
+
+    @pytest.mark.parametrize(
+        "changed",
+        [
+            {"a": 1, "b": {"c": 2, "d": 3}},
+            {"a": 1, "b": {"d": 2}},
+            {"a": 1, "b": 2},
+            {"a": 1, "b": {"c": {"d": 2}}},
+            {"a": 1, "b": {"c": "two"}},
+        ],
+    )
+    def test_new_plan_when_nested_shape_changes(self, changed):
+        args = ("2023-01-01T00:00:00+00:00", "correlation_id", "emon", "emonTx4")
+        timeseries.create_record_from_plan({"a": 1, "b": {"c": 2}}, [], *args)
+        expected = timeseries.create_record_recursive(changed, [], *args)
+        assert timeseries.create_record_from_plan(changed, [], *args) == expected
+
+    def test_plans_kept_per_subject(self):
+        payload = {"a": 1}
+        timeseries.create_record_from_plan(payload, [], "t", "id", "emon", "first")
+        with patch(
+            "shared_code.timeseries.compile_record_plan",
+            wraps=timeseries.compile_record_plan,
+        ) as mock_compile:
+            records = timeseries.create_record_from_plan(
+                payload, [], "t", "id", "emon", "second"
+            )
+        mock_compile.assert_called_once()
+        assert records[0]["measurement_subject"] == "second"
+
+    def test_list_leaf_is_checked_per_message(self):
+        args = ("2023-01-01T00:00:00+00:00", "correlation_id", "emon", "emonTx4")
+        timeseries.create_record_from_plan({"a": [1, 2]}, [], *args)
+        with pytest.raises(
+            TypeError, match=r".*List is not a valid coordinate pair: .*"
+        ):
+            timeseries.create_record_from_plan({"a": [1, 2, 3]}, [], *args)
+
+    def test_unknown_type_raises(self):
+        args = ("2023-01-01T00:00:00+00:00", "correlation_id", "emon", "emonTx4")
+        with pytest.raises(TypeError, match=r".*Unknown payload type: NoneType.*"):
+            timeseries.create_record_from_plan({"a": None}, [], *args)
+
+    def test_empty_payload(self):
+        records = ["existing"]
+        result = timeseries.create_record_from_plan(
+            {}, records, "2023-01-01T00:00:00+00:00", "id", "glow", "subject"
+        )
+        assert result == ["existing"]
+
+    @patch("shared_code.timeseries.RECORD_PLAN_CACHE_SIZE", 2)
+    def test_cache_is_bounded(self):
+        args = ("2023-01-01T00:00:00+00:00", "correlation_id", "emon", "emonTx4")
+        for key in ["a", "b", "c"]:
+            timeseries.create_record_from_plan({key: 1}, [], *args)
+        assert len(timeseries._record_plans) == 2
@@ -0,0 +1,115 @@
+import json
+from unittest.mock import Mock, patch
+
+import pytest
+
+from shared_code import json_converter, warm_up
+from shared_code.dedupe_backend import MemoryDedupeBackend, TableDedupeBackend
+
+
+def get_logged_report(mock_logging) -> dict:
+    mock_logging.info.assert_called_once()
+    message = mock_logging.info.call_args[0][0]
+    assert message.startswith("warm_up: ")
+    return json.loads(message.removeprefix("warm_up: "))
+
+
+class TestWarmUp:
+    def test_runs_steps_in_order_and_reports_durations(self):
+        calls = []
+        steps = [
+            ("first", lambda: calls.append("first")),
+            ("second", lambda: calls.append("second")),
+        ]
+        with patch.dict(warm_up.WARM_UP_STEPS, {"test": steps}), patch(
+            "shared_code.warm_up.logging"
+        ) as mock_logging:
+            report = warm_up.warm_up("test")
+        assert calls == ["first", "second"]
+        assert list(report["steps_ms"]) == ["first", "second"]
+        assert report["total_ms"] >= 0
+        assert report["errors"] == {}
+        assert get_logged_report(mock_logging) == report
+
+    def test_failed_step_is_reported_and_skipped(self):
+        def fail():
+            raise ConnectionError("no route to host")
+
+        steps = [("connect", fail), ("after", Mock())]
+        with patch.dict(warm_up.WARM_UP_STEPS, {"test": steps}), patch(
+            "shared_code.warm_up.logging"
+        ) as mock_logging:
+            report = warm_up.warm_up("test")
+        assert report["errors"] == {"connect": "ConnectionError: no route to host"}
+        steps[1][1].assert_called_once_with()
+        mock_logging.warning.assert_called_once()
+
+    def test_timeseries_to_timescale_opens_connections(self, monkeypatch):
+        monkeypatch.setenv("WARM_UP_DB_CONNECTIONS", "2")
+        with patch("shared_code.timescale.get_connection_pool") as mock_get_pool, patch(
+            "shared_code.timescale.get_validator"
+        ) as mock_get_validator:
+            report = warm_up.warm_up("timeseries_to_timescale")
+        assert report["errors"] == {}
+        mock_get_validator.assert_called_once_with()
+        mock_get_pool.return_value.warm_up.assert_called_once_with(2)
+
+
+class TestStartWarmUp:
+    def test_disabled_by_default(self, monkeypatch):
+        monkeypatch.delenv("WARM_UP", raising=False)
+        with patch("shared_code.warm_up.warm_up") as mock_warm_up:
+            assert warm_up.start_warm_up("json_to_timeseries") is None
+        mock_warm_up.assert_not_called()
+
+    def test_unknown_mode(self, monkeypatch):
+        monkeypatch.setenv("WARM_UP", "eager")
+        with pytest.raises(ValueError, match="Unknown WARM_UP: eager"):
+            warm_up.start_warm_up("json_to_timeseries")
+
+    def test_foreground(self, monkeypatch):
+        monkeypatch.setenv("WARM_UP", "foreground")
+        with patch("shared_code.warm_up.warm_up") as mock_warm_up:
+            assert warm_up.start_warm_up("json_to_timeseries") is None
+        mock_warm_up.assert_called_once_with("json_to_timeseries")
+
+    def test_background(self, monkeypatch):
+        monkeypatch.setenv("WARM_UP", "background")
+        with patch("shared_code.warm_up.warm_up") as mock_warm_up:
+            thread = warm_up.start_warm_up("json_to_timeseries")
+            thread.join(timeout=5)
+        assert thread.daemon
+        mock_warm_up.assert_called_once_with("json_to_timeseries")
+
+
+class TestDedupeBackendWarmUp:
+    @patch("shared_code.dedupe_backend.duplicate_check.ensure_table_exists")
+    def test_table_backend_creates_each_table(self, mock_ensure_table_exists):
+        client = Mock()
+        TableDedupeBackend(client).warm_up(["VIN1", "VIN2"])
+        assert [call.args for call in mock_ensure_table_exists.call_args_list] == [
+            ("VIN1", client),
+            ("VIN2", client),
+        ]
+
+    def test_memory_backend_has_nothing_to_do(self):
+        assert MemoryDedupeBackend().warm_up(["VIN1"]) is None
+
+
+class TestProcessPoolWarmUp:
+    def test_nothing_to_start_when_serial(self, monkeypatch):
+        monkeypatch.setenv("JSON_CONVERTER_WORKERS", "0")
+        with patch("shared_code.json_converter.get_process_pool") as mock_get_pool:
+            json_converter.warm_up_process_pool()
+        mock_get_pool.assert_not_called()
+
+    def test_starts_every_worker(self, monkeypatch):
+        monkeypatch.setenv("JSON_CONVERTER_WORKERS", "2")
+        mock_pool = Mock()
+        with patch(
+            "shared_code.json_converter.get_process_pool", return_value=mock_pool
+        ) as mock_get_pool:
+            json_converter.warm_up_process_pool()
+        mock_get_pool.assert_called_once_with(2)
+        assert mock_pool.submit.call_count == 2
+        mock_pool.submit.assert_called_with(json_converter.warm_up_worker)
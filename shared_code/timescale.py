@@ -1,63 +1,158 @@
 import os
 import logging
+import threading
 
-from typing import Any, Union, List
-from dotenv_vault import load_dotenv
+from typing import Any, Dict, Optional, Union, List
 
 import psycopg as psycopg
 import azure.functions as func
 
+from .ingest_lag import ENQUEUED_TIME_FIELD, LagTracker, get_partition_id
+from .instrumentation import count, instrumented_invocation, timed
+from .settings import get_settings
 
-from jsonschema import validate
-import json
 
-load_dotenv()
+from jsonschema import validators
+from jsonschema.protocols import Validator
+from jsonschema.exceptions import best_match
+import json
 
 
 def store_data(events: List[func.EventHubEvent]):
-    conn = psycopg.connect(get_connection_string())
-    errors: List[Exception] = []
-    with conn:  # will close the connection when done
-        for event in events:
-            try:
-                record_batch = event.get_body().decode("utf-8")
-                if raised_errors := create_single_timescale_record(
-                    conn, record_batch, get_table_name()
-                ):
-                    errors.extend(raised_errors)
-            except Exception as e:
-                logging.error(f"Error creating timescale records: {e}")
-                errors.append(e)
-    if errors:
-        raise Exception(errors)
+    with instrumented_invocation("timeseries_to_timescale"):
+        pool = get_connection_pool()
+        with timed("db_connect"):
+            conn = pool.acquire()
+        errors: List[Exception] = []
+        lag_tracker = LagTracker("db_commit")
+        table_name = get_table_name()
+        try:
+            for event in events:
+                try:
+                    record_batch = event.get_body().decode("utf-8")
+                    if raised_errors := create_single_timescale_record(
+                        conn,
+                        record_batch,
+                        table_name,
+                        lag_tracker=lag_tracker,
+                        partition=get_partition_id(event),
+                    ):
+                        errors.extend(raised_errors)
+                except Exception as e:
+                    logging.error(f"Error creating timescale records: {e}")
+                    count("record_errors")
+                    errors.append(e)
+            if conn.info.transaction_status == psycopg.pq.TransactionStatus.INERROR:
+                # the commit will roll back, so nothing reached the table
+                lag_tracker.discard()
+            with timed("db_commit"):
+                conn.commit()
+            lag_tracker.complete()
+        finally:
+            # back to the pool for the next invocation, or closed if the transaction did not end
+            pool.release(conn)
+        lag_tracker.log()
+        if errors:
+            raise Exception(errors)
+
+
+class ConnectionPool:
+    """Connections to one database, kept open between invocations on the same worker
+
+    Invocations may run concurrently on a worker, so each takes a connection of its own and
+    returns it when done. At most max_idle connections are kept.
+    """
+
+    def __init__(self, connection_string: str, max_idle: int = 4):
+        self.connection_string = connection_string
+        self.max_idle = max_idle
+        self.idle: List[psycopg.Connection] = []
+        self.lock = threading.Lock()
+
+    def acquire(self) -> psycopg.Connection:
+        """An idle connection may have been dropped by the server or the network while it waited,
+        which conn.closed does not show until it is used, so each is checked with a round trip first
+        @return: an idle connection which is still alive, or a new one if there is none
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn = self.idle.pop()
+            if not conn.closed and self.is_alive(conn):
+                return conn
+            conn.close()
+        return psycopg.connect(self.connection_string)
+
+    @staticmethod
+    def is_alive(conn: psycopg.Connection) -> bool:
+        try:
+            conn.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg.Error as e:
+            logging.warning(f"timescale: Discarding a dead pooled connection: {e}")
+            return False
+
+    def release(self, conn: psycopg.Connection) -> None:
+        """Keep the connection for reuse if it is open and outside a transaction, otherwise close it"""  # noqa: E501
+        if (
+            not conn.closed
+            and conn.info.transaction_status == psycopg.pq.TransactionStatus.IDLE
+        ):
+            with self.lock:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append(conn)
+                    return
+        conn.close()
+
+    def warm_up(self, size: int = 1) -> None:
+        """Open connections until size are idle, checking each with a round trip"""
+        with self.lock:
+            needed = size - len(self.idle)
+        connections = [psycopg.connect(self.connection_string) for _ in range(needed)]
+        for conn in connections:
+            conn.execute("SELECT 1")
+            conn.rollback()
+            self.release(conn)
+
+
+# one pool per connection string, reused by every invocation on this worker
+connection_pools: Dict[str, ConnectionPool] = {}
+connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool() -> ConnectionPool:
+    """Get the pool of connections to the timescale database
+    @return: the pool
+    @throws: ValueError if any of the connection settings are missing
+    """
+    connection_string = get_connection_string()
+    with connection_pools_lock:
+        if connection_string not in connection_pools:
+            connection_pools[connection_string] = ConnectionPool(connection_string)
+        return connection_pools[connection_string]
 
 
 def get_connection_string() -> str:
     """Get the connection string for the timescale database
+    Built from POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST and POSTGRES_PORT,
+    once per worker, see settings.get_settings.
     @return: the connection string
     """
-    # if we have a connection string in the environment, use that
-    # otherwise, look for the individual components
-    # which are POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_PORT, TABLE_NAME
-    required_env_vars = [
-        "POSTGRES_DB",
-        "POSTGRES_USER",
-        "POSTGRES_PASSWORD",
-        "POSTGRES_HOST",
-        "POSTGRES_PORT",
-    ]
-    if missing_env_vars := [
-        env_var for env_var in required_env_vars if env_var not in os.environ
-    ]:
-        raise ValueError(f"Missing required environment variables: {missing_env_vars}")
-    return f"dbname={os.environ['POSTGRES_DB']} user={os.environ['POSTGRES_USER']} password={os.environ['POSTGRES_PASSWORD']} host={os.environ['POSTGRES_HOST']} port={os.environ['POSTGRES_PORT']}"  # noqa: E501
+    settings = get_settings()
+    if settings.missing_postgres_variables:
+        raise ValueError(
+            f"Missing required environment variables: {list(settings.missing_postgres_variables)}"
+        )
+    return settings.connection_string
 
 
 def get_table_name() -> str:
     """Get the table name for the timescale database
     @return: the table name
     """
-    if table_name := os.environ.get("TABLE_NAME"):
+    if table_name := get_settings().table_name:
         return table_name
     else:
         raise ValueError("Missing required environment variable: TABLE_NAME")
@@ -70,6 +165,21 @@ schema_path = os.sep.join(
 with open(schema_path) as f:
     schema = json.load(f)
 
+validator: Optional[Validator] = None
+
+
+def get_validator() -> Validator:
+    """Get a validator for the timeseries schema, checking and compiling the schema on first use
+    jsonschema.validate does both on every call.
+    @return: the validator
+    """
+    global validator
+    if validator is None:
+        validator_class = validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        validator = validator_class(schema)
+    return validator
+
 
 # def create_timescale_records_from_batch_of_events(
 #     conn: psycopg.Connection, record_set: str, table_name: str
@@ -96,15 +206,28 @@ with open(schema_path) as f:
 
 
 def create_single_timescale_record(
-    conn: psycopg.Connection, string_record: str, table_name: str
+    conn: psycopg.Connection,
+    string_record: str,
+    table_name: str,
+    lag_tracker: Optional[LagTracker] = None,
+    partition: str = "",
 ) -> None:
     """Create a single timescale record
     @param record: the record to create
+    @param lag_tracker: where to add the record once inserted, to measure its lag to commit
+    @param partition: the EventHub partition the record was read from
     """
-    record = json.loads(string_record)
-    validate(instance=record, schema=schema)
-
-    with conn.cursor() as cur:
+    with timed("decode"):
+        record = json.loads(string_record)
+    publisher = (
+        record.get("measurement_publisher", "") if isinstance(record, dict) else ""
+    )
+    with timed("validate", publisher):
+        # the same error jsonschema.validate would raise
+        if error := best_match(get_validator().iter_errors(record)):
+            raise error
+
+    with conn.cursor() as cur, timed("db_execute", publisher):
         result = cur.execute(
             f"INSERT INTO {table_name} (timestamp, measurement_publisher, measurement_subject, correlation_id, measurement_of, {identify_data_column(record['measurement_data_type'])}) VALUES (%s, %s, %s, %s, %s, %s)",  # noqa: E501
             (
@@ -122,6 +245,9 @@ def create_single_timescale_record(
             raise ValueError(f"Failed to insert record: {record}")
         elif result.rowcount > 1:
             raise ValueError(f"Inserted too many records: {record}")
+    count("records", publisher)
+    if lag_tracker is not None:
+        lag_tracker.add(record.get(ENQUEUED_TIME_FIELD), publisher, partition)
 
 
 def validate_all_fields_in_record(record: dict[str, Any]) -> None:
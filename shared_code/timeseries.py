@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import Any, List
+from typing import Any, List, Optional, Tuple
 
 
 class PayloadType(Enum):
@@ -98,6 +98,168 @@ def create_record_recursive(
     return records
 
 
+# compiled flattening plans, keyed on (publisher, subject, prefix, ignore_keys, top-level keys)
+# each plan is the size of every nested dict, by path, and a (path, measurement_of, payload type,
+# leaf type) entry per leaf
+RECORD_PLAN_CACHE_SIZE = 256
+RecordPlan = Tuple[
+    List[Tuple[tuple, int]], List[Tuple[tuple, str, Optional[PayloadType], type]]
+]
+_record_plans: dict[tuple, RecordPlan] = {}
+
+
+def create_record_from_plan(
+    payload: dict,
+    records: List,
+    timestamp: str,
+    correlation_id: str,
+    measurement_publisher: str,
+    measurement_subject: str,
+    ignore_keys: list = None,
+    measurement_of_prefix: str = None,
+) -> List[dict[str, Any]]:
+    """creates the same records as create_record_recursive, but caches a flattening plan per payload shape
+    Payloads which repeat the same key structure (e.g. glow and emon) skip the prefix building
+    and type detection on every message and emit records straight from the cached plan. Plans are
+    looked up on the publisher, subject and top-level keys only, so finding one costs no more than
+    the message has keys; the nested keys and leaf types are checked as the plan is applied, and a
+    payload whose shape has changed gets a new plan.
+    Args:
+        payload (dict): payload of the record to be parsed
+        records (Array[TimescaleRecord]): list of records to be returned
+        timestamp (str): timestamp in ISO format with timezone
+        correlation_id (str): unique id for the record set
+        measurement_publisher (str): publisher of the record
+        measurement_subject (str): subject of the record
+        ignore_keys (list): list of keys to ignore (also will not be recursed)
+        measurement_of_prefix (str): prefix to add to the measurement_of field
+    Returns:
+        dict: record in the format expected by TimescaleDB
+    """  # noqa: E501
+    if payload is None or not payload:
+        return records
+    ignore_set = frozenset(ignore_keys) if ignore_keys else frozenset()
+    plan_key = (
+        measurement_publisher,
+        measurement_subject,
+        measurement_of_prefix,
+        ignore_set,
+        tuple(payload),
+    )
+    plan = _record_plans.get(plan_key)
+    values = None if plan is None else get_plan_values(plan, payload)
+    if values is None:
+        plan = compile_record_plan(payload, ignore_set, measurement_of_prefix)
+        if (
+            plan_key not in _record_plans
+            and len(_record_plans) >= RECORD_PLAN_CACHE_SIZE
+        ):
+            # evict the oldest plan; dicts preserve insertion order
+            del _record_plans[next(iter(_record_plans))]
+        _record_plans[plan_key] = plan
+        values = get_plan_values(plan, payload)
+    for (_, measurement_of, payload_type, _), value in zip(plan[1], values):
+        records.append(
+            create_atomic_record(
+                source_timestamp=timestamp,
+                measurement_publisher=measurement_publisher,
+                measurement_subject=measurement_subject,
+                measurement_of=measurement_of,
+                measurement_value=value,
+                measurement_data_type=payload_type or get_record_type(value),
+                correlation_id=correlation_id,
+            )
+        )
+    return records
+
+
+def get_plan_values(plan: RecordPlan, payload: dict) -> Optional[List[Any]]:
+    """Looks up the leaf values of a payload at the paths of a plan, if the payload has the plan's shape
+    Args:
+        plan (RecordPlan): plan compiled from a payload with the same top-level keys
+        payload (dict): payload to read
+    Returns:
+        list: the value of each leaf of the plan, or None if the nested keys or leaf types differ
+    """  # noqa: E501
+    dict_sizes, leaves = plan
+    values = []
+    try:
+        # every planned key is present, so a nested dict of the same size has no other keys
+        for path, size in dict_sizes:
+            if len(get_path(payload, path)) != size:
+                return None
+        for path, _, _, leaf_type in leaves:
+            value = get_path(payload, path)
+            if type(value) is not leaf_type:
+                return None
+            values.append(value)
+    except (KeyError, TypeError):
+        # a planned dict is now a leaf, or a planned key is missing
+        return None
+    return values
+
+
+def get_path(payload: dict, path: tuple) -> Any:
+    value = payload
+    for key in path:
+        value = value[key]
+    return value
+
+
+def clear_record_plan_cache() -> None:
+    """Discards all compiled flattening plans"""
+    _record_plans.clear()
+
+
+def compile_record_plan(
+    payload: dict,
+    ignore_keys: frozenset,
+    measurement_of_prefix: str = None,
+    path: tuple = (),
+    plan: Optional[RecordPlan] = None,
+) -> RecordPlan:
+    """Walks a payload in the same order as create_record_recursive and records where each leaf lives
+    Args:
+        payload (dict): payload to walk
+        ignore_keys (frozenset): keys to ignore (also will not be recursed)
+        measurement_of_prefix (str): prefix to add to the measurement_of field
+        path (tuple): keys leading to this payload from the root
+        plan (RecordPlan): plan to add this payload to, for nested payloads
+    Returns:
+        RecordPlan: the size of each nested dict, and the (path, measurement_of, payload type, leaf type) of
+                    each leaf. The payload type is None for lists, which are checked per message as their
+                    contents decide whether they are a valid coordinate pair
+    Raises:
+        TypeError: If a leaf type is not recognized
+    """  # noqa: E501
+    if plan is None:
+        plan = ([], [])
+    if path:
+        plan[0].append((path, len(payload)))
+    for key, value in payload.items():
+        if key in ignore_keys:
+            continue
+        if isinstance(value, dict):
+            compile_record_plan(
+                value, ignore_keys, measurement_of_prefix, path + (key,), plan
+            )
+        else:
+            payload_type = get_record_type(value)
+            plan[1].append(
+                (
+                    path + (key,),
+                    (
+                        key
+                        if measurement_of_prefix is None
+                        else f"{measurement_of_prefix}_{key}"
+                    ),
+                    None if isinstance(value, list) else payload_type,
+                    type(value),
+                )
+            )
+    return plan
+
+
 def get_record_type(payload):
     """Gets the type of the payload and maps it to the PayloadType enum.
        This is important as we store different types of data in different columns in the database.
@@ -0,0 +1,109 @@
+"""Warm-up of a functions worker before its first invocation
+
+A fresh worker pays for importing the modules behind a function, opening connections and
+building clients and validators on its first invocation, inside the latency budget of that
+invocation's events. When WARM_UP is set, each function module starts its warm-up when the host
+imports it:
+    background: in a daemon thread, so the host is not held up. The first invocation waits only
+        for whatever it needs which is not ready yet, e.g. the connection pool's lock.
+    foreground: before the import returns, so the first invocation finds everything ready.
+
+Each warm-up ends with one "warm_up:" log record holding the duration of every step.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+MODES = {"background", "foreground"}
+
+
+def warm_up_json_converter() -> None:
+    from .json_converter import warm_up_process_pool
+
+    warm_up_process_pool()
+
+
+def warm_up_validator() -> None:
+    from .timescale import get_validator
+
+    get_validator()
+
+
+def warm_up_db_connections() -> None:
+    from .timescale import get_connection_pool
+
+    get_connection_pool().warm_up(int(os.environ.get("WARM_UP_DB_CONNECTIONS") or 1))
+
+
+def warm_up_dedupe_backend() -> None:
+    from .dedupe_backend import get_dedupe_backend, get_vins
+
+    get_dedupe_backend().warm_up(get_vins())
+
+
+# the steps for each function, run in order
+WARM_UP_STEPS: Dict[str, List[Tuple[str, Callable[[], None]]]] = {
+    "json_to_timeseries": [("process_pool", warm_up_json_converter)],
+    "timeseries_to_timescale": [
+        ("validator", warm_up_validator),
+        ("db_connections", warm_up_db_connections),
+    ],
+    "bmw_to_timescale": [("dedupe_backend", warm_up_dedupe_backend)],
+}
+
+
+def warm_up(function_name: str) -> Dict[str, Any]:
+    """Run the warm-up steps of a function, and log how long each took
+    A step which fails is logged and skipped; the invocation will try again and raise if it must.
+    @param function_name: the function to warm up
+    @return: the duration of each step in ms, the total, and the error of each step which failed
+    """
+    start = time.perf_counter()
+    steps: Dict[str, float] = {}
+    errors: Dict[str, str] = {}
+    for step, run_step in WARM_UP_STEPS.get(function_name, []):
+        step_start = time.perf_counter()
+        try:
+            run_step()
+        except Exception as e:
+            logging.warning(f"warm_up: {function_name} step {step} failed: {e}")
+            errors[step] = f"{type(e).__name__}: {e}"
+        steps[step] = round((time.perf_counter() - step_start) * 1000, 3)
+    report = {
+        "function": function_name,
+        "steps_ms": steps,
+        "total_ms": round((time.perf_counter() - start) * 1000, 3),
+        "errors": errors,
+    }
+    logging.info("warm_up: " + json.dumps(report))
+    return report
+
+
+def start_warm_up(function_name: str) -> Optional[threading.Thread]:
+    """Warm up a function as WARM_UP says, called when the function module is imported
+
+    Environment variables used:
+        WARM_UP: "background" or "foreground". Unset or empty to disable.
+        WARM_UP_DB_CONNECTIONS: How many database connections timeseries_to_timescale opens. Defaults to 1.
+
+    @param function_name: the function to warm up
+    @return: the warm-up thread, if running in the background
+    @raises ValueError: if WARM_UP is not a known mode
+    """  # noqa: E501
+    mode = (os.environ.get("WARM_UP") or "").lower()
+    if not mode:
+        return None
+    if mode not in MODES:
+        raise ValueError(f"Unknown WARM_UP: {mode}")
+    if mode == "foreground":
+        warm_up(function_name)
+        return None
+    thread = threading.Thread(
+        target=warm_up, args=(function_name,), name="warm_up", daemon=True
+    )
+    thread.start()
+    return thread
@@ -44,7 +44,8 @@ def test_function_signature(folder_name):
         for binding in function_config['bindings']
         if binding['name'] != '$return'
     }
-    main_params = set(inspect.signature(module.main).parameters)
+    # the host passes the invocation context to a parameter named context, which has no binding
+    main_params = set(inspect.signature(module.main).parameters) - {"context"}
 
     missing_in_main = binding_names - main_params
     missing_in_bindings = main_params - binding_names
@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from benchmarks.bench_import_time import ROOT, UNUSED_LIBRARIES
+
+
+@pytest.mark.parametrize("entry_point", sorted(UNUSED_LIBRARIES))
+def test_entry_point_does_not_import_unused_libraries(entry_point):
+    # a fresh interpreter, as sys.modules here already holds everything the other tests imported
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys, {entry_point}; print(' '.join(sorted(sys.modules)))",
+        ],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imported = set(result.stdout.split())
+    assert [
+        library for library in UNUSED_LIBRARIES[entry_point] if library in imported
+    ] == []
+
+
+@pytest.mark.parametrize("entry_point", sorted(UNUSED_LIBRARIES))
+def test_entry_point_loads_dotenv(entry_point, tmp_path):
+    # the functions host runs from the app root, where .env is found
+    (tmp_path / ".env").write_text('JSON_CONVERTER_WORKERS="3"\n')
+    environment = {
+        name: value
+        for name, value in os.environ.items()
+        if name not in ("DOTENV_KEY", "JSON_CONVERTER_WORKERS")
+    }
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import os, {entry_point}; print(os.environ.get('JSON_CONVERTER_WORKERS'))",
+        ],
+        cwd=tmp_path,
+        env=environment | {"PYTHONPATH": str(ROOT)},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == "3"
@@ -1,30 +1,37 @@
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from bmw_to_timescale import main as bmw_to_timescale_main
 from bmw_update import main as bmw_update_main
+from dedupe_purge import main as dedupe_purge_main
 from json_to_timeseries import main as json_to_timeseries_main
 from timeseries_to_timescale import main as timeseries_to_timescale_main
 
 
 @patch("bmw_to_timescale.convert_bmw_to_timescale")
 def test_bmw_to_timescale(mock_convert_bmw_to_timescale):
-    bmw_to_timescale_main("event", "outputEventHubMessage", "outputEHMonitor")
+    bmw_to_timescale_main(
+        "event", "outputEventHubMessage", "outputEHMonitor", context=Mock()
+    )
     mock_convert_bmw_to_timescale.assert_called_once_with(
         "event", "outputEventHubMessage", "outputEHMonitor"
     )
 
 
-@patch("bmw_update.get_and_serialise_car_data")
-def test_bmw_update(mock_get_and_serialise_car_data):
-    mock_get_and_serialise_car_data.return_value = "mytimer_data_return_value"
-    return_value = bmw_update_main("mytimer_data")
-    mock_get_and_serialise_car_data.assert_called_once_with()
-    assert return_value == mock_get_and_serialise_car_data.return_value
+@patch("bmw_update.publish_car_data")
+def test_bmw_update(mock_publish_car_data):
+    bmw_update_main("mytimer_data", "outputEventHubMessage", context=Mock())
+    mock_publish_car_data.assert_called_once_with("outputEventHubMessage")
+
+
+@patch("dedupe_purge.purge_dedupe_store")
+def test_dedupe_purge(mock_purge_dedupe_store):
+    dedupe_purge_main("mytimer_data")
+    mock_purge_dedupe_store.assert_called_once_with()
 
 
 @patch("json_to_timeseries.convert_json_to_timeseries")
 def test_json_to_timeseries(mock_convert_json_to_timeseries):
-    json_to_timeseries_main(["event"], ["outputEventHubMessage"])
+    json_to_timeseries_main(["event"], ["outputEventHubMessage"], context=Mock())
     mock_convert_json_to_timeseries.assert_called_once_with(
         ["event"], ["outputEventHubMessage"]
     )
@@ -32,5 +39,5 @@ def test_json_to_timeseries(mock_convert_json_to_timeseries):
 
 @patch("timeseries_to_timescale.store_data")
 def test_timeseries_to_timescale(mock_store_data):
-    timeseries_to_timescale_main(["event"])
+    timeseries_to_timescale_main(["event"], context=Mock())
     mock_store_data.assert_called_once_with(["event"])
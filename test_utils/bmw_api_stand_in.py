@@ -0,0 +1,146 @@
+"""
+An offline stand-in for the MyBMW API, so the token handling in shared_code.bmw can be tested
+without credentials or network access.
+
+The stand-in replaces the network calls of bimmer_connected's authentication (password login and
+refresh token exchange), the vehicle list and each vehicle's state fetch. Everything else, including bimmer_connected's
+decision to use the access token, refresh, or log in again, runs as normal.
+"""
+
+import asyncio
+import datetime
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+from unittest.mock import patch
+
+import httpx
+from bimmer_connected.account import MyBMWAccount
+from bimmer_connected.api.authentication import MyBMWAuthentication
+
+
+class StandInVehicle:
+    def __init__(self, stand_in: "BMWAPIStandIn", data: Dict[str, Any]):
+        self.stand_in = stand_in
+        self.vin = data["vin"]
+        self.data = data
+
+    async def get_vehicle_state(self) -> None:
+        await self.stand_in.get_vehicle_state(self)
+
+
+class BMWAPIStandIn:
+    def __init__(
+        self,
+        vehicles: Optional[List[Dict[str, Any]]] = None,
+        token_lifetime: datetime.timedelta = datetime.timedelta(hours=1),
+        state_delays: Optional[Dict[str, float]] = None,
+        state_errors: Optional[Dict[str, Exception]] = None,
+    ):
+        """
+        @param vehicles: the vehicle data returned by the vehicle list, each with at least a "vin"
+        @param token_lifetime: how long issued access tokens are valid for
+        @param state_delays: seconds each VIN's state fetch takes, default none
+        @param state_errors: an exception each VIN's state fetch raises, default none
+        """
+        self.vehicles = vehicles if vehicles is not None else []
+        self.token_lifetime = token_lifetime
+        self.state_delays = state_delays or {}
+        self.state_errors = state_errors or {}
+        self.login_calls = 0
+        self.refresh_calls = 0
+        self.vehicle_calls = 0
+        self.state_calls = 0
+        self.concurrent_state_calls = 0
+        self.max_concurrent_state_calls = 0
+        self.valid_access_tokens: set[str] = set()
+        self.valid_refresh_tokens: set[str] = set()
+        self.tokens_issued = 0
+
+    def issue_tokens(self) -> Dict[str, Any]:
+        """Issue a new access and refresh token, in the format bimmer_connected expects"""
+        self.tokens_issued += 1
+        access_token = f"access-{self.tokens_issued}"
+        refresh_token = f"refresh-{self.tokens_issued}"
+        self.valid_access_tokens.add(access_token)
+        self.valid_refresh_tokens.add(refresh_token)
+        return {
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "gcid": "stand-in-gcid",
+            "expires_at": datetime.datetime.now(datetime.timezone.utc)
+            + self.token_lifetime,
+        }
+
+    def expire_access_tokens(self) -> None:
+        """Make the API reject every access token issued so far"""
+        self.valid_access_tokens.clear()
+
+    def revoke_refresh_tokens(self) -> None:
+        """Make the API reject every refresh token issued so far"""
+        self.valid_refresh_tokens.clear()
+
+    async def login(self, authentication: MyBMWAuthentication) -> Dict[str, Any]:
+        self.login_calls += 1
+        return self.issue_tokens()
+
+    async def refresh(self, authentication: MyBMWAuthentication) -> Dict[str, Any]:
+        self.refresh_calls += 1
+        if authentication.refresh_token not in self.valid_refresh_tokens:
+            # bimmer_connected falls back to a full login when the refresh returns nothing
+            return {}
+        self.valid_refresh_tokens.discard(authentication.refresh_token)
+        return self.issue_tokens()
+
+    async def init_vehicles(self, account: MyBMWAccount):
+        """Drive bimmer_connected's real auth flow for one request, then list the vehicles"""
+        self.vehicle_calls += 1
+        auth_flow = account.config.authentication.async_auth_flow(
+            httpx.Request("POST", "https://stand-in.invalid/eadrax-vcs/v5/vehicle-list")
+        )
+        request = await auth_flow.__anext__()
+        try:
+            while True:
+                bearer = request.headers["authorization"].removeprefix("Bearer ")
+                status_code = 200 if bearer in self.valid_access_tokens else 401
+                request = await auth_flow.asend(
+                    httpx.Response(status_code, request=request)
+                )
+        except StopAsyncIteration:
+            pass
+        account.vehicles = [StandInVehicle(self, vehicle) for vehicle in self.vehicles]
+
+    async def get_vehicle_state(self, vehicle: StandInVehicle) -> None:
+        self.state_calls += 1
+        self.concurrent_state_calls += 1
+        self.max_concurrent_state_calls = max(
+            self.max_concurrent_state_calls, self.concurrent_state_calls
+        )
+        try:
+            await asyncio.sleep(self.state_delays.get(vehicle.vin, 0))
+            if vehicle.vin in self.state_errors:
+                raise self.state_errors[vehicle.vin]
+        finally:
+            self.concurrent_state_calls -= 1
+
+    @contextmanager
+    def patch(self):
+        """Route bimmer_connected's network calls to the stand-in while the context is active"""
+        stand_in = self
+
+        async def login(authentication):
+            return await stand_in.login(authentication)
+
+        async def refresh(authentication):
+            return await stand_in.refresh(authentication)
+
+        async def init_vehicles(account):
+            return await stand_in.init_vehicles(account)
+
+        with patch.object(MyBMWAuthentication, "_login_row_na", login), patch.object(
+            MyBMWAuthentication, "_refresh_token_row_na", refresh
+        ), patch.object(MyBMWAuthentication, "_login_china", login), patch.object(
+            MyBMWAuthentication, "_refresh_token_china", refresh
+        ), patch.object(
+            MyBMWAccount, "_init_vehicles", init_vehicles
+        ):
+            yield self
@@ -4,7 +4,7 @@ from typing import List
 from azure.functions import EventHubEvent
 import datetime
 from dateutil import parser
-from shared_code import recursively_deserialize
+from shared_code import deserialize_nested_json
 
 
 def load_test_data():
@@ -17,7 +17,7 @@ def load_test_data():
 
     with open(test_data_path, "r") as f:
         raw_test_data = f.read()
-    whole_object = recursively_deserialize(raw_test_data)
+    whole_object = deserialize_nested_json(raw_test_data)
     # in functions, the payload is a string, but in tests it is a dict because it is loaded from JSON
     # within whole_object, for each item, replace [properties][body] with json.dumps([properties][body])
     for item in whole_object:
@@ -1,9 +1,10 @@
-from dotenv_vault import load_dotenv
 from typing import List
 
 import azure.functions as func
 
+from shared_code.profiling import profiled
 from shared_code.timescale import store_data
+from shared_code.warm_up import start_warm_up
 
 # from shared_code import (
 #     create_single_timescale_record,
@@ -11,10 +12,11 @@ from shared_code.timescale import store_data
 #     get_table_name,
 # )
 
-load_dotenv()
+start_warm_up("timeseries_to_timescale")
 
 
-def main(events: List[func.EventHubEvent]):
+@profiled("timeseries_to_timescale")
+def main(events: List[func.EventHubEvent], context: func.Context):
     # print(f"Connection string: {get_connection_string()}")
     # print(f"Table name: {get_table_name()}")
     store_data(events)